@@ -0,0 +1,160 @@
+import cv2
+import numpy as np
+
+from .landmark_store import pose_connections
+
+_connections = np.array(pose_connections, dtype=np.intp)
+font = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def fit(frame, max_width, max_height=None):
+    """
+    :return: A downscaled copy of frame that fits in max_width x max_height, keeping its aspect ratio. Always a copy,
+    so it can be drawn on even when frame is a read-only view from the frame store.
+    """
+    height, width = frame.shape[:2]
+    scale = min(max_width / width, max_height / height if max_height else max_width / width)
+    if scale >= 1:
+        return frame.copy()
+    return cv2.resize(frame, (max(int(width * scale), 1), max(int(height * scale), 1)), interpolation=cv2.INTER_AREA)
+
+
+def draw_pose(img, landmarks, visible, colour=(255, 0, 0), radius=5, thickness=2, connections=_connections):
+    """
+    Draws one person's landmarks onto img in place. Every bone goes to OpenCV in a single polylines call.
+    :param landmarks: (33, 4) array of normalized x, y, z, visibility, ex; a row of LandmarkSeries.landmarks
+    :param visible: (33,) bool array, only visible landmarks and bones between two of them are drawn
+    :param radius: of the joint dots, 0 for none. Default to 5.
+    :param thickness: of the bones, 0 for none. Default to 2.
+    :param connections: (n, 2) landmark index pairs to join. Default to pose_connections.
+    """
+    img_height, img_width = img.shape[:2]
+    # Same rounding as draw_points always did, int() of the scaled coordinate
+    points = (np.nan_to_num(landmarks[:, :2]) * (img_width, img_height)).astype(np.int32)
+
+    if thickness and len(connections) != 0:
+        bones = connections[visible[connections[:, 0]] & visible[connections[:, 1]]]
+        if len(bones) != 0:
+            cv2.polylines(img, list(points[bones]), False, colour, thickness, cv2.LINE_AA)
+    if radius:
+        for x, y in points[visible].tolist():
+            cv2.circle(img, (x, y), radius, colour, -1)
+    return img
+
+
+def score_colour(score, good_score=25):
+    # Scores are percent off target, lower is better
+    return (0, 200, 0) if score <= good_score else (0, 0, 230)
+
+
+def draw_text(img, lines, origin=(4, 4), scale=0.4, background=(0, 0, 0)):
+    """
+    Writes lines of text onto img in place, top to bottom on a dark box so they stay readable on any frame.
+    :param lines: (text, BGR colour) tuples
+    """
+    if not lines:
+        return img
+    sizes = [cv2.getTextSize(text, font, scale, 1) for text, _ in lines]
+    line_height = max(h + baseline for (_, h), baseline in sizes) + 2
+    box_width = max(w for (w, _), _ in sizes) + 6
+    x, y = origin
+    cv2.rectangle(img, (x, y), (x + box_width, y + line_height * len(lines) + 2), background, -1)
+    for i, (text, colour) in enumerate(lines):
+        cv2.putText(img, text, (x + 3, y + line_height * (i + 1) - 2), font, scale, colour, 1, cv2.LINE_AA)
+    return img
+
+
+def score_lines(scores, titles=None, good_score=25):
+    """
+    :param scores: {condition name: score}, as returned by score_frames
+    :param titles: {condition name: title} to show instead of the names. Default to None.
+    :return: One (text, colour) line per condition, for draw_text
+    """
+    titles = titles or {}
+    return [(f"{titles.get(name) or name}: {score:.0f}%", score_colour(score, good_score))
+            for name, score in (scores or {}).items()]
+
+
+def draw_tile(frame, landmarks=None, visible=None, scores=None, titles=None, label=None, tile_width=320,
+              colour=(255, 0, 0)):
+    """
+    One contact sheet tile: the frame downscaled to tile_width, with the skeleton and the scores on it. Drawing happens
+    after downscaling, so the cost doesn't depend on the video's resolution.
+    :param label: first line of text, ex; "Rep 1 - frame 30". Default to None.
+    :return: The tile, a new array
+    """
+    tile = fit(frame, tile_width)
+    if landmarks is not None:
+        draw_pose(tile, landmarks, visible, colour, radius=max(tile.shape[1] // 160, 2),
+                  thickness=max(tile.shape[1] // 320, 1))
+    lines = ([(label, (255, 255, 255))] if label else []) + score_lines(scores, titles)
+    return draw_text(tile, lines)
+
+
+def contact_sheet(tiles, columns=4, background=(32, 32, 32)):
+    """
+    Lays tiles out in rows of columns, in order. Tiles are padded to the size of the largest one.
+    :return: The sheet as one image, or None if there are no tiles
+    """
+    if not tiles:
+        return None
+    tile_height = max(tile.shape[0] for tile in tiles)
+    tile_width = max(tile.shape[1] for tile in tiles)
+    columns = min(columns, len(tiles))
+    rows = -(-len(tiles) // columns)
+    sheet = np.empty((rows * tile_height, columns * tile_width, 3), dtype=np.uint8)
+    sheet[:] = background
+    for i, tile in enumerate(tiles):
+        top, left = (i // columns) * tile_height, (i % columns) * tile_width
+        sheet[top:top + tile.shape[0], left:left + tile.shape[1]] = tile
+    return sheet
+
+
+class AnnotatedVideoWriter:
+    def __init__(self, path, fps, max_side=480, fourcc="mp4v"):
+        """
+        Writes frames downscaled with the skeleton drawn on them, one at a time, so memory doesn't grow with the
+        video's length. The file is opened with the size of the first frame written.
+        :param max_side: longer side of the written frames, in pixels. Default to 480.
+        :param fourcc: codec, "mp4v" is available in every OpenCV build. Default to "mp4v".
+        """
+        self.path = path
+        self.fps = fps
+        self.max_side = max_side
+        self.fourcc = fourcc
+        self.frames = 0
+        self._writer = None
+        self._size = None
+
+    def write(self, frame, landmarks=None, visible=None, lines=None, colour=(255, 0, 0)):
+        """
+        :param landmarks: (33, 4) landmarks to draw. Default to None (the frame as is).
+        :param lines: (text, colour) tuples to write in the corner, see score_lines. Default to None.
+        """
+        if self._size is None:
+            height, width = frame.shape[:2]
+            scale = min(self.max_side / max(height, width), 1)
+            # Most encoders want even dimensions
+            self._size = (max(int(width * scale) // 2 * 2, 2), max(int(height * scale) // 2 * 2, 2))
+            self._writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, self._size)
+            if not self._writer.isOpened():
+                raise RuntimeError(f"Can't write {self.path} with the {self.fourcc} codec")
+
+        img = cv2.resize(frame, self._size, interpolation=cv2.INTER_AREA)
+        if landmarks is not None:
+            draw_pose(img, landmarks, visible, colour, radius=max(self._size[0] // 160, 2),
+                      thickness=max(self._size[0] // 320, 1))
+        draw_text(img, lines)
+        self._writer.write(img)
+        self.frames += 1
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,255 @@
+"""
+Analyzes a whole directory (or manifest) of videos across every core, ex; to re-score archived uploads after
+movement_criteria.json changed. Each video gets one JSON line in the results file with its key frames and scores.
+Videos already in the results file for the current criteria are skipped, so an interrupted run picks up where it
+stopped.
+
+    python -m "Python Pose Analysis.batch_analyze" user_videos/ --movement squat --output results.jsonl
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+
+from .landmarker_pool import get_pool
+from .metrics import AnalysisStats, to_prometheus
+
+
+def _init_worker():
+    from mediapipe.tasks.python import vision
+    from .video_analyzer import default_models, model_path, resolve_tier
+
+    # Load the scan model once when the worker starts, every video in this worker then reuses it
+    get_pool(model_path(resolve_tier(default_models["scan"])), running_mode=vision.RunningMode.VIDEO,
+             output_segmentation_masks=False).warm_up()
+
+
+def criteria_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+
+
+def find_videos(source):
+    """
+    :param source: a directory (searched recursively for .mp4 files) or a manifest file with one video path per line.
+           Relative paths in a manifest are relative to the manifest.
+    :return: The absolute paths of the videos, sorted
+    """
+    if os.path.isdir(source):
+        videos = [os.path.join(root, name) for root, _, names in os.walk(source) for name in names
+                  if name.lower().endswith('.mp4')]
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            videos = [os.path.join(base, line.strip()) for line in f if line.strip() and not line.startswith('#')]
+
+    return sorted(os.path.abspath(v) for v in videos)
+
+
+def video_dimensions(video_path):
+    """
+    :return: The (width, height) of a video as it's played, like the frontend reports it for an upload, or None if
+    it can't be read. Phones store portrait videos sideways with a rotation, so the rotation is applied.
+    """
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            return None
+        width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if int(cap.get(cv2.CAP_PROP_ORIENTATION_META)) % 180 == 90:
+            width, height = height, width
+        return width, height
+    finally:
+        cap.release()
+
+
+def load_finished(output_path, criteria):
+    """
+    :return: The videos already analyzed successfully with these criteria according to the results file
+    """
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interruption, the video just runs again
+                continue
+            if record.get("status") == "done" and record.get("criteria") == criteria:
+                finished.add(record["video"])
+    return finished
+
+
+def analyze_video(video_path, movement_type, frames_cut_ps, width=None, height=None):
+    """
+    Finds the key frames of one video and scores each of them. Runs in the worker processes.
+    :param width: recording width, see VideoAnalyzer. Default to None (read from the video, see video_dimensions).
+    :param height: recording height. Default to None (read from the video).
+    :return: The video's results record
+    """
+    from .video_analyzer import VideoAnalyzer
+
+    start = time.perf_counter()
+    record = {"video": video_path, "movement_type": movement_type}
+    analyzer = None
+    try:
+        if width is None or height is None:
+            dimensions = video_dimensions(video_path)
+            if dimensions is None:
+                raise ValueError(f"Can't read {video_path}")
+            width, height = dimensions
+        record.update({"width": width, "height": height})
+        analyzer = VideoAnalyzer(video_path, frames_cut_ps, width, height)
+        key_frames = analyzer.find_key_time(movement_type, streaming=True, save_key_frames=False) or []
+        frame_indices = [int(os.path.splitext(name)[0]) for name in key_frames]
+        rep_scores = analyzer.score_frames(movement_type, frame_indices)
+
+        record.update({
+            "status": "done",
+            "key_frames": frame_indices,
+            # Scores of the first key frame, the one the server reports
+            "scores": rep_scores.get(frame_indices[0]) if frame_indices else None,
+            "rep_scores": {str(k): v for k, v in rep_scores.items()},
+            "reps": [rep._asdict() for rep in analyzer.reps or []],
+            "frames": len(analyzer.landmarks) if analyzer.landmarks is not None else 0,
+            "model_calls": analyzer.tier_calls,
+        })
+    except Exception as e:
+        traceback.print_exc()
+        record.update({"status": "failed", "error": repr(e), "frames": 0})
+
+    record["stats"] = analyzer.stats.to_dict() if analyzer is not None else None
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+
+def run_batch(videos, movement_type, output_path, workers=None, frames_cut_ps=5, width=None, height=None,
+              resume=True, metrics_path=None):
+    """
+    Analyzes every video in a process pool and appends one JSON line per video to output_path as soon as it's done.
+    If a worker process dies, the videos it took down with it are analyzed again one at a time in a new pool, and
+    the one that kills its worker again is recorded as failed.
+    :param workers: number of worker processes. Default to None (one per CPU).
+    :param width: recording width of every video. Default to None (each video's own, see video_dimensions).
+    :param height: recording height of every video. Default to None (each video's own).
+    :param resume: skip videos output_path already has results for with the current criteria. Default to True.
+    :param metrics_path: file the summed stage timings and frame counts of the run are written to in the Prometheus
+           text format, ex; for node_exporter's textfile collector. Default to None.
+    :return: A dictionary of counts and throughput, with the summed AnalysisStats.to_dict() under "stats"
+    """
+    criteria = criteria_hash(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'movement_criteria.json'))
+    finished = load_finished(output_path, criteria) if resume else set()
+    pending = [v for v in videos if v not in finished]
+    print(f"{len(videos)} videos, {len(videos) - len(pending)} already done, {len(pending)} to analyze")
+
+    workers = workers or os.cpu_count() or 1
+    counts = {"done": 0, "failed": 0, "frames": 0}
+    stats = AnalysisStats()
+    start = time.perf_counter()
+
+    queue = collections.deque(pending)
+    # Videos that were running when a worker died, each runs alone from then on to find out which one it was
+    suspects = set()
+    recorded = 0
+    with open(output_path, 'a') as output:
+        def record_video(record):
+            nonlocal recorded
+            record["criteria"] = criteria
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+
+            recorded += 1
+            counts[record["status"]] += 1
+            counts["frames"] += record["frames"]
+            if record["stats"] is not None:
+                stats.merge(record["stats"])
+            elapsed = time.perf_counter() - start
+            print(f"[{recorded}/{len(pending)}] {record['status']} {os.path.basename(record['video'])} "
+                  f"({recorded / elapsed:.2f} videos/s, {counts['frames'] / elapsed:.1f} frames/s)")
+
+        def can_submit(running):
+            if not queue or len(running) >= workers or any(v in suspects for v in running.values()):
+                return False
+            return not running or queue[0] not in suspects
+
+        while queue:
+            # Spawn instead of fork, mediapipe's threads don't survive a fork
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        mp_context=multiprocessing.get_context("spawn"),
+                                                        initializer=_init_worker) as executor:
+                # Only as many videos as workers are handed over at once, so a dead worker only takes those down
+                running = {}
+                broken = False
+                while (queue or running) and not broken:
+                    while can_submit(running):
+                        video = queue.popleft()
+                        running[executor.submit(analyze_video, video, movement_type, frames_cut_ps, width,
+                                                height)] = video
+                    finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        video = running.pop(future)
+                        try:
+                            record_video(future.result())
+                        except BrokenProcessPool:
+                            running[future] = video
+                            broken = True
+
+                # The pool is gone, and every video still running with it
+                for future, video in running.items():
+                    if future.exception() is None:
+                        record_video(future.result())
+                    elif video in suspects:
+                        record_video({"video": video, "movement_type": movement_type, "status": "failed",
+                                      "error": repr(future.exception()), "frames": 0, "stats": None,
+                                      "seconds": 0.0})
+                    else:
+                        suspects.add(video)
+                        queue.appendleft(video)
+            if broken and queue:
+                print(f"A worker process died, {len(queue)} videos left to analyze in a new pool")
+
+    elapsed = time.perf_counter() - start
+    counts["skipped"] = len(videos) - len(pending)
+    counts["seconds"] = elapsed
+    counts["videos_per_second"] = (counts["done"] + counts["failed"]) / elapsed if elapsed > 0 else 0
+    counts["frames_per_second"] = counts["frames"] / elapsed if elapsed > 0 else 0
+    counts["stats"] = stats.to_dict()
+
+    if metrics_path is not None:
+        with open(metrics_path, 'w') as f:
+            f.write(to_prometheus(stats, {"movement_type": movement_type}, analyses=len(pending)))
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze a directory or manifest of videos in parallel.")
+    parser.add_argument("source", help="directory of .mp4 files, or a manifest with one video path per line")
+    parser.add_argument("--movement", default="squat", help="movement type in movement_criteria.json")
+    parser.add_argument("--output", default="results.jsonl", help="JSON lines file results are appended to")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default one per CPU")
+    parser.add_argument("--frames-cut-ps", type=int, default=5, help="frames analyzed per second of video")
+    parser.add_argument("--width", type=int, default=None, help="recording width of every video, default each one's")
+    parser.add_argument("--height", type=int, default=None, help="recording height of every video, default each one's")
+    parser.add_argument("--no-resume", action="store_true", help="analyze every video, even ones already done")
+    parser.add_argument("--metrics", default=None, help="write stage timings in the Prometheus text format here")
+    args = parser.parse_args(argv)
+
+    counts = run_batch(find_videos(args.source), args.movement, args.output, args.workers, args.frames_cut_ps,
+                       args.width, args.height, resume=not args.no_resume, metrics_path=args.metrics)
+    print(f"{counts['done']} done, {counts['failed']} failed, {counts['skipped']} skipped in {counts['seconds']:.1f}s "
+          f"({counts['videos_per_second']:.2f} videos/s, {counts['frames_per_second']:.1f} frames/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Checks how long importing the pipeline modules takes, each in a fresh interpreter with -X importtime, against a time
+budget. Also checks that none of them pulls in the heavy optional dependencies (mediapipe, scipy, matplotlib,
+send2trash) at import: those are only loaded when the code that needs them runs.
+
+    python benchmarks/import_time.py [--budget-scale 1.0] [--top 10]
+
+Exits with status 1 if a module is over budget or imports one of the deferred dependencies.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+package = os.path.basename(package_dir)
+
+# Milliseconds of cumulative import time allowed per module, on top of what numpy and OpenCV cost by themselves
+budgets_ms = {
+    "rep_segmentation": 50,
+    "criteria": 50,
+    "scoring": 50,
+    "metrics": 20,
+    "video_analyzer": 150,
+    "batch_analyze": 150,
+    "job_service": 200,
+    "live_stream": 50,
+}
+# Unavoidable imports every module above needs, timed separately so budgets only cover our own code
+baseline_imports = ("numpy", "cv2")
+deferred = ("mediapipe", "scipy", "matplotlib", "send2trash")
+
+# Lines look like "import time:  self [us] | cumulative | imported package"
+line_re = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(.+)$")
+
+
+def import_times(code):
+    """
+    Runs code in a fresh interpreter with -X importtime.
+    :return: A tuple of ({top level module: cumulative microseconds}, [(cumulative us, module)] for every module,
+    modules loaded afterwards)
+    """
+    script = f"import sys\n{code}\nprint('\\n'.join(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", script], capture_output=True, text=True,
+                            cwd=os.path.dirname(package_dir))
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    top_level = {}
+    everything = []
+    for line in result.stderr.splitlines():
+        match = line_re.match(line)
+        if match is None:
+            continue
+        cumulative, indent, name = int(match.group(2)), len(match.group(3)), match.group(4)
+        everything.append((cumulative, name))
+        # Only the modules the code imported directly, nested ones are already in their cumulative time
+        if indent == 1:
+            top_level[name] = top_level.get(name, 0) + cumulative
+    return top_level, everything, result.stdout.splitlines()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="multiply every budget, ex; for slow CI")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports listed per module")
+    args = parser.parse_args()
+
+    baseline, _, _ = import_times("\n".join(f"import {name}" for name in baseline_imports))
+    baseline_ms = sum(baseline.values()) / 1000
+    print(f"{', '.join(baseline_imports)}: {baseline_ms:.0f}ms")
+
+    failures = []
+    for module, budget in budgets_ms.items():
+        top_level, everything, loaded = import_times(
+            "\n".join(f"import {name}" for name in baseline_imports) +
+            # __import__ since the package name has spaces, importlib.import_module would bypass -X importtime
+            f"\n__import__({f'{package}.{module}'!r})")
+        own_ms = sum(us for name, us in top_level.items() if name.startswith(package)) / 1000
+        budget *= args.budget_scale
+        leaked = sorted({name.split(".")[0] for name in loaded} & set(deferred))
+
+        status = "ok"
+        if own_ms > budget:
+            status = "OVER BUDGET"
+            failures.append(module)
+        if leaked:
+            status = f"imports {', '.join(leaked)}"
+            failures.append(module)
+        print(f"{module:<18} {own_ms:>7.1f}ms / {budget:.0f}ms  {status}")
+
+        if status != "ok":
+            own = [(us, name) for us, name in everything if not name.startswith(baseline_imports)]
+            for us, name in sorted(own, reverse=True)[:args.top]:
+                print(f"    {us / 1000:>7.1f}ms {name}")
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
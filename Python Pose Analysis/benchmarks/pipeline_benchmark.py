@@ -0,0 +1,433 @@
+"""
+Times every stage of the video pipeline on synthetic squat videos and landmark series, each stage on its own and the
+whole analysis end to end. Videos and series are generated offline from a fixed seed, so runs on the same machine are
+comparable. Every stage runs in a fresh process so its peak RSS isn't inflated by the stages before it.
+
+Results are written as JSON. Pass --baseline to compare against an earlier results file, stages that got slower or
+use more memory than the thresholds allow are listed and the script exits with status 1.
+
+    python benchmarks/pipeline_benchmark.py [--quick] [--output results.json] [--baseline baseline.json]
+
+Stages that run the pose model are skipped when the model files aren't next to video_analyzer.py.
+"""
+import argparse
+import contextlib
+import importlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Windows, peak RSS isn't reported
+    resource = None
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+package = os.path.basename(package_dir)
+# The pipeline modules use relative imports, so they're imported as a package from the directory above
+sys.path.insert(0, os.path.dirname(package_dir))
+
+# Recording size and orientation as the phone reports it, portrait videos are stored sideways and rotated back by the
+# analyzer like real uploads
+video_cases = {
+    "720p_30fps_10s": {"seconds": 10, "fps": 30, "width": 1280, "height": 720},
+    "720p_30fps_10s_portrait": {"seconds": 10, "fps": 30, "width": 720, "height": 1280},
+    "1080p_60fps_10s": {"seconds": 10, "fps": 60, "width": 1920, "height": 1080},
+    "720p_30fps_60s": {"seconds": 60, "fps": 30, "width": 1280, "height": 720},
+}
+# Landmark series only, for the stages after detection. samples_per_second is the analyzer's frames_cut_ps
+series_cases = {
+    "series_1min_5sps": {"seconds": 60, "samples_per_second": 5},
+    "series_10min_5sps": {"seconds": 600, "samples_per_second": 5},
+    "series_10min_30sps": {"seconds": 600, "samples_per_second": 30},
+}
+video_stages = ("decode", "split_frames", "split_frames_store", "detection", "end_to_end")
+series_stages = ("angles", "rep_segmentation", "scoring")
+model_stages = ("detection", "end_to_end")
+
+# Lines of the stick figure drawn in the synthetic videos, as landmark index pairs
+skeleton = [(11, 12), (11, 13), (13, 15), (12, 14), (14, 16), (11, 23), (12, 24), (23, 24), (23, 25), (25, 27),
+            (27, 29), (29, 31), (27, 31), (24, 26), (26, 28), (28, 30), (30, 32), (28, 32)]
+
+
+def squat_pose(depth):
+    """
+    A side on squat, ankles fixed and everything above them folding with depth.
+    :param depth: 0 standing to 1 at the bottom
+    :return: (33, 4) array of normalized x, y, z, visibility
+    """
+    shin, thigh, torso = 0.2, 0.2, 0.26
+    ankle = np.array([0.5, 0.85])
+    knee = ankle + shin * np.array([math.sin(0.7 * depth), -math.cos(0.7 * depth)])
+    hip = knee + thigh * np.array([-math.sin(1.7 * depth), -math.cos(1.7 * depth)])
+    shoulder = hip + torso * np.array([math.sin(0.8 * depth), -math.cos(0.8 * depth)])
+    elbow = shoulder + np.array([0.08, 0.06])
+    wrist = elbow + np.array([0.1, -0.02])
+    nose = shoulder + np.array([0.04, -0.09])
+
+    points = np.tile(nose, (33, 1))
+    # Eyes, ears and mouth around the nose
+    points[1:11] += np.linspace(-0.02, 0.02, 10)[:, np.newaxis]
+    for left, right, point in ((11, 12, shoulder), (13, 14, elbow), (15, 16, wrist), (23, 24, hip), (25, 26, knee),
+                               (27, 28, ankle), (29, 30, ankle + [-0.03, 0.03]), (31, 32, ankle + [0.06, 0.03])):
+        # The far side sits a touch behind the near one
+        points[left] = point
+        points[right] = point + [0.005, -0.002]
+    # Pinkies, index fingers and thumbs on the wrists
+    points[17:23] = np.tile(points[15:17], (3, 1))
+
+    landmarks = np.zeros((33, 4), dtype=np.float32)
+    landmarks[:, :2] = points
+    landmarks[:, 3] = 0.95
+    return landmarks
+
+
+def squat_depths(num_samples, samples_per_second, rng):
+    """
+    :return: A tuple of (depth of each sample, number of complete reps). Reps take 2 to 4 seconds with a pause at the
+    top of each.
+    """
+    depths = []
+    reps = 0
+    while len(depths) < num_samples:
+        rep = max(int(rng.uniform(2, 4) * samples_per_second), 4)
+        pause = int(rng.uniform(0, 1) * samples_per_second)
+        bottom = rng.uniform(0.8, 1.0)
+        depths += [0.0] * pause
+        depths += (bottom * (1 - np.cos(np.linspace(0, 2 * math.pi, rep))) / 2).tolist()
+        reps += len(depths) <= num_samples
+    return np.array(depths[:num_samples]), reps
+
+
+def synthetic_series(seconds, samples_per_second, seed=0, video_fps=30):
+    """
+    A LandmarkSeries of a squat set as find_key_time would build it, with landmark jitter, poorly seen landmarks and
+    frames where nobody was detected.
+    :return: A tuple of (LandmarkSeries, number of complete reps)
+    """
+    landmark_store = importlib.import_module(f"{package}.landmark_store")
+
+    rng = np.random.default_rng(seed)
+    num_samples = int(seconds * samples_per_second)
+    depths, reps = squat_depths(num_samples, samples_per_second, rng)
+    landmarks = np.stack([squat_pose(d) for d in depths]) if num_samples else np.empty((0, 33, 4), dtype=np.float32)
+    landmarks[..., :2] += rng.normal(0, 0.003, landmarks[..., :2].shape)
+    landmarks[..., 3][rng.random(landmarks.shape[:2]) < 0.05] = 0.2
+    landmarks[rng.random(num_samples) < 0.03] = np.nan
+
+    timestamps_ms = np.arange(num_samples) * 1000 / samples_per_second
+    frame_indices = np.round(timestamps_ms * video_fps / 1000).astype(np.int64)
+    return landmark_store.LandmarkSeries(landmarks, frame_indices, timestamps_ms), reps
+
+
+def write_video(path, seconds, fps, width, height, seed=0):
+    """
+    Writes a squat set as an mp4: a stick figure over a textured background. Portrait recordings (width < height) are
+    stored rotated a quarter turn, the way phones store them.
+    :return: The number of complete reps in the video
+    """
+    rng = np.random.default_rng(seed)
+    num_frames = int(seconds * fps)
+    depths, reps = squat_depths(num_frames, fps, rng)
+
+    # Upright size of the picture, before the phone's rotation
+    frame_width, frame_height = max(width, height), min(width, height)
+    if width < height:
+        frame_width, frame_height = frame_height, frame_width
+    background = cv2.GaussianBlur(rng.integers(0, 255, (frame_height, frame_width, 3), dtype=np.uint8), (0, 0), 3)
+    scale = np.array([frame_width, frame_height])
+    thickness = max(frame_height // 60, 2)
+
+    stored_size = (max(width, height), min(width, height))
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, stored_size)
+    try:
+        for depth in depths:
+            frame = background.copy()
+            points = (squat_pose(depth)[:, :2] * scale).astype(np.int32)
+            for a, b in skeleton:
+                cv2.line(frame, tuple(points[a].tolist()), tuple(points[b].tolist()), (230, 230, 230), thickness)
+            cv2.circle(frame, tuple(points[0].tolist()), thickness * 3, (230, 230, 230), -1)
+            if width < height:
+                frame = cv2.rotate(frame, cv2.ROTATE_90_COUNTERCLOCKWISE)
+            writer.write(frame)
+    finally:
+        writer.release()
+    return reps
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def model_available(video_analyzer):
+    return all(os.path.exists(video_analyzer.model_path(video_analyzer.resolve_tier(tier)))
+               for tier in video_analyzer.default_models.values())
+
+
+def setup_video_stage(stage, case, video_path, movement_type, max_cached_frames):
+    """
+    :return: A function running the stage once and returning (frames, extra results)
+    """
+    video_analyzer = importlib.import_module(f"{package}.video_analyzer")
+    movement = importlib.import_module(f"{package}.criteria").load_criteria(
+        os.path.join(package_dir, "movement_criteria.json"))[movement_type]
+    frames_cut_ps = case["frames_cut_ps"]
+
+    def new_analyzer(**options):
+        return video_analyzer.VideoAnalyzer(video_path, frames_cut_ps, case["width"], case["height"],
+                                            landmark_cache=False, **options)
+
+    if stage == "decode":
+        analyzer = new_analyzer()
+
+        def run():
+            frames = sum(1 for _ in analyzer.iter_frames())
+            return frames, {"decoded": analyzer.sampling_stats["decoded"]}
+        return run
+
+    if stage == "split_frames":
+        analyzer = new_analyzer()
+
+        def run():
+            shutil.rmtree(analyzer.get_sequence_path(), ignore_errors=True)
+            analyzer.split_frames()
+            return len(os.listdir(analyzer.sequence_path)), {}
+        return run
+
+    if stage == "split_frames_store":
+        analyzer = new_analyzer(frame_store=True)
+
+        def run():
+            analyzer.split_frames()
+            return len(analyzer.get_frame_store()), {}
+        return run
+
+    if stage == "detection":
+        # Frames are decoded ahead so only the model is timed. Long videos would need too much memory for that, so
+        # past max_cached_frames the cached frames are fed again, with the timestamps the real frames would have
+        analyzer = new_analyzer()
+        cached = []
+        num_frames = 0
+        for _, _, frame in analyzer.iter_frames():
+            if len(cached) < max_cached_frames:
+                cached.append(frame)
+            num_frames += 1
+        escalate_joints = movement.action_triples[0] if movement.action_triples.shape[0] > 0 else None
+        from mediapipe.tasks.python import vision
+        analyzer.get_landmarker_pool(analyzer.models["scan"], running_mode=vision.RunningMode.VIDEO).warm_up()
+
+        def run():
+            before = dict(analyzer.tier_calls)
+            frames = ((i, i * 1000 / frames_cut_ps, cached[i % len(cached)]) for i in range(num_frames))
+            series = analyzer.extract_landmarks(frames, escalate_joints=escalate_joints)
+            return len(series), {"detected": int(series.detected.sum()),
+                                 "model_calls": {t: analyzer.tier_calls[t] - before[t] for t in before}}
+        return run
+
+    if stage == "end_to_end":
+        def run():
+            analyzer = new_analyzer()
+            key_frames = analyzer.find_key_time(movement_type, streaming=True, save_key_frames=False) or []
+            analyzer.score_frames(movement_type, [int(os.path.splitext(name)[0]) for name in key_frames])
+            return len(analyzer.landmarks), {"key_frames": len(key_frames), "model_calls": analyzer.tier_calls}
+        return run
+
+    raise ValueError(f"Unknown video stage {stage}")
+
+
+def setup_series_stage(stage, case, movement_type):
+    video_analyzer = importlib.import_module(f"{package}.video_analyzer")
+    movement = importlib.import_module(f"{package}.criteria").load_criteria(
+        os.path.join(package_dir, "movement_criteria.json"))[movement_type]
+    sps = case["samples_per_second"]
+    series, reps = synthetic_series(case["seconds"], sps, seed=case["seed"])
+    analyzer = video_analyzer.VideoAnalyzer("synthetic.mp4", sps, 1280, 720, landmark_cache=False)
+
+    if stage == "angles":
+        def run():
+            analyzer.get_angles(series.landmarks, movement.action_triples, series.visible)
+            return len(series), {}
+        return run
+
+    if stage == "rep_segmentation":
+        # The {frame: angle} dictionary find_key_time hands to get_candidate_frames
+        angle_series = analyzer.get_angles(series.landmarks, movement.action_triples, series.visible)
+        angles_1 = {frame: (None if np.isnan(angle) else float(angle))
+                    for frame, angle in enumerate(angle_series[:, 0].tolist()) if series.detected[frame]}
+
+        def run():
+            frames = analyzer.get_candidate_frames(angles_1) or []
+            return len(series), {"reps": len(frames), "true_reps": reps}
+        return run
+
+    if stage == "scoring":
+        analyzer.landmarks = series
+
+        def run():
+            return len(analyzer.score_frames(movement_type)), {}
+        return run
+
+    raise ValueError(f"Unknown series stage {stage}")
+
+
+def run_stage(stage, case_name, case, video_path, movement_type, repeat, max_cached_frames):
+    """
+    Runs one stage repeat times after a warm up run. Called in a fresh process.
+    :return: The stage's results dictionary
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if stage in model_stages and not model_available(importlib.import_module(f"{package}.video_analyzer")):
+            return {"case": case_name, "stage": stage, "skipped": "pose model files not found"}
+
+        if video_path is not None:
+            run = setup_video_stage(stage, case, video_path, movement_type, max_cached_frames)
+        else:
+            run = setup_series_stage(stage, case, movement_type)
+        rss_before = peak_rss_mb()
+
+        frames, extra = run()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            frames, extra = run()
+            times.append(time.perf_counter() - start)
+
+    times = np.array(times)
+    median = float(np.median(times))
+    rss_after = peak_rss_mb()
+    return {
+        "case": case_name,
+        "stage": stage,
+        "frames": frames,
+        "repeat": repeat,
+        "median_s": median,
+        "latency_ms": {f"p{p}": float(np.percentile(times, p) * 1000) for p in (50, 95, 99)},
+        "max_ms": float(times.max() * 1000),
+        "frames_per_second": frames / median if median > 0 else None,
+        "peak_rss_mb": rss_after,
+        "rss_growth_mb": rss_after - rss_before if rss_after is not None else None,
+        **extra,
+    }
+
+
+def compare(results, baseline, threshold, rss_threshold):
+    """
+    :param threshold: how much slower (fraction of the baseline's median) a stage may get before it's a regression
+    :param rss_threshold: same for peak RSS
+    :return: A list of (key, what, baseline value, new value) for every regression
+    """
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None or "median_s" not in old or "median_s" not in result:
+            continue
+        if old["median_s"] > 0 and result["median_s"] > old["median_s"] * (1 + threshold):
+            regressions.append((key, "median_s", old["median_s"], result["median_s"]))
+        if old.get("peak_rss_mb") and result.get("peak_rss_mb") and \
+                result["peak_rss_mb"] > old["peak_rss_mb"] * (1 + rss_threshold):
+            regressions.append((key, "peak_rss_mb", old["peak_rss_mb"], result["peak_rss_mb"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="only the first video and series case, 3 repeats")
+    parser.add_argument("--cases", nargs="+", help="cases to run, default all")
+    parser.add_argument("--stages", nargs="+", choices=video_stages + series_stages, help="stages to run, default all")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per stage, after one warm up run")
+    parser.add_argument("--frames-cut-ps", type=int, default=5, help="frames analyzed per second of video")
+    parser.add_argument("--movement", default="squat", help="movement type in movement_criteria.json")
+    parser.add_argument("--max-cached-frames", type=int, default=64,
+                        help="decoded frames kept in memory for the detection stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="where synthetic videos are written, default a temporary directory")
+    parser.add_argument("--output", default="pipeline_benchmark.json", help="results file")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown against the baseline")
+    parser.add_argument("--rss-threshold", type=float, default=0.2, help="allowed peak RSS growth against the baseline")
+    args = parser.parse_args()
+
+    videos = dict(video_cases)
+    series = dict(series_cases)
+    repeat = args.repeat
+    if args.quick:
+        videos = dict(list(videos.items())[:1])
+        series = dict(list(series.items())[:1])
+        repeat = min(repeat, 3)
+    if args.cases:
+        videos = {k: v for k, v in video_cases.items() if k in args.cases}
+        series = {k: v for k, v in series_cases.items() if k in args.cases}
+    stages = args.stages or video_stages + series_stages
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    jobs = []
+    for name, case in videos.items():
+        path = os.path.join(workdir, f"{name}.mp4")
+        reps = write_video(path, case["seconds"], case["fps"], case["width"], case["height"], args.seed)
+        case = {**case, "frames_cut_ps": args.frames_cut_ps, "reps": reps}
+        jobs += [(stage, name, case, path) for stage in video_stages if stage in stages]
+    for name, case in series.items():
+        case = {**case, "seed": args.seed}
+        jobs += [(stage, name, case, None) for stage in series_stages if stage in stages]
+
+    results = {}
+    print(f"{'case':<26} {'stage':<19} {'frames':>7} {'median ms':>10} {'p95 ms':>9} {'frames/s':>10} {'rss MB':>8}")
+    try:
+        for stage, name, case, path in jobs:
+            # A new process per stage, so each one's peak RSS is its own
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                result = pool.apply(run_stage, (stage, name, case, path, args.movement, repeat,
+                                                args.max_cached_frames))
+            results[f"{name}/{stage}"] = result
+            if "skipped" in result:
+                print(f"{name:<26} {stage:<19} skipped, {result['skipped']}")
+                continue
+            rss = f"{result['peak_rss_mb']:.0f}" if result["peak_rss_mb"] is not None else "-"
+            print(f"{name:<26} {stage:<19} {result['frames']:>7} {result['median_s'] * 1000:>10.1f} "
+                  f"{result['latency_ms']['p95']:>9.1f} {result['frames_per_second'] or 0:>10.0f} {rss:>8}")
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(),
+                    "numpy": np.__version__, "opencv": cv2.__version__},
+        "settings": {"repeat": repeat, "frames_cut_ps": args.frames_cut_ps, "movement": args.movement,
+                     "seed": args.seed},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("machine") != report["machine"]:
+            print("Baseline was recorded on a different machine or environment, comparisons may not be meaningful")
+        regressions = compare(results, baseline["results"], args.threshold, args.rss_threshold)
+        for key, what, old, new in regressions:
+            print(f"REGRESSION {key} {what}: {old:.4g} -> {new:.4g} ({(new / old - 1) * 100:+.0f}%)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Compares rep segmentation (rep_segmentation.find_reps) with the sine fit get_candidate_frames used before it, on
+synthetic knee angle series of increasing length. Reps have irregular depth and tempo, with noise and gaps where the
+joint wasn't seen.
+
+    python benchmarks/rep_segmentation_benchmark.py [--samples-per-second 5] [--seed 0]
+"""
+import argparse
+import importlib
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+package = os.path.basename(package_dir)
+# The modules use relative imports, so they're imported as a package from the directory above
+sys.path.insert(0, os.path.dirname(package_dir))
+
+
+def synthetic_set(num_reps, samples_per_second, rng):
+    """
+    :return: A tuple of (angles with NaN gaps, position of the true bottom of each rep)
+    """
+    angles, bottoms = [], []
+    for _ in range(num_reps):
+        # Stand for a bit, go down, pause at the bottom, come back up
+        stand = rng.uniform(0.3, 1.5)
+        down = rng.uniform(0.8, 2.0)
+        up = rng.uniform(0.6, 1.5)
+        depth = rng.uniform(1.2, 1.9)
+        top = math.pi - rng.uniform(0, 0.15)
+
+        angles += [top] * int(stand * samples_per_second)
+        n_down = max(int(down * samples_per_second), 2)
+        angles += (top - (top - (math.pi - depth)) * np.sin(np.linspace(0, math.pi / 2, n_down)) ** 2).tolist()
+        bottoms.append(len(angles) - 1)
+        n_up = max(int(up * samples_per_second), 2)
+        bottom = math.pi - depth
+        angles += (bottom + (top - bottom) * np.sin(np.linspace(0, math.pi / 2, n_up)) ** 2).tolist()
+
+    angles = np.array(angles) + rng.normal(0, 0.03, len(angles))
+    angles[rng.random(len(angles)) < 0.05] = np.nan
+    return angles, bottoms
+
+
+def sine_fit_candidates(data_analyzer, angles_1):
+    """
+    get_candidate_frames as it was before rep segmentation, kept here as the baseline.
+    """
+    candidate_frames = []
+    angles_1_no_none = {k: v for (k, v) in angles_1.items() if v is not None}
+    labels = list(range(len(angles_1_no_none)))
+    values = list(angles_1_no_none.values())
+
+    sine_fit = data_analyzer.fit_sin(labels, values)
+    angle_thresh = sine_fit["offset"] - abs(sine_fit["amp"])
+    min_values = [i for i in values if i <= angle_thresh]
+    if len(min_values) == 0:
+        min_values = [min(values)]
+
+    min_key = -1
+    prev_frame = 0
+    current_min = float('inf')
+    for k, v in angles_1.items():
+        if v not in min_values:
+            continue
+        if k - 1 != prev_frame:
+            if min_key != -1:
+                candidate_frames.append(min_key)
+            else:
+                candidate_frames.append(k)
+            min_key = -1
+            current_min = float('inf')
+        else:
+            if v < current_min:
+                current_min = v
+                min_key = k
+        prev_frame = k
+
+    return candidate_frames
+
+
+def matched(found, bottoms, tolerance):
+    """
+    :return: How many true bottoms have a found frame within tolerance samples
+    """
+    found = np.array(sorted(found))
+    if len(found) == 0:
+        return 0
+    count = 0
+    for b in bottoms:
+        i = np.searchsorted(found, b)
+        nearest = min(abs(found[j] - b) for j in (i - 1, i) if 0 <= j < len(found))
+        count += nearest <= tolerance
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--samples-per-second", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reps", type=int, nargs="+", default=[5, 20, 100, 500])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    data_analysis = importlib.import_module(f"{package}.data_analysis")
+    find_reps = importlib.import_module(f"{package}.rep_segmentation").find_reps
+
+    data_analyzer = data_analysis.DataAnalyzer()
+    tolerance = args.samples_per_second // 2 + 1
+    min_spacing = max(args.samples_per_second // 2, 1)
+
+    print(f"{'reps':>5} {'samples':>8} | {'sine fit ms':>11} {'found':>6} {'matched':>7} | "
+          f"{'find_reps ms':>12} {'found':>6} {'matched':>7}")
+    for num_reps in args.reps:
+        angles, bottoms = synthetic_set(num_reps, args.samples_per_second, rng)
+        angles_1 = {k: (None if np.isnan(v) else float(v)) for k, v in enumerate(angles)}
+
+        start = time.perf_counter()
+        try:
+            sine_found = sine_fit_candidates(data_analyzer, angles_1)
+            sine_result = f"{len(sine_found):>6} {matched(sine_found, bottoms, tolerance):>7}"
+        except (RuntimeError, ValueError) as e:
+            sine_result = f"{'failed':>6} {type(e).__name__:>7}"
+        sine_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        reps = find_reps(angles, min_spacing=min_spacing)
+        reps_ms = (time.perf_counter() - start) * 1000
+        found = [rep.bottom for rep in reps]
+
+        print(f"{num_reps:>5} {len(angles):>8} | {sine_ms:>11.1f} {sine_result} | "
+              f"{reps_ms:>12.1f} {len(found):>6} {matched(found, bottoms, tolerance):>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Measures what sparse inference (find_key_time with keyframe_interval > 1) trades for running the model less: model
+calls and time saved, against how far the angle series and the rep bottoms end up from the reference.
+
+Each sampling rate and keyframe interval is measured two ways:
+  flow   on synthetic squat videos whose real pose is known. The real landmarks stand in for the model on the frames it
+         would run on, so only the optical flow's error is measured. Runs without the model files.
+  model  the whole find_key_time with the landmarker, compared with keyframe_interval=1 at the same rate. Skipped when
+         the model files aren't next to video_analyzer.py.
+
+    python benchmarks/sparse_inference.py [--intervals 1 2 3 4 6] [--frames-cut-ps 5 15] [--video clip.mp4]
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from pipeline_benchmark import model_available, package, package_dir, squat_depths, squat_pose, video_cases, write_video
+
+# Portrait cases are stored rotated, the known pose wouldn't line up with the frames
+flow_cases = {name: case for name, case in video_cases.items() if case["width"] >= case["height"]}
+
+
+def compare_series(reference, landmarks, triples, samples_per_second):
+    """
+    :param reference: (frames, 33, 4) landmarks taken as right
+    :param landmarks: (frames, 33, 4) landmarks of the same frames to check
+    :return: A dictionary of angle errors (degrees) at the first action joint, and how the rep bottoms found in both
+    line up
+    """
+    data_analysis = importlib.import_module(f"{package}.data_analysis")
+    rep_segmentation = importlib.import_module(f"{package}.rep_segmentation")
+
+    analyzer = data_analysis.DataAnalyzer()
+    reference_angles = analyzer.get_angles(reference, triples[:1], reference[..., 3] > 0.5)[:, 0]
+    angles = analyzer.get_angles(landmarks, triples[:1], landmarks[..., 3] > 0.5)[:, 0]
+    both = ~np.isnan(reference_angles) & ~np.isnan(angles)
+    errors = np.degrees(np.abs(reference_angles - angles)[both])
+
+    # Same spacing as get_candidate_frames
+    min_spacing = max(int(round(0.5 * samples_per_second)), 1)
+    reference_bottoms = np.array([rep.bottom for rep in rep_segmentation.find_reps(reference_angles,
+                                                                                   min_spacing=min_spacing)])
+    bottoms = np.array([rep.bottom for rep in rep_segmentation.find_reps(angles, min_spacing=min_spacing)])
+    offsets = [int(np.abs(bottoms - b).min()) for b in reference_bottoms] if len(bottoms) else []
+    return {
+        "angle_error_mean_deg": float(errors.mean()) if len(errors) else None,
+        "angle_error_p95_deg": float(np.percentile(errors, 95)) if len(errors) else None,
+        # Frames with a reference angle that still have one
+        "angle_coverage": float(both.sum() / max((~np.isnan(reference_angles)).sum(), 1)),
+        "reps": len(bottoms),
+        "reference_reps": len(reference_bottoms),
+        "bottom_offset_max_samples": max(offsets) if offsets else None,
+    }
+
+
+def measure_flow(video_path, case, samples_per_second, interval, triples, seed):
+    """
+    Runs LandmarkFlow over a synthetic video, with the real pose wherever the model would run.
+    """
+    frame_sampler = importlib.import_module(f"{package}.frame_sampler")
+    landmark_flow = importlib.import_module(f"{package}.landmark_flow")
+
+    depths, _ = squat_depths(int(case["seconds"] * case["fps"]), case["fps"], np.random.default_rng(seed))
+    flow = landmark_flow.LandmarkFlow(interval, required=triples[0]) if interval > 1 else None
+    truth, estimate = [], []
+    model_calls = 0
+    flow_seconds = 0.0
+    for frame_index, _, frame in frame_sampler.FrameSampler(video_path, samples_per_second):
+        real = squat_pose(depths[frame_index])
+        landmarks = None
+        if flow is not None:
+            start = time.perf_counter()
+            landmarks = flow.propagate(frame)
+            flow_seconds += time.perf_counter() - start
+        if landmarks is None:
+            landmarks = real
+            model_calls += 1
+            if flow is not None:
+                flow.update(frame, landmarks)
+        truth.append(real)
+        estimate.append(landmarks)
+
+    frames = len(truth)
+    result = {"frames": frames, "model_calls": model_calls, "model_call_ratio": model_calls / max(frames, 1),
+              "fallbacks": flow.fallbacks if flow is not None else 0,
+              "flow_ms_per_frame": flow_seconds * 1000 / max(frames - model_calls, 1) if flow is not None else None}
+    result.update(compare_series(np.stack(truth), np.stack(estimate), triples, samples_per_second))
+    return result
+
+
+def measure_model(video_path, width, height, samples_per_second, interval, movement_type):
+    """
+    :return: A tuple of (LandmarkSeries, timings and counts)
+    """
+    video_analyzer = importlib.import_module(f"{package}.video_analyzer")
+
+    analyzer = video_analyzer.VideoAnalyzer(video_path, samples_per_second, width, height, landmark_cache=False)
+    start = time.perf_counter()
+    analyzer.find_key_time(movement_type, streaming=True, save_key_frames=False, keyframe_interval=interval)
+    seconds = time.perf_counter() - start
+    counters = analyzer.stats.counters
+    return analyzer.landmarks, {
+        "frames": len(analyzer.landmarks), "seconds": seconds, "model_calls": sum(analyzer.tier_calls.values()),
+        "propagated": counters["frames_propagated"], "fallbacks": counters["flow_fallbacks"],
+        "detection_seconds": analyzer.stats.seconds["detection"], "decode_seconds": analyzer.stats.seconds["decode"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--intervals", type=int, nargs="+", default=[1, 2, 3, 4, 6], help="keyframe intervals")
+    parser.add_argument("--frames-cut-ps", type=int, nargs="+", default=[5, 15], help="sampling rates")
+    parser.add_argument("--cases", nargs="+", default=["720p_30fps_10s"], choices=list(flow_cases),
+                        help="synthetic videos")
+    parser.add_argument("--video", help="also measure the model on this video")
+    parser.add_argument("--width", type=int, default=1920, help="recording width of --video")
+    parser.add_argument("--height", type=int, default=1080, help="recording height of --video")
+    parser.add_argument("--movement", default="squat", help="movement type in movement_criteria.json")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="sparse_inference.json", help="results file")
+    args = parser.parse_args()
+
+    criteria = importlib.import_module(f"{package}.criteria")
+    triples = criteria.load_criteria(os.path.join(package_dir, "movement_criteria.json"))[args.movement].action_triples
+    with_model = model_available(importlib.import_module(f"{package}.video_analyzer"))
+    intervals = sorted(set(args.intervals) | {1})
+
+    workdir = tempfile.mkdtemp(prefix="sparse_inference_")
+    results = {}
+    try:
+        videos = []
+        for name in args.cases:
+            case = flow_cases[name]
+            path = os.path.join(workdir, f"{name}.mp4")
+            write_video(path, case["seconds"], case["fps"], case["width"], case["height"], args.seed)
+            videos.append((name, path, case))
+
+        print(f"{'video':<22} {'kind':<6} {'fps':>4} {'k':>3} {'model calls':>12} {'ms':>8} {'angle err':>10} "
+              f"{'p95':>6} {'reps':>6} {'bottom off':>11}")
+
+        def show(name, kind, rate, k, result):
+            ms = f"{result['seconds'] * 1000:.0f}" if "seconds" in result else \
+                f"{result['flow_ms_per_frame']:.2f}/f" if result.get("flow_ms_per_frame") is not None else "-"
+            error = result["angle_error_mean_deg"]
+            p95 = result["angle_error_p95_deg"]
+            print(f"{name:<22} {kind:<6} {rate:>4} {k:>3} {result['model_calls']:>5}/{result['frames']:<6} {ms:>8} "
+                  f"{error if error is None else f'{error:.2f}':>10} {p95 if p95 is None else f'{p95:.1f}':>6} "
+                  f"{result['reps']:>2}/{result['reference_reps']:<3} {result['bottom_offset_max_samples']!s:>11}")
+
+        for name, path, case in videos:
+            for rate in args.frames_cut_ps:
+                for k in intervals:
+                    result = measure_flow(path, case, rate, k, triples, args.seed)
+                    results[f"{name}/flow/{rate}/{k}"] = result
+                    show(name, "flow", rate, k, result)
+
+        if with_model:
+            model_videos = [(name, path, case["width"], case["height"]) for name, path, case in videos]
+            if args.video:
+                model_videos.append((os.path.basename(args.video), os.path.abspath(args.video), args.width,
+                                     args.height))
+            for name, path, width, height in model_videos:
+                for rate in args.frames_cut_ps:
+                    # Warm up, so the first timed run doesn't pay for loading the model
+                    measure_model(path, width, height, rate, 1, args.movement)
+                    reference = None
+                    for k in intervals:
+                        series, result = measure_model(path, width, height, rate, k, args.movement)
+                        if reference is None:
+                            reference = series
+                        result.update(compare_series(reference.landmarks, series.landmarks, triples, rate))
+                        results[f"{name}/model/{rate}/{k}"] = result
+                        show(name, "model", rate, k, result)
+        else:
+            print("Model files not found, model measurements skipped")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "seed": args.seed, "results": results}, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
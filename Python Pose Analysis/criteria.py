@@ -0,0 +1,196 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from .landmark_store import PoseLandmark
+
+assessment_types = ("line", "parallel_lines", "min_line", "max_line")
+
+
+def add_side_prefix(joints):
+    left_side, right_side = [], []
+    for j in joints:
+        left_side.append("LEFT_" + j) if j != "MOUTH" else left_side.append(j + "_LEFT")
+        right_side.append("RIGHT_" + j) if j != "MOUTH" else right_side.append(j + "_RIGHT")
+
+    return left_side, right_side
+
+
+def encode_target_slope(m):
+    """
+    :param m: a target slope from movement_criteria.json, a number, "inf" or "None" (compare the lines to each other)
+    :return: The slope as a float, np.inf for "inf" and NaN for "None"
+    """
+    if m == "None" or m is None:
+        return np.nan
+    return float(m)
+
+
+def landmark_index(name, where):
+    try:
+        return int(PoseLandmark[name])
+    except (KeyError, TypeError):
+        raise ValueError(f"{where}: unknown landmark {name!r}")
+
+
+def compile_action_joints(action_joints, where="action_joints"):
+    """
+    :param action_joints: {ACTION_JOINT: [ADJACENT_JOINT_1, ADJACENT_JOINT_2]}, left joint first
+    :return: A (n, 3) int array of (action joint, adjacent joint 1, adjacent joint 2) landmark indices, same order
+    """
+    triples = []
+    for action_joint, adjacent in action_joints.items():
+        if len(adjacent) != 2:
+            raise ValueError(f"{where}: {action_joint} needs exactly two adjacent joints")
+        triples.append([landmark_index(j, where) for j in (action_joint, *adjacent)])
+
+    return np.array(triples, dtype=np.intp).reshape(-1, 3)
+
+
+class CompiledCondition:
+    def __init__(self, group, name, condition, profile, where):
+        """
+        One assessment condition from movement_criteria.json with its joint names resolved to landmark indices, in
+        the same combinations get_score evaluates them for the given profile.
+        """
+        self.group = group
+        self.name = name
+        self.title = condition.get("title")
+        self.info = condition.get("info")
+        self.link = condition.get("link")
+        self.assessment_type = condition.get("assessment_type")
+        if self.assessment_type not in assessment_types:
+            raise ValueError(f"{where}: unknown assessment_type {self.assessment_type!r}")
+        if "m" not in condition:
+            raise ValueError(f"{where}: missing target slope m")
+        self.target_slope = condition["m"]
+        try:
+            self.target = encode_target_slope(self.target_slope)
+        except (TypeError, ValueError):
+            raise ValueError(f"{where}: invalid target slope {self.target_slope!r}")
+
+        joints = condition.get("joints")
+        if self.assessment_type == "parallel_lines":
+            if not isinstance(joints, dict) or "first_line" not in joints or "second_line" not in joints:
+                raise ValueError(f"{where}: parallel_lines needs first_line and second_line joints")
+
+            # (first line, second line) pairs of landmark pairs. The side profile compares the left side's lines
+            # with each other and the right side's with each other. The front profile compares each first line with
+            # itself on the left, and each second line with itself on the right.
+            comparisons = []
+            for joints_1 in joints["first_line"]:
+                for joints_2 in joints["second_line"]:
+                    if profile == "side":
+                        left_first, right_first = add_side_prefix(joints_1)
+                        left_second, right_second = add_side_prefix(joints_2)
+                    else:
+                        left_first, right_first = joints_1, joints_2
+                        left_second, right_second = joints_1, joints_2
+                    comparisons.append((left_first, left_second))
+                    comparisons.append((right_first, right_second))
+
+            self.pairs = np.array([[[landmark_index(j, where) for j in line] for line in comparison]
+                                   for comparison in comparisons], dtype=np.intp).reshape(-1, 2, 2)
+        else:
+            if not isinstance(joints, list):
+                raise ValueError(f"{where}: {self.assessment_type} needs a list of joint pairs")
+
+            pairs = []
+            for pair in joints:
+                if profile == "side":
+                    pairs += add_side_prefix(pair)
+                else:
+                    pairs.append(pair)
+
+            self.pairs = np.array([[landmark_index(j, where) for j in pair] for pair in pairs],
+                                  dtype=np.intp).reshape(-1, 2)
+
+
+class CompiledMovement:
+    def __init__(self, name, data):
+        """
+        A movement from movement_criteria.json, validated, with every joint name resolved to its landmark index.
+        """
+        self.name = name
+        self.data = data
+
+        if "action_joints" not in data:
+            raise ValueError(f"{name}: missing action_joints")
+        self.action_joints = data["action_joints"]
+        self.action_triples = compile_action_joints(self.action_joints, f"{name}.action_joints")
+
+        # Landmarks that must be seen on each side for the front profile, in the order determine_profile pairs them
+        left_required, right_required = [], []
+        for i in self.action_joints:
+            if "LEFT" in i:
+                left_required.append(i)
+                left_required += self.action_joints[i]
+            else:
+                right_required.append(i)
+                right_required += self.action_joints[i]
+        self.left_required = np.array([landmark_index(j, name) for j in left_required], dtype=np.intp)
+        self.right_required = np.array([landmark_index(j, name) for j in right_required], dtype=np.intp)
+
+        self.assessments = {}
+        for profile, key in (("side", "assessment_side"), ("front", "assessment_front")):
+            conditions = []
+            for group, group_conditions in data.get(key, {}).items():
+                for condition_name, condition in group_conditions.items():
+                    conditions.append(CompiledCondition(group, condition_name, condition, profile,
+                                                        f"{name}.{key}.{group}.{condition_name}"))
+            self.assessments[profile] = conditions
+
+
+class CompiledCriteria:
+    def __init__(self, path):
+        """
+        Loads and validates a movement criteria file.
+        :param path: path to movement_criteria.json
+        """
+        self.path = path
+        self.mtime = os.stat(path).st_mtime_ns
+        with open(path) as f:
+            self.data = json.load(f)
+
+        self.movements = {name: CompiledMovement(name, data) for name, data in self.data.items()}
+
+    def __getitem__(self, movement_type):
+        return self.movements[movement_type]
+
+    def __contains__(self, movement_type):
+        return movement_type in self.movements
+
+
+_criteria = {}
+_criteria_lock = threading.Lock()
+
+
+def load_criteria(path):
+    """
+    Returns the compiled criteria for a file, only reading and compiling it again when its modification time changes.
+    If the file was edited into something invalid, the last valid version keeps being used.
+    :param path: path to movement_criteria.json
+    """
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    compiled = _criteria.get(path)
+    if compiled is not None and compiled.mtime == mtime:
+        return compiled
+
+    with _criteria_lock:
+        compiled = _criteria.get(path)
+        if compiled is not None and compiled.mtime == mtime:
+            return compiled
+
+        try:
+            compiled = CompiledCriteria(path)
+        except (ValueError, KeyError, TypeError) as e:
+            if compiled is None:
+                raise
+            print(f"Invalid criteria in {path}, keeping the previous version: {e}")
+            return compiled
+
+        _criteria[path] = compiled
+        return compiled
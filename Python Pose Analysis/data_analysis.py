@@ -1,8 +1,6 @@
 import numpy as np
 import cv2
 import math
-import matplotlib as plt
-import scipy.optimize
 
 
 class DataAnalyzer:
@@ -41,7 +39,6 @@ class DataAnalyzer:
 
         t1 = np.subtract(adj_joint_1, target_joint)
         t2 = np.subtract(adj_joint_2, target_joint)
-        print(target_joint, adj_joint_1, adj_joint_2)
 
         # DEBUG ONLY
         if debug_img is not None:
@@ -60,7 +57,34 @@ class DataAnalyzer:
         return math.acos((np.dot(t1, t2)) / (self.magnitude(t1) * self.magnitude(t2)))
 
     def magnitude(self, vector):
-        return math.sqrt(sum(pow(i, 2) for i in vector))
+        return math.hypot(*vector)
+
+    def get_angles(self, landmarks, joint_triples, visible=None):
+        """
+        Batch version of get_angle: the angle at every target joint, for every frame, in one numpy call.
+        :param landmarks: (frames, 33, 3 or 4) array of x, y, z(, visibility), ex; LandmarkSeries.landmarks
+        :param joint_triples: (k, 3) int array of (target joint, adjacent joint 1, adjacent joint 2) landmark indices,
+               ex; CompiledMovement.action_triples
+        :param visible: optional (frames, 33) bool array. Angles involving a joint that isn't visible are NaN.
+        :return: A (frames, k) array of angles in radians. NaN where a joint is missing or two joints overlap.
+        """
+        landmarks = np.asarray(landmarks, dtype=np.float64)[..., :3]
+        joint_triples = np.asarray(joint_triples, dtype=np.intp).reshape(-1, 3)
+
+        target = landmarks[:, joint_triples[:, 0]]
+        t1 = landmarks[:, joint_triples[:, 1]] - target
+        t2 = landmarks[:, joint_triples[:, 2]] - target
+
+        dot = np.einsum('fkc,fkc->fk', t1, t2)
+        norms = np.linalg.norm(t1, axis=-1) * np.linalg.norm(t2, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cos = dot / norms
+        # Rounding can push cos just past +-1, which arccos would turn into NaN
+        angles = np.arccos(np.clip(cos, -1, 1))
+
+        if visible is not None:
+            angles[~np.asarray(visible)[:, joint_triples].all(axis=-1)] = np.nan
+        return angles
 
     # Polynomial Regression
     def polyfit(self, x, y, degree):
@@ -98,6 +122,8 @@ class DataAnalyzer:
 
         def sinfunc(t, A, w, p, c):  return A * np.sin(w * t + p) + c
 
+        # Only the old sine fit key frame search needs scipy, don't make every import pay for it
+        import scipy.optimize
         popt, pcov = scipy.optimize.curve_fit(sinfunc, tt, yy, p0=guess)
         A, w, p, c = popt
         f = w / (2. * np.pi)
@@ -114,16 +140,58 @@ class DataAnalyzer:
             return 'inf'
         return m
 
+    def get_slopes(self, landmarks, joint_pairs, m_inf_threshold, visible=None):
+        """
+        Batch version of get_slope: the slope between every pair of landmarks, for every frame, in one numpy call.
+        Slopes get_slope would call 'inf' (vertical, or at least m_inf_threshold) are np.inf.
+        :param landmarks: (frames, 33, 2 or more) array of x, y, ..., ex; LandmarkSeries.landmarks
+        :param joint_pairs: (k, 2) int array of landmark indices, the slope goes from the first to the second
+        :param visible: optional (frames, 33) bool array. Slopes involving a landmark that isn't visible are NaN.
+        :return: A (frames, k) array of slopes
+        """
+        landmarks = np.asarray(landmarks, dtype=np.float64)
+        joint_pairs = np.asarray(joint_pairs, dtype=np.intp).reshape(-1, 2)
+
+        p1 = landmarks[:, joint_pairs[:, 0]]
+        p2 = landmarks[:, joint_pairs[:, 1]]
+        dx = p2[..., 0] - p1[..., 0]
+        dy = p2[..., 1] - p1[..., 1]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m = dy / dx
+        m[(dx == 0) | (m >= m_inf_threshold)] = np.inf
+
+        if visible is not None:
+            m[~np.asarray(visible)[:, joint_pairs].all(axis=-1)] = np.nan
+        return m
+
     def get_percent_diff(self, actual_value, desired_value, m_inf_threshold=100):
-        # If the target value is 0, the % diff formula always gives 200%, so multiply actual value by 100 in this case
-        if desired_value == 0:
-            return actual_value * 100
         # Infinity case
         if actual_value == "inf" and desired_value == "inf":
             return 0
         elif actual_value == "inf" and desired_value != "inf":
             return float('inf')
+        # If the target value is 0, the % diff formula always gives 200%, so multiply actual value by 100 in this case
+        if desired_value == 0:
+            return actual_value * 100
         elif actual_value != "inf" and desired_value == "inf":
             return (abs(actual_value - m_inf_threshold) / ((actual_value + m_inf_threshold) / 2)) * 100
         # Normal case
         return (abs(desired_value - actual_value) / ((desired_value + actual_value) / 2)) * 100
+
+    def get_percent_diffs(self, actual_values, desired_values, m_inf_threshold=100):
+        """
+        Batch version of get_percent_diff over arrays, with np.inf in place of 'inf'. NaN inputs give NaN.
+        """
+        actual, desired = np.broadcast_arrays(np.asarray(actual_values, dtype=np.float64),
+                                              np.asarray(desired_values, dtype=np.float64))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normal = (np.abs(desired - actual) / ((desired + actual) / 2)) * 100
+            to_inf = (np.abs(actual - m_inf_threshold) / ((actual + m_inf_threshold) / 2)) * 100
+            diffs = np.where(desired == 0, actual * 100, np.where(np.isposinf(desired), to_inf, normal))
+
+        # Infinity case
+        diffs = np.where(np.isposinf(actual), np.where(np.isposinf(desired), 0., np.inf), diffs)
+        diffs[np.isnan(desired)] = np.nan
+        return diffs
@@ -0,0 +1,137 @@
+import cv2
+
+
+class FrameSampler:
+    def __init__(self, video_path, samples_per_second, seek_threshold=2.0, start_ms=0, end_ms=None):
+        """
+        Picks frames out of a video at a fixed rate, using each frame's presentation time instead of its position so
+        variable frame rate videos are sampled evenly. Frames that aren't sampled are only grabbed, never retrieved,
+        and long gaps between samples are skipped by seeking.
+        :param video_path: path to the video file
+        :param samples_per_second: how many frames to keep per second of video
+        :param seek_threshold: seconds between two samples after which the sampler seeks to the next sample instead
+               of grabbing every frame in between. Default to 2 seconds.
+        :param start_ms: timestamp (milliseconds) of the first sample. Default to the start of the video.
+        :param end_ms: timestamp (milliseconds) after which sampling stops. Default to None (end of the video).
+        """
+        self.video_path = video_path
+        self.samples_per_second = samples_per_second
+        self.seek_threshold = seek_threshold
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.fps = None
+        self.num_frames = None
+        self.decoded = 0
+        self.skipped = 0
+        self.seeks = 0
+
+    def __iter__(self):
+        """
+        :return: A generator of (frame_index, timestamp_ms, frame) tuples in presentation order
+        """
+        cap = cv2.VideoCapture(self.video_path)
+        self.fps = cap.get(cv2.CAP_PROP_FPS)  # OpenCV v2.x used "CV_CAP_PROP_FPS"
+        self.num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if self.fps == 0 or self.num_frames == 0:
+            cap.release()
+            return
+
+        interval_ms = 1000 / self.samples_per_second
+        # Timestamps jitter by a few ms, so a frame within half a frame of the target still counts as on time
+        tolerance_ms = 500 / self.fps
+        next_ms = self.start_ms
+        last_ms = 0
+        last_index = None
+
+        try:
+            while True:
+                seeked = next_ms - last_ms >= self.seek_threshold * 1000
+                if seeked:
+                    cap.set(cv2.CAP_PROP_POS_MSEC, max(next_ms - tolerance_ms, 0))
+                    self.seeks += 1
+
+                if not cap.grab():
+                    break
+                frame_index = int(cap.get(cv2.CAP_PROP_POS_FRAMES)) - 1
+                last_ms = cap.get(cv2.CAP_PROP_POS_MSEC)
+
+                # Frames jumped over by a seek were never decoded either
+                if seeked and last_index is not None:
+                    self.skipped += max(frame_index - last_index - 1, 0)
+                last_index = frame_index
+
+                if self.end_ms is not None and last_ms > self.end_ms:
+                    break
+                if last_ms < next_ms - tolerance_ms:
+                    self.skipped += 1
+                    continue
+
+                success, frame = cap.retrieve()
+                if not success:
+                    break
+                self.decoded += 1
+
+                # Skip over any sample times this frame already covers (dropped frames in VFR video)
+                while next_ms - tolerance_ms <= last_ms:
+                    next_ms += interval_ms
+
+                yield frame_index, last_ms, frame
+        finally:
+            cap.release()
+
+    def stats(self):
+        total = self.decoded + self.skipped
+        return {
+            "decoded": self.decoded,
+            "skipped": self.skipped,
+            "seeks": self.seeks,
+            "skipped_ratio": self.skipped / total if total != 0 else 0,
+        }
+
+
+class WindowSampler:
+    def __init__(self, video_path, windows, samples_per_second=None, seek_threshold=2.0):
+        """
+        Samples only inside a few time windows of a video, ex; around candidate rep bottoms, with a FrameSampler per
+        window. Overlapping windows are merged, so no frame comes out twice.
+        :param windows: (start_ms, end_ms) tuples
+        :param samples_per_second: sampling rate inside the windows. Default to None (every frame).
+        :param seek_threshold: same as FrameSampler
+        """
+        self.video_path = video_path
+        self.samples_per_second = samples_per_second
+        self.seek_threshold = seek_threshold
+        self.windows = []
+        for start_ms, end_ms in sorted(windows):
+            start_ms = max(start_ms, 0)
+            if self.windows and start_ms <= self.windows[-1][1]:
+                self.windows[-1][1] = max(self.windows[-1][1], end_ms)
+            else:
+                self.windows.append([start_ms, end_ms])
+        self.samplers = []
+
+    def __iter__(self):
+        """
+        :return: A generator of (frame_index, timestamp_ms, frame) tuples in presentation order, same as FrameSampler
+        """
+        samples_per_second = self.samples_per_second
+        if samples_per_second is None:
+            cap = cv2.VideoCapture(self.video_path)
+            samples_per_second = cap.get(cv2.CAP_PROP_FPS)
+            cap.release()
+            if samples_per_second == 0:
+                return
+
+        for start_ms, end_ms in self.windows:
+            sampler = FrameSampler(self.video_path, samples_per_second, self.seek_threshold, start_ms, end_ms)
+            self.samplers.append(sampler)
+            yield from sampler
+
+    def stats(self):
+        stats = {"decoded": 0, "skipped": 0, "seeks": 0}
+        for sampler in self.samplers:
+            for k in stats:
+                stats[k] += getattr(sampler, k)
+        total = stats["decoded"] + stats["skipped"]
+        stats["skipped_ratio"] = stats["skipped"] / total if total != 0 else 0
+        return stats
@@ -0,0 +1,159 @@
+import mmap
+import os
+import struct
+
+import cv2
+import numpy as np
+
+# magic, version, channels, frame count, height, width, offset of the index
+_header = struct.Struct("<4sHHQIIQ")
+header_size = 64
+magic = b"PAFS"
+version = 1
+
+
+class FrameStoreWriter:
+    def __init__(self, path, max_side=None):
+        """
+        Writes sampled frames one after the other into a single file instead of one JPEG each. Frames are stored raw
+        (no compression), so reading one back is a memory map instead of a decode. The file only appears at path once
+        close() wrote the index, until then it's a .tmp next to it.
+        :param path: where the store goes, ex; images_<id>.frames
+        :param max_side: frames are downscaled so their longer side is at most this many pixels. Every frame of a
+               store has the size of the first one. Default to None (keep the first frame's size).
+        """
+        self.path = path
+        self.max_side = max_side
+        self.shape = None
+        self.frame_indices = []
+        self.timestamps_ms = []
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(bytes(header_size))
+
+    def append(self, frame_index, timestamp_ms, frame):
+        """
+        :param frame: (height, width, channels) uint8 array, resized to the store's size if it differs
+        """
+        if self.shape is None:
+            height, width = frame.shape[:2]
+            scale = self.max_side / max(height, width) if self.max_side else 1
+            if scale < 1:
+                height, width = max(int(height * scale), 1), max(int(width * scale), 1)
+            self.shape = (height, width, frame.shape[2] if frame.ndim == 3 else 1)
+
+        if frame.shape[:2] != self.shape[:2]:
+            frame = cv2.resize(frame, (self.shape[1], self.shape[0]), interpolation=cv2.INTER_AREA)
+        self._file.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        self.frame_indices.append(frame_index)
+        self.timestamps_ms.append(timestamp_ms)
+
+    def close(self):
+        if self._file is None:
+            return
+        height, width, channels = self.shape or (0, 0, 3)
+        # Keep the index 8 byte aligned so it can be viewed in place
+        offset = self._file.tell()
+        self._file.write(bytes(-offset % 8))
+        index_offset = offset + -offset % 8
+        self._file.write(np.asarray(self.frame_indices, dtype=np.int64).tobytes())
+        self._file.write(np.asarray(self.timestamps_ms, dtype=np.float64).tobytes())
+
+        self._file.seek(0)
+        self._file.write(_header.pack(magic, version, channels, len(self.frame_indices), height, width, index_offset))
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """
+        Throws away everything written so far.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class FrameStore:
+    def __init__(self, path):
+        """
+        Read side of a file written by FrameStoreWriter. The whole file is memory mapped, frames and the index are
+        numpy views straight into the mapping, nothing is copied or decoded until it's used. The views are read-only,
+        copy a frame before drawing on it.
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, file_version, channels, count, height, width, index_offset = _header.unpack_from(self._mmap)
+        if file_magic != magic or file_version != version:
+            self.close()
+            raise ValueError(f"{path} is not a version {version} frame store")
+
+        # (frames, height, width, channels) uint8
+        self.frames = np.frombuffer(self._mmap, dtype=np.uint8, count=count * height * width * channels,
+                                    offset=header_size).reshape(count, height, width, channels)
+        self.frame_indices = np.frombuffer(self._mmap, dtype=np.int64, count=count, offset=index_offset)
+        self.timestamps_ms = np.frombuffer(self._mmap, dtype=np.float64, count=count, offset=index_offset + 8 * count)
+        self._positions = None
+
+    def position(self, frame_index):
+        """
+        :return: Where a frame (by its index in the video) sits in the store, or None if it wasn't stored
+        """
+        if self._positions is None:
+            self._positions = {f: i for i, f in enumerate(self.frame_indices.tolist())}
+        return self._positions.get(int(frame_index))
+
+    def get(self, frame_index, default=None):
+        """
+        :return: The frame as a read-only view, or default if it wasn't stored
+        """
+        position = self.position(frame_index)
+        return self.frames[position] if position is not None else default
+
+    def __contains__(self, frame_index):
+        return self.position(frame_index) is not None
+
+    def __len__(self):
+        return len(self.frame_indices)
+
+    def __iter__(self):
+        """
+        :return: A generator of (frame_index, timestamp_ms, frame) tuples in the order they were written, same as
+        VideoAnalyzer.iter_frames
+        """
+        for position, (frame_index, timestamp_ms) in enumerate(zip(self.frame_indices.tolist(),
+                                                                    self.timestamps_ms.tolist())):
+            yield frame_index, timestamp_ms, self.frames[position]
+
+    def close(self):
+        # The mapping can only be closed once no view into it is left, otherwise it goes when the last one does
+        self.frames = self.frame_indices = self.timestamps_ms = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+    def unlink(self):
+        """
+        Closes the store and deletes its file.
+        """
+        self.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
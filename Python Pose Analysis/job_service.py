@@ -0,0 +1,261 @@
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import os
+import threading
+import time
+
+from .metrics import get_registry
+from .video_analyzer import AnalysisCancelled, VideoAnalyzer
+from .workspace import get_workspace_manager
+
+job_statuses = ("queued", "running", "done", "failed", "cancelled")
+
+
+class JobRejected(Exception):
+    """
+    Raised by AnalysisJobService.submit when too many jobs are already waiting.
+    """
+
+
+class AnalysisJob:
+    def __init__(self, job_id, video_path, movement_type, frames_cut_ps, width, height, workspace=None):
+        self.job_id = job_id
+        self.video_path = video_path
+        self.movement_type = movement_type
+        self.frames_cut_ps = frames_cut_ps
+        self.width = width
+        self.height = height
+        self.workspace = workspace
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # Checked by the analyzer between frames, so a running job stops mid-video
+        self.cancel_event = threading.Event()
+        self.done = asyncio.Event()
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "video_path": self.video_path,
+            "movement_type": self.movement_type,
+            "result": self.result,
+            "error": self.error,
+            "queued_s": (self.started or self.finished or time.time()) - self.created,
+            "running_s": (self.finished or time.time()) - self.started if self.started is not None else None,
+        }
+
+
+def run_analysis(job):
+    """
+    The same stages server.js runs for a local analysis: find the key frames, then score the first one.
+    Runs in the executor.
+    """
+    analyzer = VideoAnalyzer(job.video_path, job.frames_cut_ps, job.width, job.height, cancel_event=job.cancel_event,
+                             workspace=job.workspace)
+    try:
+        with analyzer:
+            result = _run_stages(analyzer, job)
+            # Cancelled right at the end still counts, and the workspace goes with it like a failed job's
+            analyzer.check_cancelled()
+            return result
+    finally:
+        # Cancelled and failed analyses still did work worth counting
+        get_registry().record(analyzer.stats)
+
+
+def _run_stages(analyzer, job):
+    key_frames = analyzer.find_key_time(job.movement_type, streaming=True)
+    if not key_frames:
+        return {"key_frames": [], "scores": None, "analyzed_images": [], "stats": analyzer.stats.to_dict()}
+
+    analyzer.check_cancelled()
+    scores = analyzer.analyze_bottom_position(os.path.join(analyzer.sequence_path, key_frames[0]), job.movement_type)
+    return {"key_frames": key_frames, "scores": scores, "analyzed_images": analyzer.analyzed_images_path,
+            "stats": analyzer.stats.to_dict()}
+
+
+class AnalysisJobService:
+    def __init__(self, max_concurrent=None, max_queue=16, executor=None, max_finished=1000, workspace=None):
+        """
+        Runs video analyses in the background with a fixed number of them at once. Jobs wait in a queue, and new jobs
+        are rejected once the queue is full instead of piling up. Everything runs in this process, no broker needed.
+        Create and use it from inside a running event loop.
+        :param max_concurrent: analyses running at the same time. Default to None (one per CPU).
+        :param max_queue: jobs allowed to wait for a free slot before submit starts rejecting. Default to 16.
+        :param executor: where analyses run. It needs to share memory with the service for cancellation to work, so
+               a thread pool. It's left running on stop(), shutting it down is up to the caller. Default to None (a
+               thread pool with max_concurrent threads, shut down by stop()).
+        :param max_finished: finished jobs kept around for status polling, the oldest are forgotten first. Default to
+               1000.
+        :param workspace: a WorkspaceManager the jobs' frames and analyzed images go in, or True for the process-wide
+               one. A finished job's files stay until the manager needs the space, a failed or cancelled one's are
+               deleted right away. Default to None (next to the videos, kept until purged).
+        """
+        self.max_concurrent = max_concurrent or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.max_finished = max_finished
+        self.workspace = workspace
+        self._owns_executor = executor is None
+        self.executor = executor or self._new_executor()
+        self.jobs = {}
+        # Queued jobs in submission order, and how many jobs are in each status, so nothing has to go through every
+        # job to find them
+        self._queued = collections.OrderedDict()
+        self._counts = dict.fromkeys(job_statuses, 0)
+        self._finished = collections.deque()
+        self._queue = asyncio.Queue()
+        self._workers = []
+        self._ids = itertools.count(1)
+
+    def _new_executor(self):
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="analysis")
+
+    def _set_status(self, job, status):
+        self._counts[job.status] -= 1
+        self._counts[status] += 1
+        if job.status == "queued":
+            del self._queued[job.job_id]
+        job.status = status
+
+    def start(self):
+        if self._owns_executor and self.executor is None:
+            # Shut down by stop()
+            self.executor = self._new_executor()
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.max_concurrent)]
+
+    async def stop(self, cancel_running=True):
+        """
+        Stops taking jobs. Queued jobs are cancelled, running ones too unless cancel_running is False, in which case
+        they are waited for. The service can be started again afterwards, ex; by submitting a job.
+        """
+        for job in list(self.jobs.values()):
+            if job.status == "queued" or (cancel_running and job.status == "running"):
+                self.cancel(job.job_id)
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._owns_executor:
+            # Analyses still finishing up after being cancelled are waited for without blocking the event loop
+            executor, self.executor = self.executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+    def submit(self, video_path, movement_type="squat", frames_cut_ps=5, width=1920, height=1080):
+        """
+        Queues an analysis of a video under user_videos/, see VideoAnalyzer.
+        :return: The AnalysisJob, poll it with status()
+        """
+        waiting = self.queue_depth()
+        if waiting >= self.max_queue:
+            raise JobRejected(f"{waiting} jobs are already waiting")
+
+        self.start()
+        job = AnalysisJob(str(next(self._ids)), video_path, movement_type, frames_cut_ps, width, height,
+                          self.workspace)
+        self.jobs[job.job_id] = job
+        self._queued[job.job_id] = job
+        self._counts["queued"] += 1
+        self._queue.put_nowait(job)
+        return job
+
+    def queue_depth(self):
+        # Cancelled jobs stay in the asyncio queue until a worker skips them, so count statuses instead
+        return len(self._queued)
+
+    def status(self, job_id):
+        """
+        :return: The job's state as a dictionary (see AnalysisJob.to_dict), with its place in line while queued, or
+        None for an unknown job. Polling a finished job counts as using its workspace, so it's evicted later.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job.status == "done" and job.result and job.result["analyzed_images"] and job.workspace is not None:
+            manager = get_workspace_manager() if job.workspace is True else job.workspace
+            manager.touch(job.result["analyzed_images"][0])
+        status = job.to_dict()
+        if job.status == "queued":
+            # At most max_queue jobs to go through
+            status["position"] = list(self._queued).index(job_id)
+        return status
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued job right away, or stops a running one at its next frame. A job whose analysis finishes
+        before seeing the cancellation is still done, with its results and files kept.
+        :return: False if the job is unknown or already finished
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.status not in ("queued", "running"):
+            return False
+        job.cancel_event.set()
+        if job.status == "queued":
+            self._finish(job, "cancelled")
+        return True
+
+    async def wait(self, job_id, timeout=None):
+        """
+        Waits for a job to finish.
+        :return: The job's final status dictionary
+        """
+        job = self.jobs[job_id]
+        await asyncio.wait_for(job.done.wait(), timeout)
+        return self.status(job_id)
+
+    def metrics_text(self):
+        """
+        :return: The job counts and the stage timings of every analysis run in this process, in the Prometheus text
+        format, ex; for a /metrics endpoint
+        """
+        counts = self.stats()
+        lines = ["# HELP pose_analysis_jobs Analysis jobs by status.", "# TYPE pose_analysis_jobs gauge"]
+        lines += [f'pose_analysis_jobs{{status="{status}"}} {counts[status]}' for status in job_statuses]
+        return "\n".join(lines) + "\n" + get_registry().prometheus_text()
+
+    def stats(self):
+        counts = dict(self._counts)
+        counts["queue_depth"] = counts["queued"]
+        counts["max_concurrent"] = self.max_concurrent
+        return counts
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.status != "queued":
+                    continue
+                self._set_status(job, "running")
+                job.started = time.time()
+                try:
+                    result = await loop.run_in_executor(self.executor, run_analysis, job)
+                except AnalysisCancelled:
+                    self._finish(job, "cancelled")
+                except Exception as e:
+                    print(f"Analysis job {job.job_id} failed: {e!r}")
+                    job.error = repr(e)
+                    self._finish(job, "failed")
+                else:
+                    job.result = result
+                    self._finish(job, "done")
+            finally:
+                self._queue.task_done()
+
+    def _finish(self, job, status):
+        self._set_status(job, status)
+        job.finished = time.time()
+        job.done.set()
+
+        self._finished.append(job.job_id)
+        while len(self._finished) > self.max_finished:
+            forgotten = self.jobs.pop(self._finished.popleft(), None)
+            if forgotten is not None:
+                self._counts[forgotten.status] -= 1
@@ -0,0 +1,226 @@
+import atexit
+import collections
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from .landmark_store import num_landmarks
+
+
+_video_hashes = {}
+_video_hashes_lock = threading.Lock()
+
+
+def video_content_hash(video_path, chunk_size=1 << 20):
+    """
+    Hashes the contents of a video, so re-uploads of the same file share cache entries. Hashes are remembered for as
+    long as the file's size and modification time don't change.
+    """
+    stat = os.stat(video_path)
+    memo_key = (os.path.abspath(video_path), stat.st_size, stat.st_mtime_ns)
+    with _video_hashes_lock:
+        if memo_key in _video_hashes:
+            return _video_hashes[memo_key]
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(video_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    with _video_hashes_lock:
+        _video_hashes[memo_key] = digest.hexdigest()
+    return _video_hashes[memo_key]
+
+
+class LandmarkCache:
+    def __init__(self, directory=None, max_memory_bytes=32 << 20, max_disk_bytes=512 << 20):
+        """
+        Two level cache of detected landmarks. Entries are grouped by video, model and sensitivity and looked up by
+        the sampled frame's index in the video. Each group is stored on disk as a single .npz file, written by
+        flush(). Both levels evict the least recently used entries (memory) or groups (disk) once over budget.
+        Concurrent writers of the same group may drop each other's new entries, which only costs a re-detection.
+        :param directory: where the .npz files are kept. Default to None (memory only).
+        :param max_memory_bytes: budget for landmark arrays kept in memory
+        :param max_disk_bytes: budget for the .npz files in directory
+        """
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._loaded = set()
+        self._dirty = collections.defaultdict(dict)
+        self._lock = threading.RLock()
+
+        if directory is not None and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def group_key(video_hash, model_asset_path, sensitivity, variant=None):
+        """
+        :param variant: anything else that changes the detections, ex; the running mode, frame size or "roi" for
+               cropped frames. Default to None.
+        """
+        model = os.path.splitext(os.path.basename(model_asset_path))[0]
+        key = f"{video_hash}-{model}-{sensitivity:g}"
+        return f"{key}-{variant}" if variant is not None else key
+
+    def _group_path(self, group):
+        return os.path.join(self.directory, group + ".npz")
+
+    def get(self, group, frame_index):
+        """
+        :return: The (33, 4) landmark array, an empty (0, 4) array if no pose was detected in that frame, or None if
+        the frame isn't cached
+        """
+        if group is None or frame_index is None:
+            return None
+
+        with self._lock:
+            if group not in self._loaded:
+                self._load_group(group)
+
+            landmarks = self._entries.get((group, frame_index))
+            if landmarks is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((group, frame_index))
+            self.hits += 1
+            return landmarks
+
+    def put(self, group, frame_index, landmarks):
+        if group is None or frame_index is None:
+            return
+
+        with self._lock:
+            self._insert(group, frame_index, landmarks)
+            self._dirty[group][frame_index] = landmarks
+
+    def _insert(self, group, frame_index, landmarks):
+        old = self._entries.pop((group, frame_index), None)
+        if old is not None:
+            self._memory_bytes -= old.nbytes
+        self._entries[(group, frame_index)] = landmarks
+        self._memory_bytes += landmarks.nbytes
+
+        while self._memory_bytes > self.max_memory_bytes and len(self._entries) > 1:
+            (evicted_group, _), evicted = self._entries.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+            # Let the group be read from disk again the next time it's needed
+            self._loaded.discard(evicted_group)
+
+    def _load_group(self, group):
+        self._loaded.add(group)
+        if self.directory is None:
+            return
+
+        path = self._group_path(group)
+        try:
+            with np.load(path) as data:
+                frames, landmarks, detected = data["frames"], data["landmarks"], data["detected"]
+            # Reading a group counts as using it for the disk LRU
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return
+
+        empty = np.empty((0, 4), dtype=np.float32)
+        for frame_index, frame_landmarks, frame_detected in zip(frames.tolist(), landmarks, detected):
+            if (group, frame_index) not in self._entries:
+                self._insert(group, frame_index, frame_landmarks if frame_detected else empty)
+
+    def flush(self):
+        """
+        Writes every entry added since the last flush to its group's .npz file, then evicts the least recently used
+        groups until the directory is back under budget.
+        """
+        if self.directory is None:
+            return
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, collections.defaultdict(dict)
+        if not dirty:
+            return
+
+        for group, new_entries in dirty.items():
+            entries = {}
+            path = self._group_path(group)
+            try:
+                with np.load(path) as data:
+                    for frame_index, frame_landmarks, frame_detected in zip(data["frames"].tolist(),
+                                                                            data["landmarks"], data["detected"]):
+                        entries[frame_index] = frame_landmarks if frame_detected else None
+            except (OSError, KeyError, ValueError):
+                pass
+
+            for frame_index, frame_landmarks in new_entries.items():
+                entries[frame_index] = frame_landmarks if len(frame_landmarks) != 0 else None
+
+            frames = sorted(entries)
+            landmarks = np.full((len(frames), num_landmarks, 4), np.nan, dtype=np.float32)
+            detected = np.zeros(len(frames), dtype=bool)
+            for i, frame_index in enumerate(frames):
+                if entries[frame_index] is not None:
+                    landmarks[i] = entries[frame_index]
+                    detected[i] = True
+
+            # Write next to the real file and swap it in, so readers never see half a file
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, frames=np.array(frames, dtype=np.int64), landmarks=landmarks, detected=detected)
+            os.replace(tmp_path, path)
+
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self._loaded.discard(name[:-len(".npz")])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+            self._loaded.clear()
+            self._dirty.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_landmark_cache():
+    """
+    Returns the process-wide landmark cache. Its directory can be moved with the LANDMARK_CACHE_DIR environment
+    variable, and defaults to pose_analysis/landmarks/ in the user's cache directory ($XDG_CACHE_HOME or ~/.cache),
+    away from the source files.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+            directory = os.environ.get("LANDMARK_CACHE_DIR") or os.path.join(cache_home, "pose_analysis", "landmarks")
+            _cache = LandmarkCache(directory)
+            atexit.register(_cache.flush)
+        return _cache
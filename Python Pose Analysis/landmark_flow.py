@@ -0,0 +1,114 @@
+import cv2
+import numpy as np
+
+
+class LandmarkFlow:
+    def __init__(self, keyframe_interval=3, max_error=1.5, max_motion=0.05, min_tracked=0.6, required=None,
+                 max_side=480, win_size=21, max_level=3, sensitivity=0.5):
+        """
+        Carries landmarks from one frame to the next with sparse Lucas-Kanade optical flow, so the pose model only has
+        to run on one frame out of keyframe_interval. Each landmark is tracked forward and then back again, and the
+        model runs on the frame anyway when too many landmarks come back somewhere else, or when the lifter moves so
+        fast between two frames that the flow can't be trusted.
+        :param keyframe_interval: run the model on one frame out of this many. Default to 3.
+        :param max_error: forward-backward error, in pixels of the downscaled frame, above which a landmark counts as
+               lost. Default to 1.5.
+        :param max_motion: median landmark movement between two frames, as a fraction of the frame's longer side,
+               above which the model runs instead. Default to 0.05.
+        :param min_tracked: fraction of the visible landmarks that have to be tracked, otherwise the model runs.
+               Default to 0.6.
+        :param required: landmark indices that have to be tracked, ex; the joints find_key_time measures the angle of.
+               Default to None.
+        :param max_side: frames are downscaled so their longer side is at most this many pixels before the flow.
+               Default to 480.
+        :param win_size: size in pixels of the patch tracked around each landmark, at each pyramid level. Default to 21.
+        :param max_level: pyramid levels above the frame itself, for movements larger than the patch. Default to 3.
+        :param sensitivity: visibility threshold for a landmark to be tracked, same as analyze_photo
+        """
+        self.keyframe_interval = keyframe_interval
+        self.max_error = max_error
+        self.max_motion = max_motion
+        self.min_tracked = min_tracked
+        self.required = None if required is None else np.asarray(required, dtype=np.intp)
+        self.max_side = max_side
+        self.sensitivity = sensitivity
+        self.lk_options = {"winSize": (win_size, win_size), "maxLevel": max_level,
+                           "criteria": (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03)}
+        self.propagated = 0
+        self.fallbacks = 0
+        self.reset()
+
+    def reset(self):
+        # Frame and landmarks the next frame is tracked from, None until the model found someone
+        self.previous = None
+        self.landmarks = None
+        self.since_detection = 0
+        self._pending = None
+
+    def prepare(self, image_mat):
+        """
+        :return: The frame in grayscale, downscaled to max_side
+        """
+        gray = cv2.cvtColor(image_mat, cv2.COLOR_BGR2GRAY) if image_mat.ndim == 3 else image_mat
+        scale = self.max_side / max(gray.shape[:2])
+        if scale < 1:
+            gray = cv2.resize(gray, (max(int(gray.shape[1] * scale), 1), max(int(gray.shape[0] * scale), 1)),
+                              interpolation=cv2.INTER_AREA)
+        return gray
+
+    def propagate(self, image_mat):
+        """
+        Tracks the last landmarks into this frame, unless it's time for the model to run.
+        :return: The (33, 4) landmarks of this frame, or None if the model has to run on it. In that case pass what
+        the model found to update().
+        """
+        gray = self._pending = self.prepare(image_mat)
+        if self.landmarks is None or self.since_detection + 1 >= self.keyframe_interval:
+            return None
+
+        tracked_landmarks = np.flatnonzero(self.landmarks[:, 3] > self.sensitivity)
+        height, width = gray.shape[:2]
+        size = np.array([width, height], dtype=np.float32)
+        start = (self.landmarks[tracked_landmarks, :2] * size).astype(np.float32).reshape(-1, 1, 2)
+        if len(start) == 0:
+            self.fallbacks += 1
+            return None
+
+        end, status, _ = cv2.calcOpticalFlowPyrLK(self.previous, gray, start, None, **self.lk_options)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.previous, end, None, **self.lk_options)
+        error = np.linalg.norm((start - back).reshape(-1, 2), axis=1)
+        tracked = status.ravel().astype(bool) & back_status.ravel().astype(bool) & (error <= self.max_error)
+
+        start, end = start.reshape(-1, 2), end.reshape(-1, 2)
+        motion = np.median(np.linalg.norm(end[tracked] - start[tracked], axis=1)) / max(width, height) \
+            if tracked.any() else np.inf
+        lost_required = self.required is not None and \
+            not np.isin(self.required, tracked_landmarks[tracked]).all()
+        if tracked.mean() < self.min_tracked or motion > self.max_motion or lost_required:
+            self.fallbacks += 1
+            return None
+
+        landmarks = self.landmarks.copy()
+        landmarks[tracked_landmarks[tracked], :2] = end[tracked] / size
+        # Lost ones aren't seen anymore, until the next frame the model runs on
+        landmarks[tracked_landmarks[~tracked], 3] = 0
+        self.previous, self.landmarks, self._pending = gray, landmarks, None
+        self.since_detection += 1
+        self.propagated += 1
+        return landmarks
+
+    def update(self, image_mat, landmarks):
+        """
+        Starts tracking again from what the model found in a frame.
+        :param landmarks: (33, 4) landmarks, or an empty array if nobody was detected
+        """
+        gray = self._pending if self._pending is not None else self.prepare(image_mat)
+        self._pending = None
+        if len(landmarks) == 0:
+            self.previous = self.landmarks = None
+            return
+        self.previous, self.landmarks = gray, np.asarray(landmarks, dtype=np.float32)
+        self.since_detection = 0
+
+    def stats(self):
+        return {"propagated": self.propagated, "fallbacks": self.fallbacks}
@@ -0,0 +1,149 @@
+import collections
+import enum
+
+import numpy as np
+
+Landmark = collections.namedtuple("Landmark", ["x", "y", "z", "visibility"])
+
+# Same order as mediapipe's PoseLandmark, kept here so criteria and scoring don't have to import mediapipe
+landmark_names = ("NOSE", "LEFT_EYE_INNER", "LEFT_EYE", "LEFT_EYE_OUTER", "RIGHT_EYE_INNER", "RIGHT_EYE",
+                  "RIGHT_EYE_OUTER", "LEFT_EAR", "RIGHT_EAR", "MOUTH_LEFT", "MOUTH_RIGHT", "LEFT_SHOULDER",
+                  "RIGHT_SHOULDER", "LEFT_ELBOW", "RIGHT_ELBOW", "LEFT_WRIST", "RIGHT_WRIST", "LEFT_PINKY",
+                  "RIGHT_PINKY", "LEFT_INDEX", "RIGHT_INDEX", "LEFT_THUMB", "RIGHT_THUMB", "LEFT_HIP", "RIGHT_HIP",
+                  "LEFT_KNEE", "RIGHT_KNEE", "LEFT_ANKLE", "RIGHT_ANKLE", "LEFT_HEEL", "RIGHT_HEEL", "LEFT_FOOT_INDEX",
+                  "RIGHT_FOOT_INDEX")
+PoseLandmark = enum.IntEnum("PoseLandmark", landmark_names, start=0)
+
+num_landmarks = len(landmark_names)
+
+# Pairs of landmarks joined by a bone when drawing the skeleton, same as mediapipe's POSE_CONNECTIONS
+pose_connections = ((0, 1), (1, 2), (2, 3), (3, 7), (0, 4), (4, 5), (5, 6), (6, 8), (9, 10), (11, 12), (11, 13),
+                    (13, 15), (15, 17), (15, 19), (15, 21), (17, 19), (12, 14), (14, 16), (16, 18), (16, 20), (16, 22),
+                    (18, 20), (11, 23), (12, 24), (23, 24), (23, 25), (24, 26), (25, 27), (26, 28), (27, 29), (28, 30),
+                    (29, 31), (30, 32), (27, 31), (28, 32))
+
+
+def pack_landmarks(pose_landmarks):
+    """
+    Converts one person's landmarks from a PoseLandmarkerResult into a (33, 4) float32 array of x, y, z, visibility.
+    """
+    return np.array([(lm.x, lm.y, lm.z, lm.visibility) for lm in pose_landmarks], dtype=np.float32)
+
+
+class FrameLandmarks:
+    __slots__ = ("data", "visible")
+
+    def __init__(self, data, visible):
+        """
+        Read-only view of one frame's landmarks that behaves like the connections dictionary returned by
+        analyze_photo: only landmarks above the visibility threshold are in it, keyed by landmark index.
+        :param data: (33, 4) array of x, y, z, visibility
+        :param visible: (33,) bool array, which landmarks count as seen
+        """
+        self.data = data
+        self.visible = visible
+
+    def get(self, idx, default=None):
+        if not self.visible[idx]:
+            return default
+        return Landmark(*self.data[idx].tolist())
+
+    def __getitem__(self, idx):
+        if not self.visible[idx]:
+            raise KeyError(idx)
+        return Landmark(*self.data[idx].tolist())
+
+    def __contains__(self, idx):
+        return 0 <= idx < len(self.visible) and bool(self.visible[idx])
+
+    def keys(self):
+        return np.flatnonzero(self.visible).tolist()
+
+    def values(self):
+        return [Landmark(*row) for row in self.data[self.visible].tolist()]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.visible))
+
+
+class LandmarkSeries:
+    def __init__(self, landmarks, frame_indices, timestamps_ms, sensitivity=0.5):
+        """
+        The landmarks of a whole clip in one float32 array, about 0.5 KB per analyzed frame. Frames where nobody was
+        detected are all NaN. Pickles cheaply, so it can be passed between processes as is.
+        :param landmarks: (frames, 33, 4) array of x, y, z, visibility
+        :param frame_indices: (frames,) position of each frame in the video
+        :param timestamps_ms: (frames,) presentation time of each frame
+        :param sensitivity: visibility threshold for a landmark to count as seen, same as analyze_photo
+        """
+        self.landmarks = np.asarray(landmarks, dtype=np.float32).reshape(-1, num_landmarks, 4)
+        self.frame_indices = np.asarray(frame_indices, dtype=np.int64)
+        self.timestamps_ms = np.asarray(timestamps_ms, dtype=np.float64)
+        self.sensitivity = sensitivity
+        # NaN compares False, so frames without a pose have no visible landmarks
+        self.visible = self.landmarks[..., 3] > sensitivity
+        self.detected = ~np.isnan(self.landmarks[:, 0, 0])
+
+    @classmethod
+    def from_frames(cls, frames, sensitivity=0.5):
+        """
+        :param frames: an iterable of (frame_index, timestamp_ms, landmarks) tuples, where landmarks is a (33, 4) array
+               or an empty array if no pose was detected
+        """
+        frame_indices, timestamps_ms, landmarks = [], [], []
+        missing = np.full((num_landmarks, 4), np.nan, dtype=np.float32)
+        for frame_index, timestamp_ms, frame_landmarks in frames:
+            frame_indices.append(frame_index)
+            timestamps_ms.append(timestamp_ms)
+            landmarks.append(frame_landmarks if len(frame_landmarks) != 0 else missing)
+
+        stacked = np.stack(landmarks) if landmarks else np.empty((0, num_landmarks, 4), dtype=np.float32)
+        return cls(stacked, frame_indices, timestamps_ms, sensitivity)
+
+    @classmethod
+    def concatenate(cls, series, sensitivity=0.5):
+        series = list(series)
+        if not series:
+            return cls(np.empty((0, num_landmarks, 4)), [], [], sensitivity)
+        return cls(np.concatenate([s.landmarks for s in series]),
+                   np.concatenate([s.frame_indices for s in series]),
+                   np.concatenate([s.timestamps_ms for s in series]), sensitivity)
+
+    def __len__(self):
+        return len(self.landmarks)
+
+    def frame(self, i):
+        """
+        :return: A FrameLandmarks view of the i-th frame, or None if nobody was detected in it
+        """
+        if not self.detected[i]:
+            return None
+        return FrameLandmarks(self.landmarks[i], self.visible[i])
+
+    def position(self, frame_index):
+        """
+        :return: The position in the series of the frame at frame_index in the video, or None if it wasn't analyzed
+        """
+        i = np.searchsorted(self.frame_indices, frame_index)
+        if i < len(self.frame_indices) and self.frame_indices[i] == frame_index:
+            return int(i)
+        return None
+
+    @property
+    def nbytes(self):
+        return self.landmarks.nbytes + self.frame_indices.nbytes + self.timestamps_ms.nbytes + self.visible.nbytes
+
+    def save(self, path):
+        np.savez(path, landmarks=self.landmarks, frame_indices=self.frame_indices, timestamps_ms=self.timestamps_ms,
+                 sensitivity=self.sensitivity)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["landmarks"], data["frame_indices"], data["timestamps_ms"], float(data["sensitivity"]))
@@ -0,0 +1,156 @@
+import contextlib
+import os
+import threading
+
+
+class LandmarkerPool:
+    def __init__(self, model_asset_path, max_size=None, **options):
+        """
+        Keeps loaded PoseLandmarker instances around so the model asset is read once per worker instead of once per
+        frame. Instances are handed out one caller at a time, so the pool can be shared between threads.
+        :param model_asset_path: path to the .task model file
+        :param max_size: maximum number of landmarkers alive at once. Callers wait for a free one once this is reached.
+               Default to None (no limit).
+        :param options: any extra keyword arguments for vision.PoseLandmarkerOptions, ex; output_segmentation_masks
+        """
+        self.model_asset_path = model_asset_path
+        self.max_size = max_size
+        self.options = options
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _create(self):
+        # mediapipe is only imported once a landmarker is actually needed, so code that never runs the model (ex;
+        # rescoring stored landmarks) doesn't need it installed
+        from mediapipe.tasks import python
+        from mediapipe.tasks.python import vision
+
+        base_options = python.BaseOptions(model_asset_path=self.model_asset_path)
+        options = vision.PoseLandmarkerOptions(base_options=base_options, **self.options)
+        return vision.PoseLandmarker.create_from_options(options)
+
+    def warm_up(self, count=1):
+        """
+        Loads landmarkers ahead of time so the first frames of an analysis don't pay for model loading.
+        :param count: how many landmarkers should be ready after warming up
+        """
+        if self.max_size is not None:
+            count = min(count, self.max_size)
+
+        landmarkers = []
+        try:
+            # checkout() hands out idle landmarkers first, so keep everything taken until the pool has grown enough
+            while True:
+                with self._cond:
+                    if self._size >= count:
+                        break
+                landmarkers.append(self.checkout())
+        finally:
+            for landmarker in landmarkers:
+                self.checkin(landmarker)
+
+    def checkout(self, timeout=None):
+        """
+        Takes a landmarker out of the pool, loading a new one if none are free. Every checkout must be followed by
+        a checkin, prefer the landmarker() context manager.
+        :param timeout: seconds to wait for a free landmarker when the pool is full. Default to None (wait forever).
+        :return: a vision.PoseLandmarker only used by the caller until it is checked back in
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Landmarker pool is closed")
+                if self._idle:
+                    return self._idle.pop()
+                if self.max_size is None or self._size < self.max_size:
+                    # Reserve the slot now, the model is loaded outside the lock so other threads aren't blocked
+                    self._size += 1
+                    break
+                if not self._cond.wait(timeout):
+                    raise TimeoutError("No landmarker became available")
+
+        try:
+            return self._create()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def checkin(self, landmarker):
+        with self._cond:
+            if not self._closed:
+                self._idle.append(landmarker)
+                self._cond.notify()
+                return
+            self._size -= 1
+        landmarker.close()
+
+    def discard(self, landmarker):
+        """
+        Closes a checked out landmarker instead of putting it back, and frees its slot. For landmarkers that keep
+        state between calls, ex; a VIDEO mode one still tracking the person of the clip it just ran on.
+        """
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        landmarker.close()
+
+    @contextlib.contextmanager
+    def landmarker(self, timeout=None, discard=False):
+        """
+        :param discard: close the landmarker afterwards instead of checking it back in, see discard(). Default to
+               False.
+        """
+        landmarker = self.checkout(timeout)
+        try:
+            yield landmarker
+        finally:
+            if discard:
+                self.discard(landmarker)
+            else:
+                self.checkin(landmarker)
+
+    def close(self):
+        """
+        Closes all idle landmarkers. Landmarkers still checked out are closed when they are checked back in.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for landmarker in idle:
+            landmarker.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(model_asset_path, **options):
+    """
+    Returns the process-wide pool for this model and set of options, creating it on first use.
+    :param model_asset_path: path to the .task model file
+    :param options: keyword arguments for vision.PoseLandmarkerOptions. Pools with different options never share
+           landmarkers.
+    """
+    key = (os.path.abspath(model_asset_path), tuple(sorted(options.items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = LandmarkerPool(key[0], **options)
+            _pools[key] = pool
+        return pool
+
+
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,269 @@
+import collections
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from .criteria import load_criteria
+from .data_analysis import DataAnalyzer
+from .landmark_store import pack_landmarks
+from .rep_segmentation import RepDetectorHub
+
+# landmarks is a (33, 4) array or None if nobody was detected, angle is the first action joint's angle (radians) or
+# None, rep is the RepEvent this frame confirmed, if any
+LiveResult = collections.namedtuple("LiveResult", ["stream_id", "frame_id", "timestamp_ms", "landmarks", "angle",
+                                                   "latency_ms", "rep"])
+
+# Landmarker timestamps are milliseconds since the module was loaded
+_start = time.monotonic()
+
+
+class LiveStreamAnalyzer(DataAnalyzer):
+    def __init__(self, stream_id, movement_type="squat", on_result=None, rep_hub=None, max_queue=2, max_in_flight=1,
+                 max_age_ms=500, sensitivity=0.5, model_asset_path=None):
+        """
+        Analyzes frames pushed one at a time from a socket or a generator with a LIVE_STREAM mode landmarker. Frames
+        wait in a small queue and only the newest one is sent to the model, so under load old frames are dropped
+        instead of adding latency.
+        :param stream_id: identifies the stream in results and rep events, ex; the player's socket id
+        :param movement_type: movement in movement_criteria.json whose action joint angle is tracked
+        :param on_result: called with a LiveResult for every analyzed frame, from the landmarker's thread. Default to
+               None.
+        :param rep_hub: the RepDetectorHub rep events go to, can be shared between streams. Default to None (one hub
+               for this stream).
+        :param max_queue: frames waiting for the model at most, older ones are dropped first. Default to 2.
+        :param max_in_flight: frames given to the model whose result hasn't come back yet. Default to 1.
+        :param max_age_ms: frames that waited longer than this are dropped. Default to 500.
+        :param sensitivity: same as VideoAnalyzer.analyze_photo
+        :param model_asset_path: path to the .task model file. Default to None (pose_landmarker_heavy.task).
+        """
+        super().__init__()
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        self.stream_id = stream_id
+        self.on_result = on_result
+        self.rep_hub = rep_hub if rep_hub is not None else RepDetectorHub()
+        self.max_in_flight = max_in_flight
+        self.max_age_ms = max_age_ms
+        self.sensitivity = sensitivity
+        criteria = load_criteria(os.path.join(base_dir, 'movement_criteria.json'))
+        self.action_triples = criteria[movement_type].action_triples
+
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        # Frames the landmarker refused, with the last reason why
+        self.errors = 0
+        self.last_error = None
+        self.latencies_ms = collections.deque(maxlen=1000)
+
+        self._queue = collections.deque(maxlen=max_queue)
+        self._in_flight = {}
+        self._last_timestamp = -1
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # Only imported once a stream starts, so importing this module stays cheap
+        from mediapipe.tasks import python
+        from mediapipe.tasks.python import vision
+
+        # The result callback is bound to this stream, so LIVE_STREAM landmarkers can't come from a shared pool
+        model_asset_path = model_asset_path or os.path.join(base_dir, 'pose_landmarker_heavy.task')
+        options = vision.PoseLandmarkerOptions(base_options=python.BaseOptions(model_asset_path=model_asset_path),
+                                               running_mode=vision.RunningMode.LIVE_STREAM,
+                                               output_segmentation_masks=False, result_callback=self._on_result)
+        self.landmarker = vision.PoseLandmarker.create_from_options(options)
+
+        self._thread = threading.Thread(target=self._dispatch, name=f"live-stream-{stream_id}", daemon=True)
+        self._thread.start()
+
+    def push(self, frame, frame_id=None):
+        """
+        Queues a frame for analysis. Never blocks, if the queue is full the oldest waiting frame is dropped.
+        :param frame: decoded frame, same format as VideoAnalyzer.analyze_image takes
+        :param frame_id: anything identifying the frame, passed back in its LiveResult. Default to None (the number of
+               frames pushed so far).
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Live stream is closed")
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append((self.received if frame_id is None else frame_id, time.monotonic(), frame))
+            self.received += 1
+            self._cond.notify()
+
+    def run(self, frames):
+        """
+        Pushes every frame of an iterable, ex; fake_frame_source, then waits for the last results.
+        :param frames: iterable of frames or (frame_id, frame) tuples
+        """
+        for frame in frames:
+            if isinstance(frame, tuple):
+                self.push(frame[1], frame[0])
+            else:
+                self.push(frame)
+        self.drain()
+
+    def _dispatch(self):
+        import mediapipe as mp
+
+        while True:
+            with self._cond:
+                while not self._closed and (not self._queue or len(self._in_flight) >= self.max_in_flight):
+                    self._expire_in_flight()
+                    self._cond.wait(self.max_age_ms / 1000)
+                if self._closed:
+                    return
+
+                # Only the newest frame is worth analyzing, everything older is already stale
+                frame_id, pushed, frame = self._queue.pop()
+                self.dropped += len(self._queue)
+                self._queue.clear()
+                if (time.monotonic() - pushed) * 1000 > self.max_age_ms:
+                    self.dropped += 1
+                    continue
+
+                # Timestamps have to keep increasing for the landmarker's whole life
+                timestamp = max(int((pushed - _start) * 1000), self._last_timestamp + 1)
+                self._last_timestamp = timestamp
+                self._in_flight[timestamp] = (frame_id, pushed)
+
+            try:
+                self.landmarker.detect_async(mp.Image(image_format=mp.ImageFormat.SRGB, data=frame), timestamp)
+            except (RuntimeError, ValueError) as e:
+                with self._cond:
+                    self._in_flight.pop(timestamp, None)
+                    self.dropped += 1
+                    self.errors += 1
+                    self.last_error = f"frame {frame_id}: {e!r}"
+
+    def _expire_in_flight(self):
+        # The landmarker may skip frames while it's busy without calling back, don't wait on them forever
+        now = time.monotonic()
+        for timestamp, (_, pushed) in list(self._in_flight.items()):
+            if (now - pushed) * 1000 > self.max_age_ms * 2:
+                del self._in_flight[timestamp]
+                self.dropped += 1
+
+    def _on_result(self, detection_result, output_image, timestamp_ms):
+        with self._cond:
+            frame_id, pushed = self._in_flight.pop(timestamp_ms, (None, None))
+            self._cond.notify()
+        if pushed is None:
+            return
+        latency_ms = (time.monotonic() - pushed) * 1000
+
+        landmarks, angle, rep = None, None, None
+        if len(detection_result.pose_landmarks) != 0:
+            landmarks = pack_landmarks(detection_result.pose_landmarks[0])
+            if self.action_triples.shape[0] > 0:
+                angles = self.get_angles(landmarks[np.newaxis], self.action_triples[:1],
+                                         landmarks[np.newaxis, :, 3] > self.sensitivity)
+                angle = float(angles[0, 0]) if not np.isnan(angles[0, 0]) else None
+            rep = self.rep_hub.push(self.stream_id, timestamp_ms, angle, frame_id)
+
+        with self._cond:
+            self.processed += 1
+            self.latencies_ms.append(latency_ms)
+
+        if self.on_result is not None:
+            self.on_result(LiveResult(self.stream_id, frame_id, timestamp_ms, landmarks, angle, latency_ms, rep))
+
+    def drain(self, timeout=5):
+        """
+        Waits until every queued frame was analyzed or dropped.
+        :return: True if everything finished within timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queue or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 0.05))
+                self._expire_in_flight()
+        return True
+
+    def stats(self):
+        """
+        :return: A dictionary of frame counts and latencies (milliseconds from push to result) for this stream.
+        "errors" counts the frames the landmarker refused, also counted as dropped, and "last_error" says why.
+        """
+        with self._cond:
+            latencies = np.array(self.latencies_ms)
+            stats = {
+                "received": self.received,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "queued": len(self._queue),
+                "in_flight": len(self._in_flight),
+                "drop_ratio": self.dropped / self.received if self.received != 0 else 0,
+                "reps": self.rep_hub.rep_count(self.stream_id),
+            }
+        for p in (50, 95, 99):
+            stats[f"latency_p{p}_ms"] = float(np.percentile(latencies, p)) if len(latencies) != 0 else None
+        stats["latency_max_ms"] = float(latencies.max()) if len(latencies) != 0 else None
+        return stats
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+        self._thread.join()
+        self.landmarker.close()
+        self.rep_hub.remove(self.stream_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def fake_frame_source(num_frames, fps=30, width=640, height=480, realtime=True):
+    """
+    Generates synthetic frames at a given rate, for trying out live streams without a camera or socket. A bright band
+    slides up and down the frame, one full cycle every 2 seconds.
+    :param realtime: sleep between frames so they arrive at fps. Default to True.
+    :return: A generator of (frame_id, frame) tuples
+    """
+    next_time = time.monotonic()
+    for i in range(num_frames):
+        phase = (np.sin(2 * np.pi * i / (2 * fps)) + 1) / 2
+        frame = np.full((height, width, 3), 40, dtype=np.uint8)
+        top = int(phase * (height - height // 8))
+        frame[top:top + height // 8] = 220
+
+        if realtime:
+            next_time += 1 / fps
+            time.sleep(max(next_time - time.monotonic(), 0))
+        yield i, frame
+
+
+def video_frame_source(video_path, realtime=True):
+    """
+    Replays a video file as if it were a live stream.
+    :param realtime: sleep between frames so they arrive at the video's frame rate. Default to True.
+    :return: A generator of (frame_index, frame) tuples
+    """
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    next_time = time.monotonic()
+    i = 0
+    try:
+        while True:
+            success, frame = cap.read()
+            if not success:
+                break
+            if realtime:
+                next_time += 1 / fps
+                time.sleep(max(next_time - time.monotonic(), 0))
+            yield i, frame
+            i += 1
+    finally:
+        cap.release()
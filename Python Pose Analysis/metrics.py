@@ -0,0 +1,145 @@
+import contextlib
+import os
+import threading
+import time
+
+# Debug output of the analysis (landmarks, profiles, candidate frames). Only checked with a plain `if`, so nothing is
+# formatted or written while it's off. Set POSE_ANALYSIS_DEBUG=1, or metrics.debug = True at runtime
+debug = os.environ.get("POSE_ANALYSIS_DEBUG", "") not in ("", "0")
+
+timer_stages = ("decode", "detection", "angles", "rep_segmentation", "scoring", "drawing")
+counter_help = {
+    "frames_decoded": "Frames decoded from video or read from disk.",
+    "frames_skipped": "Frames the sampler grabbed or seeked past without decoding.",
+    "detections": "Pose model calls.",
+    "no_pose_frames": "Analyzed frames where nobody was detected.",
+    "cache_hits": "Landmark cache lookups that found the frame.",
+    "cache_misses": "Landmark cache lookups that didn't.",
+    "frames_propagated": "Frames whose landmarks were carried over with optical flow instead of running the model.",
+    "flow_fallbacks": "Frames the optical flow lost the lifter in, which ran the model instead.",
+}
+counter_names = tuple(counter_help)
+
+
+class AnalysisStats:
+    def __init__(self):
+        """
+        Time spent per stage and frame counts for one analysis. Cheap enough to stay on all the time: a timer is two
+        perf_counter calls and a counter is a dictionary update.
+        """
+        self.seconds = dict.fromkeys(timer_stages, 0.0)
+        self.calls = dict.fromkeys(timer_stages, 0)
+        self.counters = dict.fromkeys(counter_names, 0)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds, calls=1):
+        self.seconds[stage] += seconds
+        self.calls[stage] += calls
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def merge(self, other):
+        """
+        Adds another analysis' stats to these, ex; from a worker process.
+        :param other: an AnalysisStats or its to_dict()
+        """
+        if isinstance(other, AnalysisStats):
+            other = other.to_dict()
+        for stage, seconds in other["seconds"].items():
+            self.add_time(stage, seconds, other["calls"][stage])
+        for name, n in other["counters"].items():
+            self.count(name, n)
+        return self
+
+    def to_dict(self):
+        return {"seconds": dict(self.seconds), "calls": dict(self.calls), "counters": dict(self.counters)}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls().merge(data)
+
+    def __repr__(self):
+        stages = ", ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in self.seconds.items() if seconds)
+        counters = ", ".join(f"{name}={n}" for name, n in self.counters.items() if n)
+        return f"AnalysisStats({stages}; {counters})"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def to_prometheus(stats, labels=None, prefix="pose_analysis", analyses=None):
+    """
+    Formats stats in the Prometheus text exposition format, ex; for a /metrics endpoint.
+    :param stats: an AnalysisStats
+    :param labels: {name: value} added to every sample, ex; {"worker": "1"}. Default to None.
+    :param analyses: number of analyses the stats add up, exported as <prefix>_analyses_total. Default to None (left
+           out).
+    :return: The metrics as a string
+    """
+    labels = labels or {}
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(f"# HELP {prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {prefix}_{name} counter")
+        for sample_labels, value in samples:
+            lines.append(f"{prefix}_{name}{format_labels({**labels, **sample_labels})} {value}")
+
+    if analyses is not None:
+        metric("analyses_total", "Analyses recorded.", [({}, analyses)])
+    metric("stage_seconds_total", "Time spent in each analysis stage.",
+           [({"stage": stage}, repr(float(seconds))) for stage, seconds in stats.seconds.items()])
+    metric("stage_calls_total", "Times each analysis stage ran.",
+           [({"stage": stage}, calls) for stage, calls in stats.calls.items()])
+    for name, n in stats.counters.items():
+        metric(f"{name}_total", counter_help[name], [({}, n)])
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        Totals of every analysis recorded in this process, for exporting.
+        """
+        self.stats = AnalysisStats()
+        self.analyses = 0
+        self._lock = threading.Lock()
+
+    def record(self, stats):
+        """
+        :param stats: an AnalysisStats or its to_dict()
+        """
+        with self._lock:
+            self.stats.merge(stats)
+            self.analyses += 1
+
+    def prometheus_text(self, labels=None, prefix="pose_analysis"):
+        with self._lock:
+            return to_prometheus(self.stats, labels, prefix, self.analyses)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    Returns the process-wide MetricsRegistry.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = MetricsRegistry()
+        return _registry
@@ -0,0 +1,206 @@
+import concurrent.futures
+import math
+import multiprocessing
+import os
+import threading
+
+import cv2
+
+from .frame_sampler import FrameSampler
+from .landmark_store import LandmarkSeries
+from .metrics import AnalysisStats
+from .roi import RoiTracker
+
+# Fewer samples than this per shard and starting a worker costs more than it saves
+min_frames_per_shard = 16
+
+# How often the parent checks its cancel_event while waiting for the shards, in seconds
+cancel_poll_interval = 0.1
+
+_executor = None
+_executor_key = None
+_executor_lock = threading.Lock()
+_manager = None
+
+
+def get_executor(workers, scan_model=None):
+    """
+    Returns the process pool used for parallel extraction. The pool is kept alive between videos so every worker
+    keeps its landmarker loaded.
+    :param scan_model: path of the model the workers load when they start, see _init_worker. Default to None (the
+           default scan tier).
+    """
+    global _executor, _executor_key
+    with _executor_lock:
+        if _executor is None or _executor_key != (workers, scan_model):
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # Spawn instead of fork, mediapipe's threads don't survive a fork
+            _executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                               mp_context=multiprocessing.get_context("spawn"),
+                                                               initializer=_init_worker, initargs=(scan_model,))
+            _executor_key = (workers, scan_model)
+        return _executor
+
+
+def get_cancel_event():
+    """
+    :return: An event the worker processes can check, for cancelling shards that are already running. They all come
+    from one manager process, started the first time one is needed.
+    """
+    global _manager
+    with _executor_lock:
+        if _manager is None:
+            _manager = multiprocessing.get_context("spawn").Manager()
+        return _manager.Event()
+
+
+def shutdown_executor():
+    global _executor, _executor_key, _manager
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+        if _manager is not None:
+            _manager.shutdown()
+        _executor = None
+        _executor_key = None
+        _manager = None
+
+
+def _init_worker(scan_model=None):
+    from .landmarker_pool import get_pool
+    from .video_analyzer import default_models, model_path, resolve_tier
+
+    # Load the scan model once when the worker starts instead of on its first shard
+    get_pool(scan_model or model_path(resolve_tier(default_models["scan"])), output_segmentation_masks=False).warm_up()
+
+
+def extract_shard(video_path, frames_cut_ps, width, height, start_ms, end_ms, sensitivity, roi=False,
+                  escalate_joints=None, models=None, landmark_cache=None, cancel_event=None):
+    """
+    Runs every sampled frame between start_ms and end_ms through detect_landmarks. Used both by the worker processes
+    and by the serial fallback, so both paths produce the same result.
+    :param roi: crop frames to the lifter, see RoiTracker. Each shard starts tracking from scratch.
+    :param escalate_joints: see VideoAnalyzer.detect_landmarks
+    :param models: the parent analyzer's models, landmark_cache and cancel_event, see VideoAnalyzer. In a worker
+           process cancel_event has to be one from get_cancel_event.
+    :return: A tuple of (LandmarkSeries, sampler stats with the model calls per tier under "tier_calls" and the shard's
+    AnalysisStats.to_dict() under "analysis_stats")
+    """
+    from .video_analyzer import VideoAnalyzer
+
+    analyzer = VideoAnalyzer(video_path, frames_cut_ps, width, height, landmark_cache=landmark_cache,
+                             cancel_event=cancel_event, models=models)
+    sampler = FrameSampler(analyzer.video_path, frames_cut_ps, start_ms=start_ms, end_ms=end_ms)
+    roi_tracker = RoiTracker(sensitivity=sensitivity) if roi else None
+    series = LandmarkSeries.from_frames(
+        ((frame_index, timestamp_ms, analyzer.detect_landmarks(frame, frame_index, sensitivity, roi_tracker,
+                                                               analyzer.models["scan"], escalate_joints))
+         for frame_index, timestamp_ms, frame in analyzer.iter_frames(sampler)), sensitivity)
+
+    if analyzer.landmark_cache:
+        analyzer.landmark_cache.flush()
+    stats = sampler.stats()
+    stats["tier_calls"] = analyzer.tier_calls
+    stats["analysis_stats"] = analyzer.stats.to_dict()
+    return series, stats
+
+
+def plan_shards(video_path, frames_cut_ps, workers):
+    """
+    Splits the sampled frames of a video into contiguous time ranges, one per shard. Shard boundaries fall on the
+    sampler's timestamp grid, so every shard picks exactly the frames the serial sampler would.
+    :return: A list of (start_ms, end_ms) tuples, end_ms being None for the last shard
+    """
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if fps == 0 or num_frames == 0:
+        return []
+
+    interval_ms = 1000 / frames_cut_ps
+    tolerance_ms = 500 / fps
+    num_samples = math.ceil(num_frames / fps * 1000 / interval_ms)
+    num_shards = max(min(workers, num_samples // min_frames_per_shard), 1)
+
+    bounds = [round(i * num_samples / num_shards) * interval_ms for i in range(num_shards + 1)]
+    shards = []
+    for i in range(num_shards):
+        # The sampler takes any frame within tolerance of a sample time, so stop just before the next shard's
+        # first sample could be picked
+        end_ms = bounds[i + 1] - tolerance_ms - 1e-3 if i < num_shards - 1 else None
+        shards.append((bounds[i], end_ms))
+
+    return shards
+
+
+def extract_landmarks_parallel(analyzer, sensitivity=0.5, workers=None, roi=False, escalate_joints=None):
+    """
+    Splits the sampled frames of the analyzer's video into contiguous shards and analyzes each shard in its own
+    worker process. Every frame is detected independently (IMAGE mode), so the merged result is identical to running
+    extract_shard over the whole video in one process, which is also what happens when only one worker is available
+    or the process pool can't be used.
+    The shards run with the analyzer's models and stop once its cancel_event is set, raising AnalysisCancelled. The
+    workers use their own process-wide landmark cache, unless the analyzer's is turned off.
+    :param analyzer: the VideoAnalyzer whose video is analyzed
+    :param workers: number of worker processes. Default to None (one per CPU).
+    :param roi: crop frames to the lifter, see extract_shard. Default to False.
+    :param escalate_joints: see VideoAnalyzer.detect_landmarks. Default to None.
+    :return: A tuple of (LandmarkSeries in video order, sampler stats with "tier_calls" and "analysis_stats" summed
+    over the shards)
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    args = (analyzer.video_path, analyzer.frames_cut_ps, analyzer.width, analyzer.height)
+    shards = plan_shards(analyzer.video_path, analyzer.frames_cut_ps, workers) if workers > 1 else []
+
+    from .video_analyzer import AnalysisCancelled, model_path
+
+    results = None
+    if len(shards) > 1:
+        try:
+            executor = get_executor(workers, model_path(analyzer.models["scan"]))
+            # The analyzer's cache and event can't be sent to another process, only whether the cache is on
+            cancel_event = get_cancel_event() if analyzer.cancel_event is not None else None
+            options = {"models": analyzer.models, "landmark_cache": None if analyzer.landmark_cache else False,
+                       "cancel_event": cancel_event}
+            futures = [executor.submit(extract_shard, *args, start_ms, end_ms, sensitivity, roi, escalate_joints,
+                                       **options)
+                       for start_ms, end_ms in shards]
+            while True:
+                _, pending = concurrent.futures.wait(futures, timeout=cancel_poll_interval)
+                if not pending:
+                    break
+                if analyzer.cancel_event is not None and analyzer.cancel_event.is_set():
+                    cancel_event.set()
+                    for future in pending:
+                        future.cancel()
+                    raise AnalysisCancelled(analyzer.video_path)
+            results = [f.result() for f in futures]
+        except (OSError, EOFError, concurrent.futures.process.BrokenProcessPool) as e:
+            print(f"Parallel extraction failed, falling back to serial: {e}")
+            shutdown_executor()
+            results = None
+
+    if results is None:
+        results = [extract_shard(*args, 0, None, sensitivity, roi, escalate_joints, analyzer.models,
+                                 analyzer.landmark_cache, analyzer.cancel_event)]
+
+    series = LandmarkSeries.concatenate([shard_series for shard_series, _ in results], sensitivity)
+    stats = {"decoded": 0, "skipped": 0, "seeks": 0}
+    tier_calls = {}
+    analysis_stats = AnalysisStats()
+    for _, shard_stats in results:
+        for k in stats:
+            stats[k] += shard_stats[k]
+        for tier, calls in shard_stats["tier_calls"].items():
+            tier_calls[tier] = tier_calls.get(tier, 0) + calls
+        analysis_stats.merge(shard_stats["analysis_stats"])
+    total = stats["decoded"] + stats["skipped"]
+    stats["skipped_ratio"] = stats["skipped"] / total if total != 0 else 0
+    stats["tier_calls"] = tier_calls
+    stats["analysis_stats"] = analysis_stats.to_dict()
+
+    return series, stats
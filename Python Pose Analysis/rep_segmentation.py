@@ -0,0 +1,262 @@
+import collections
+
+import numpy as np
+
+# bottom is where the key frame is, start and end are the tops before and after it. All are positions in the series.
+Rep = collections.namedtuple("Rep", ["bottom", "start", "end", "depth", "confidence"])
+
+# Smallest dip (radians) that counts as a rep whatever the rest of the series looks like, so the noise of someone
+# standing still isn't split into reps
+min_rep_depth = 0.5
+
+
+def fill_gaps(values):
+    """
+    :param values: 1D array with NaN where nothing was measured
+    :return: A copy with the NaNs linearly interpolated from their neighbours (held flat at the ends), or None if
+    nothing was measured at all
+    """
+    values = np.asarray(values, dtype=np.float64)
+    observed = ~np.isnan(values)
+    if not observed.any():
+        return None
+    positions = np.arange(len(values))
+    return np.interp(positions, positions[observed], values[observed])
+
+
+def smooth(values, window):
+    """
+    Centered moving average. The ends are padded with the edge values, so the output has the same length.
+    """
+    if window <= 1 or len(values) == 0:
+        return np.asarray(values, dtype=np.float64)
+    padded = np.pad(values, (window // 2, window - 1 - window // 2), mode="edge")
+    return np.convolve(padded, np.ones(window) / window, mode="valid")
+
+
+def find_reps(values, min_prominence=None, min_spacing=2, window=3, min_depth=min_rep_depth):
+    """
+    Splits a joint angle series into reps, one rep being a dip in the angle (ex; the knee closing at the bottom of a
+    squat) between two tops. A single pass with hysteresis over the smoothed series: a dip only counts once the angle
+    fell at least min_prominence from the last top and climbed back min_prominence from the bottom, so noise and
+    pauses don't split reps. Runs in linear time.
+    :param values: 1D array of angles in sample order, NaN where the joint wasn't seen
+    :param min_prominence: how deep a dip has to be to count as a rep. Default to None (a third of the series' 5th to
+           95th percentile range, at least min_depth).
+    :param min_spacing: bottoms closer than this many samples are the same rep, the lower one is kept. Default to 2.
+    :param window: moving average width in samples. Default to 3.
+    :param min_depth: absolute floor (radians) of the default min_prominence. Reps get full confidence from twice
+           this deep. Default to min_rep_depth.
+    :return: A list of Rep tuples in order. The bottom always lands on a measured sample.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    filled = fill_gaps(values)
+    if filled is None or len(filled) < 3:
+        return []
+
+    smoothed = smooth(filled, window)
+    low, high = np.percentile(smoothed, [5, 95])
+    series_range = high - low
+    if series_range <= 0:
+        return []
+    if min_prominence is None:
+        min_prominence = max(series_range / 3, min_depth)
+
+    # (bottom, start, end, depth down, depth up) of every dip
+    dips = []
+    top, top_i = smoothed[0], 0
+    bottom, bottom_i = None, None
+    for i, v in enumerate(smoothed.tolist()):
+        if bottom is None:
+            if v > top:
+                top, top_i = v, i
+            elif top - v >= min_prominence:
+                bottom, bottom_i = v, i
+        else:
+            if v < bottom:
+                bottom, bottom_i = v, i
+            elif v - bottom >= min_prominence:
+                dips.append([bottom_i, top_i, None, top - bottom, None])
+                top, top_i = v, i
+                bottom, bottom_i = None, None
+        # Track the top after each bottom, it ends the previous rep
+        if bottom is None and dips and v >= top:
+            dips[-1][2] = i
+            dips[-1][4] = v - smoothed[dips[-1][0]]
+
+    # A clip that stops at the bottom still ends in a rep, it just never came back up
+    if bottom is not None:
+        dips.append([bottom_i, top_i, len(smoothed) - 1, top - bottom, smoothed[-1] - bottom])
+
+    merged = []
+    for dip in dips:
+        if merged and dip[0] - merged[-1][0] < min_spacing:
+            previous = merged[-1]
+            lower = dip if smoothed[dip[0]] < smoothed[previous[0]] else previous
+            merged[-1] = [lower[0], previous[1], dip[2], max(previous[3], dip[3]), dip[4]]
+        else:
+            merged.append(dip)
+
+    observed = ~np.isnan(values)
+    half = max(window // 2, 1)
+    reps = []
+    for bottom_i, start, end, depth_down, depth_up in merged:
+        # The smoothed bottom can sit between measurements, move it to the lowest measured sample around it
+        lo, hi = max(bottom_i - half, 0), min(bottom_i + half + 1, len(values))
+        nearby = np.where(observed[lo:hi], values[lo:hi], np.inf)
+        if np.isinf(nearby).all():
+            nearest = np.flatnonzero(observed)
+            bottom_i = int(nearest[np.argmin(np.abs(nearest - bottom_i))])
+        else:
+            bottom_i = lo + int(np.argmin(nearby))
+
+        # Shallow reps, next to the others or in absolute terms, and reps mostly made of gaps are less trustworthy
+        depth = min(depth_down, depth_up)
+        coverage = observed[start:end + 1].mean()
+        absolute = np.clip(depth / (2 * min_depth), 0, 1) if min_depth > 0 else 1
+        confidence = float(np.clip(depth / series_range, 0, 1) * absolute * coverage)
+        reps.append(Rep(bottom_i, start, end, float(depth), confidence))
+
+    return reps
+
+
+# rep is the rep count so far including this one, latency_ms is how long after the bottom the event was sent
+RepEvent = collections.namedtuple("RepEvent", ["stream_id", "rep", "frame", "timestamp_ms", "angle", "depth",
+                                               "latency_ms"])
+
+
+class RepDetector:
+    __slots__ = ("stream_id", "min_prominence", "confirm_rise", "min_spacing_ms", "alpha", "reps", "smoothed",
+                 "top", "bottom", "bottom_frame", "bottom_ms", "bottom_angle", "last_rep_ms", "descending",
+                 "counted", "last_ms")
+
+    def __init__(self, stream_id=None, min_prominence=min_rep_depth, confirm_rise=0.15, min_spacing_ms=500, alpha=0.5):
+        """
+        Incremental version of find_reps for live streams. Takes one angle sample at a time and only keeps a few
+        numbers per stream. A bottom is reported as soon as the angle comes back confirm_rise above it, instead of
+        waiting for the whole rep, so the delay after the real bottom is only how long the lifter takes to rise
+        confirm_rise (plus a sample or two of smoothing).
+        :param min_prominence: how far (radians) the angle has to fall from the top for a dip to be a rep, and rise
+               again before the next rep can start. Default to 0.5.
+        :param confirm_rise: how far (radians) above the bottom the angle has to come back to report it. Default to
+               0.15.
+        :param min_spacing_ms: reps closer together than this are ignored. Default to half a second.
+        :param alpha: weight of the newest sample in the exponential moving average. Default to 0.5.
+        """
+        self.stream_id = stream_id
+        self.min_prominence = min_prominence
+        self.confirm_rise = min(confirm_rise, min_prominence)
+        self.min_spacing_ms = min_spacing_ms
+        self.alpha = alpha
+        self.reps = 0
+        self.smoothed = None
+        self.top = None
+        self.bottom = None
+        self.bottom_frame = None
+        self.bottom_ms = None
+        self.bottom_angle = None
+        self.last_rep_ms = None
+        self.last_ms = None
+        # descending: fell min_prominence from the top, tracking the bottom. counted: bottom reported, waiting to
+        # climb back min_prominence before looking for the next top
+        self.descending = False
+        self.counted = False
+
+    def push(self, timestamp_ms, angle, frame=None):
+        """
+        :param timestamp_ms: time of the sample, increasing
+        :param angle: action joint angle in radians, None if the joints weren't seen (the sample is ignored)
+        :param frame: anything identifying the sample, passed back in the event. Default to None.
+        :return: A RepEvent if this sample confirmed a rep bottom, else None
+        """
+        if angle is None or angle != angle:
+            return None
+        self.last_ms = timestamp_ms
+
+        if self.smoothed is None:
+            self.smoothed = self.top = angle
+            return None
+        v = self.smoothed = self.alpha * angle + (1 - self.alpha) * self.smoothed
+
+        if self.counted:
+            # Wait for the lifter to get back up, tracking the new top
+            if v - self.bottom >= self.min_prominence:
+                self.counted = False
+                self.top = v
+            return None
+
+        if not self.descending:
+            if v > self.top:
+                self.top = v
+            elif self.top - v >= self.min_prominence:
+                self.descending = True
+                self.bottom = v
+                self.bottom_frame, self.bottom_ms, self.bottom_angle = frame, timestamp_ms, angle
+            return None
+
+        if v < self.bottom:
+            self.bottom = v
+            self.bottom_frame, self.bottom_ms, self.bottom_angle = frame, timestamp_ms, angle
+            return None
+        if v - self.bottom < self.confirm_rise:
+            return None
+
+        self.descending = False
+        self.counted = True
+        if self.last_rep_ms is not None and self.bottom_ms - self.last_rep_ms < self.min_spacing_ms:
+            return None
+        self.last_rep_ms = self.bottom_ms
+        self.reps += 1
+        return RepEvent(self.stream_id, self.reps, self.bottom_frame, self.bottom_ms, self.bottom_angle,
+                        self.top - self.bottom, timestamp_ms - self.bottom_ms)
+
+
+class RepDetectorHub:
+    def __init__(self, on_rep=None, idle_timeout_ms=None, **detector_options):
+        """
+        One RepDetector per live stream, created on the stream's first sample.
+        :param on_rep: called with every RepEvent. Default to None.
+        :param idle_timeout_ms: streams with no sample for this long are dropped by evict_idle. Default to None (keep
+               them until remove).
+        :param detector_options: passed to every RepDetector
+        """
+        self.on_rep = on_rep
+        self.idle_timeout_ms = idle_timeout_ms
+        self.detector_options = detector_options
+        self.detectors = {}
+
+    def push(self, stream_id, timestamp_ms, angle, frame=None):
+        """
+        Feeds one sample to a stream's detector, see RepDetector.push.
+        """
+        detector = self.detectors.get(stream_id)
+        if detector is None:
+            detector = self.detectors.setdefault(stream_id, RepDetector(stream_id, **self.detector_options))
+
+        event = detector.push(timestamp_ms, angle, frame)
+        if event is not None and self.on_rep is not None:
+            self.on_rep(event)
+        return event
+
+    def rep_count(self, stream_id):
+        detector = self.detectors.get(stream_id)
+        return detector.reps if detector is not None else 0
+
+    def remove(self, stream_id):
+        self.detectors.pop(stream_id, None)
+
+    def evict_idle(self, now_ms):
+        """
+        Drops the streams that had no sample in the last idle_timeout_ms.
+        :return: The ids of the dropped streams
+        """
+        if self.idle_timeout_ms is None:
+            return []
+        idle = [stream_id for stream_id, detector in list(self.detectors.items())
+                if detector.last_ms is not None and now_ms - detector.last_ms > self.idle_timeout_ms]
+        for stream_id in idle:
+            self.detectors.pop(stream_id, None)
+        return idle
+
+    def __len__(self):
+        return len(self.detectors)
@@ -0,0 +1,121 @@
+import cv2
+import numpy as np
+
+from .data_analysis import DataAnalyzer
+
+
+class RoiTracker:
+    def __init__(self, padding=0.3, max_side=512, min_visible=8, min_box=0.1, sensitivity=0.5):
+        """
+        Follows the lifter from frame to frame so each frame can be cropped to them before inference. The box comes
+        from the previous frame's landmarks (or a segmentation mask), padded to allow for movement. Once the lifter
+        is lost the next frame is analyzed whole again.
+        :param padding: how much the box grows on each side, as a fraction of its size. Default to 0.3.
+        :param max_side: crops are downscaled so their longer side is at most this many pixels. Default to 512.
+        :param min_visible: fewer visible landmarks than this and tracking counts as lost. Default to 8.
+        :param min_box: boxes smaller than this fraction of the frame (either side) count as lost. Default to 0.1.
+        :param sensitivity: visibility threshold for a landmark to count towards the box, same as analyze_photo
+        """
+        self.padding = padding
+        self.max_side = max_side
+        self.min_visible = min_visible
+        self.min_box = min_box
+        self.sensitivity = sensitivity
+        # (x_min, y_min, x_max, y_max) in pixels of the full frame, None while there's nothing to track
+        self.box = None
+        self.crops = 0
+        self.full_frames = 0
+        self.lost = 0
+
+    def crop(self, image_mat):
+        """
+        :return: A tuple of (image to run the model on, box it was cut from or None for the whole frame)
+        """
+        if self.box is None:
+            self.full_frames += 1
+            return image_mat, None
+
+        x_min, y_min, x_max, y_max = self.box
+        crop = image_mat[y_min:y_max, x_min:x_max]
+        scale = self.max_side / max(crop.shape[:2])
+        if scale < 1:
+            crop = cv2.resize(crop, (max(int(crop.shape[1] * scale), 1), max(int(crop.shape[0] * scale), 1)),
+                              interpolation=cv2.INTER_AREA)
+        self.crops += 1
+        return np.ascontiguousarray(crop), self.box
+
+    def map_back(self, landmarks, box, frame_shape):
+        """
+        Converts landmarks detected in a crop to normalized coordinates of the full frame.
+        :param landmarks: (33, 4) array of x, y, z, visibility normalized to the crop, or an empty array
+        :param box: the box the crop was cut from, as returned by crop
+        """
+        if box is None or len(landmarks) == 0:
+            return landmarks
+
+        height, width = frame_shape[:2]
+        x_min, y_min, x_max, y_max = box
+        mapped = landmarks.copy()
+        mapped[:, 0] = (landmarks[:, 0] * (x_max - x_min) + x_min) / width
+        mapped[:, 1] = (landmarks[:, 1] * (y_max - y_min) + y_min) / height
+        # z uses the same scale as x
+        mapped[:, 2] = landmarks[:, 2] * (x_max - x_min) / width
+        return mapped
+
+    def is_lost(self, landmarks):
+        return len(landmarks) == 0 or np.count_nonzero(landmarks[:, 3] > self.sensitivity) < self.min_visible
+
+    def update(self, landmarks, frame_shape):
+        """
+        Moves the box to where the lifter is in this frame.
+        :param landmarks: full frame landmarks, see map_back
+        """
+        if self.is_lost(landmarks):
+            if self.box is not None:
+                self.lost += 1
+            self.box = None
+            return
+
+        visible = landmarks[landmarks[:, 3] > self.sensitivity]
+        self.set_box(visible[:, 0].min(), visible[:, 0].max(), visible[:, 1].min(), visible[:, 1].max(), frame_shape)
+
+    def update_from_mask(self, segmentation_mask, frame_shape):
+        """
+        Moves the box to a segmentation mask of the lifter, ex; from a landmarker with output_segmentation_masks.
+        """
+        corners = DataAnalyzer().get_mask_corners_cv(np.asarray(segmentation_mask), None)
+        if corners is None:
+            self.box = None
+            return
+
+        mask_height, mask_width = np.asarray(segmentation_mask).shape[:2]
+        x_min, x_max, y_min, y_max = corners
+        self.set_box(x_min / mask_width, (x_max + 1) / mask_width, y_min / mask_height, (y_max + 1) / mask_height,
+                     frame_shape)
+
+    def set_box(self, x_min, x_max, y_min, y_max, frame_shape):
+        """
+        Pads a box given in normalized coordinates and clamps it to the frame.
+        """
+        height, width = frame_shape[:2]
+        pad_x = (x_max - x_min) * self.padding
+        pad_y = (y_max - y_min) * self.padding
+        box = (int(max(x_min - pad_x, 0) * width), int(max(y_min - pad_y, 0) * height),
+               int(np.ceil(min(x_max + pad_x, 1) * width)), int(np.ceil(min(y_max + pad_y, 1) * height)))
+
+        if box[2] - box[0] < self.min_box * width or box[3] - box[1] < self.min_box * height:
+            self.box = None
+            return
+        self.box = box
+
+    def reset(self):
+        self.box = None
+
+    def stats(self):
+        total = self.crops + self.full_frames
+        return {
+            "crops": self.crops,
+            "full_frames": self.full_frames,
+            "lost": self.lost,
+            "crop_ratio": self.crops / total if total != 0 else 0,
+        }
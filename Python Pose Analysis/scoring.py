@@ -0,0 +1,154 @@
+import threading
+import weakref
+
+import numpy as np
+
+from .data_analysis import DataAnalyzer
+
+line_assessment_types = ("line", "min_line", "max_line")
+
+
+class MovementScorer:
+    def __init__(self, movement, m_inf_threshold=100, delta_x_side_thresh=0.075):
+        """
+        Scores every assessment condition of a movement, for any number of frames, in a handful of numpy calls.
+        Gives the same scores as running VideoAnalyzer.determine_profile and score_condition frame by frame.
+        :param movement: a CompiledMovement, see criteria.py
+        :param m_inf_threshold: slopes at least this steep count as vertical, same as get_slope
+        :param delta_x_side_thresh: same as VideoAnalyzer.determine_profile
+        """
+        self.movement = movement
+        self.m_inf_threshold = m_inf_threshold
+        self.delta_x_side_thresh = delta_x_side_thresh
+        self.data_analyzer = DataAnalyzer()
+
+        # Side conditions first, then front ones, the order analyze_bottom_position scores them in
+        self.conditions = movement.assessments["side"] + movement.assessments["front"]
+        self.is_front = np.array([False] * len(movement.assessments["side"]) +
+                                 [True] * len(movement.assessments["front"]), dtype=bool)
+
+        # Every landmark pair of every condition goes into one of two tables, remembering which condition it came from
+        line_pairs, line_owners, line_targets, line_types = [], [], [], []
+        parallel_pairs, parallel_owners, parallel_targets = [], [], []
+        for i, condition in enumerate(self.conditions):
+            if condition.assessment_type == "parallel_lines":
+                parallel_pairs.append(condition.pairs)
+                parallel_owners += [i] * len(condition.pairs)
+                parallel_targets += [condition.target] * len(condition.pairs)
+            else:
+                line_pairs.append(condition.pairs)
+                line_owners += [i] * len(condition.pairs)
+                line_targets += [condition.target] * len(condition.pairs)
+                line_types += [line_assessment_types.index(condition.assessment_type)] * len(condition.pairs)
+
+        self.line_pairs = np.concatenate(line_pairs) if line_pairs else np.empty((0, 2), dtype=np.intp)
+        self.line_targets = np.array(line_targets, dtype=np.float64)
+        self.line_types = np.array(line_types, dtype=np.intp)
+        self.parallel_pairs = np.concatenate(parallel_pairs) if parallel_pairs else np.empty((0, 2, 2), dtype=np.intp)
+        self.parallel_targets = np.array(parallel_targets, dtype=np.float64)
+
+        # Group the score columns by condition, so each condition's best score is one np.fmin.reduceat
+        owners = np.array(line_owners + parallel_owners, dtype=np.intp)
+        self.column_order = np.argsort(owners, kind="stable")
+        self.scored_conditions, self.column_starts = np.unique(owners[self.column_order], return_index=True)
+
+    def get_profiles(self, landmarks, visible):
+        """
+        Batch version of VideoAnalyzer.determine_profile.
+        :param landmarks: (frames, 33, 4) array, ex; LandmarkSeries.landmarks
+        :param visible: (frames, 33) bool array, ex; LandmarkSeries.visible
+        :return: A (frames,) bool array, True where the lifter is seen from the front
+        """
+        left = self.movement.left_required
+        right = self.movement.right_required
+        landmarks = np.asarray(landmarks, dtype=np.float64)
+        all_visible = np.asarray(visible)[:, np.concatenate([left, right])].all(axis=-1)
+
+        delta_x = np.abs(np.abs(landmarks[:, left, 0]) - np.abs(landmarks[:, right, 0]))
+        with np.errstate(invalid='ignore'):
+            avg = delta_x.mean(axis=-1) if len(left) != 0 else np.full(len(landmarks), np.nan)
+            return all_visible & ~(avg <= self.delta_x_side_thresh)
+
+    def score(self, landmarks, visible):
+        """
+        :param landmarks: (frames, 33, 4) array, ex; LandmarkSeries.landmarks
+        :param visible: (frames, 33) bool array, ex; LandmarkSeries.visible
+        :return: A (frames, conditions) array of scores in the order of self.conditions, NaN where none of a
+        condition's joints were visible
+        """
+        landmarks = np.asarray(landmarks, dtype=np.float64)
+        percent_diffs = self.data_analyzer.get_percent_diffs
+
+        slopes = self.data_analyzer.get_slopes(landmarks, self.line_pairs, self.m_inf_threshold, visible)
+        line_scores = percent_diffs(np.abs(slopes), self.line_targets, self.m_inf_threshold)
+        with np.errstate(invalid='ignore'):
+            # min_line and max_line are already good enough once the slope is past the target
+            line_scores[(self.line_types == 1) & (np.isposinf(slopes) | (slopes >= self.line_targets))] = 0
+            line_scores[(self.line_types == 2) & np.isfinite(slopes) & (slopes <= self.line_targets)] = 0
+
+        parallel_pairs = self.parallel_pairs.reshape(-1, 2)
+        parallel_slopes = np.abs(self.data_analyzer.get_slopes(landmarks, parallel_pairs, self.m_inf_threshold,
+                                                               visible))
+        slope_first, slope_second = parallel_slopes[:, 0::2], parallel_slopes[:, 1::2]
+        # Without a target slope ("None"), the two lines are compared with each other
+        to_target = (percent_diffs(slope_first, self.parallel_targets, self.m_inf_threshold) +
+                     percent_diffs(slope_second, self.parallel_targets, self.m_inf_threshold)) / 2
+        to_each_other = percent_diffs(slope_first, slope_second, self.m_inf_threshold)
+        parallel_scores = np.where(np.isnan(self.parallel_targets), to_each_other, to_target)
+
+        columns = np.abs(np.concatenate([line_scores, parallel_scores], axis=1))[:, self.column_order]
+        scores = np.full((len(landmarks), len(self.conditions)), np.nan)
+        if columns.shape[1] != 0 and len(landmarks) != 0:
+            # fmin skips NaN, so a condition is only NaN when none of its pairs were visible
+            scores[:, self.scored_conditions] = np.fmin.reduceat(columns, self.column_starts, axis=1)
+        return scores
+
+    def score_dicts(self, landmarks, visible, profiles=None):
+        """
+        :param profiles: (frames,) bool array of front profiles. Default to None (see get_profiles).
+        :return: One {condition name: score} dictionary per frame, the same as analyze_bottom_position returns. Front
+        conditions are only included for frames seen from the front.
+        """
+        if profiles is None:
+            profiles = self.get_profiles(landmarks, visible)
+        scores = self.score(landmarks, visible)
+
+        names = [condition.name for condition in self.conditions]
+        results = []
+        for frame_scores, front in zip(scores.tolist(), np.asarray(profiles).tolist()):
+            results.append({name: score for name, score, is_front in zip(names, frame_scores, self.is_front.tolist())
+                            if score == score and (front or not is_front)})
+        return results
+
+    def score_frame(self, connections, profile=None):
+        """
+        Scores a single frame.
+        :param connections: a FrameLandmarks, ex; returned by analyze_photo
+        :param profile: "side" or "front". Default to None (see get_profiles).
+        """
+        profiles = None if profile is None else np.array([profile == "front"])
+        return self.score_dicts(connections.data[np.newaxis], connections.visible[np.newaxis], profiles)[0]
+
+    def score_series(self, series):
+        """
+        :param series: a LandmarkSeries
+        :return: A list with the score dictionary of each frame, None for frames where nobody was detected
+        """
+        results = self.score_dicts(series.landmarks, series.visible)
+        return [result if detected else None for result, detected in zip(results, series.detected.tolist())]
+
+
+_scorers = weakref.WeakKeyDictionary()
+_scorers_lock = threading.Lock()
+
+
+def get_scorer(movement, m_inf_threshold=100):
+    """
+    Returns the scorer for a compiled movement, built once per movement. Reloading the criteria file gives new
+    CompiledMovement objects, so their scorers are rebuilt as well.
+    """
+    with _scorers_lock:
+        scorers = _scorers.setdefault(movement, {})
+        if m_inf_threshold not in scorers:
+            scorers[m_inf_threshold] = MovementScorer(movement, m_inf_threshold)
+        return scorers[m_inf_threshold]
@@ -1,34 +1,79 @@
-import math
-
 import cv2
-import mediapipe as mp
-import numpy
 import numpy as np
 import os
-import matplotlib.pyplot as plt
+import shutil
 import time
-import json
-import send2trash
 
+from .annotate import AnnotatedVideoWriter, contact_sheet, draw_pose, draw_tile, score_lines
+from .criteria import CompiledCondition, add_side_prefix, compile_action_joints, load_criteria
 from .data_analysis import DataAnalyzer
-from mediapipe.python.solutions.pose import PoseLandmark
-from mediapipe.python.solutions.drawing_utils import DrawingSpec
-from mediapipe.framework.formats import landmark_pb2
-from mediapipe.tasks import python
-from mediapipe.tasks.python import vision
-from mediapipe import solutions
+from .frame_sampler import FrameSampler, WindowSampler
+from .frame_store import FrameStore, FrameStoreWriter
+from .parallel_extraction import extract_landmarks_parallel
+from .rep_segmentation import Rep, find_reps
+from .roi import RoiTracker
+from .scoring import get_scorer
+from .workspace import get_workspace_manager
+from .landmark_cache import get_landmark_cache, video_content_hash
+from .landmark_flow import LandmarkFlow
+from .landmark_store import FrameLandmarks, LandmarkSeries, PoseLandmark, pack_landmarks
+from .landmarker_pool import get_pool
+from . import metrics
+from .metrics import AnalysisStats
 
 PoseLandmarkDictionary = {}
 m_inf_threshold = 100 # What m value to be considered as "infinity"
 
+# Pose landmarker models from cheapest to most accurate, stored as pose_landmarker_<tier>.task next to this file
+model_tiers = ("lite", "full", "heavy")
+# Which model each stage uses. scan: whole clip landmarks for the angle series, escalate: frames where scan couldn't
+# see the action joints, score: the key frames that get scored
+default_models = {"scan": "lite", "escalate": "heavy", "score": "heavy"}
+
+
+def model_path(tier):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), f'pose_landmarker_{tier}.task')
+
+
+def resolve_tier(tier):
+    """
+    :return: The tier, or heavy if that tier's model file isn't there
+    """
+    if tier not in model_tiers:
+        raise ValueError(f"Unknown model tier {tier!r}, expected one of {model_tiers}")
+    if tier != "heavy" and not os.path.isfile(model_path(tier)):
+        return "heavy"
+    return tier
+
+
+class AnalysisCancelled(Exception):
+    """
+    Raised from frame iteration once the analyzer's cancel_event is set.
+    """
+
 # TO DO - check standard status codes for GET requests
 class VideoAnalyzer(DataAnalyzer):
-    def __init__(self, video_path, frames_cut_per_second, width, height):
+    def __init__(self, video_path, frames_cut_per_second, width, height, landmark_cache=None, cancel_event=None,
+                 models=None, frame_store=False, frame_store_max_side=640, workspace=None):
         """
         Sets up video received from frontend for processing.
         :param video_path: path to mp4 file
         :param frames_cut_ps: how many frames to cut from the video per second. For example, setting this parameter to
         60 will result in 60 images being created per second of video.
+        :param landmark_cache: the LandmarkCache detections are looked up in before running the model. Default to None
+               (the process-wide cache), pass False to always run the model.
+        :param cancel_event: a threading.Event that stops the analysis between two frames once set, by raising
+               AnalysisCancelled. Default to None.
+        :param models: {stage: tier} to override default_models, ex; {"scan": "full"}. Tiers whose model file is
+               missing fall back to heavy. Default to None.
+        :param frame_store: keep the frames split_frames and save_frames write in one file next to the video
+               (images_<id>.frames, see FrameStore) instead of a folder with one JPEG per frame. Default to False.
+        :param frame_store_max_side: with frame_store, downscale the stored frames so their longer side is at most
+               this many pixels. Frames are stored uncompressed: a 1080p frame is about 6 MB, so 60 s split at 5 fps
+               takes about 1.8 GB at full size and about 200 MB at 640. Default to 640, None keeps the full size.
+        :param workspace: a WorkspaceManager to keep the frames and analyzed images in instead of next to the video,
+               or True for the process-wide one (see get_workspace_manager). Call close() or use the analyzer as a
+               context manager once done with it. Default to None.
         """
         self.video_dir_prefix = "user_videos"
         self.frames_cut_ps = frames_cut_per_second
@@ -39,6 +84,25 @@ class VideoAnalyzer(DataAnalyzer):
         self.height = height
         self.key_frames = None
         self.analyzed_images_path = []
+        self.sampling_stats = None
+        self.landmarks = None
+        self.angle_series = None
+        self.reps = None
+        self.models = {stage: resolve_tier(tier) for stage, tier in {**default_models, **(models or {})}.items()}
+        # Model calls per tier, cache hits not included
+        self.tier_calls = dict.fromkeys(model_tiers, 0)
+        self.landmark_cache = get_landmark_cache() if landmark_cache is None else landmark_cache
+        self.video_hash = None
+        self.cancel_event = cancel_event
+        self.use_frame_store = frame_store
+        self.frame_store_max_side = frame_store_max_side
+        self.frame_store = None
+        # Stage timings and frame counts of everything this analyzer ran, see metrics.AnalysisStats
+        self.stats = AnalysisStats()
+        if workspace is True:
+            workspace = get_workspace_manager()
+        self.workspace = workspace.acquire(os.path.splitext(os.path.basename(self.video_path))[0]) \
+            if workspace is not None else None
         super().__init__()
 
     def split_frames(self):
@@ -47,45 +111,218 @@ class VideoAnalyzer(DataAnalyzer):
                 f.write(self.video_path)
             return
 
-        cap = cv2.VideoCapture(self.video_path)
-        fps = cap.get(cv2.CAP_PROP_FPS)  # OpenCV v2.x used "CV_CAP_PROP_FPS"
-        num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        if fps == 0 or num_frames == 0:
-            return
-        vid_length = num_frames / fps
+        sequence_path = self.get_sequence_path()
+        saved = 0
+
+        if self.use_frame_store:
+            saved = self.write_frame_store(self.iter_frames())
+            if saved != 0:
+                # Still where draw_points writes the analyzed images
+                self.sequence_path = sequence_path
+            else:
+                # Nothing was sampled, don't leave an empty store behind
+                os.remove(self.get_frame_store_path())
+        else:
+            for frame_count, _, frame in self.iter_frames():
+                if saved == 0:
+                    # Replace with deletion later
+                    if not os.path.exists(sequence_path):
+                        os.makedirs(sequence_path)
+                    self.sequence_path = sequence_path
+
+                cv2.imwrite(os.path.join(self.sequence_path, f"{frame_count}.jpg"), frame)
+                saved += 1
 
-        frame_rate = int(num_frames / vid_length)
-        if frame_rate == 0:
+        if saved == 0:
             return
+        if metrics.debug:
+            print(f"{os.path.basename(self.video_path)} successfully saved")
+            print(self.sampling_stats)
 
-        frame_count = 0
-        self.sequence_path = os.path.join(os.path.dirname(self.video_path), f"images_{os.path.basename(self.video_path).strip('.mp4')}")
+    def get_sequence_path(self):
+        directory = self.workspace.path if self.workspace is not None else os.path.dirname(self.video_path)
+        return os.path.join(directory, f"images_{os.path.basename(self.video_path).strip('.mp4')}")
 
-        # Replace with deletion later
-        if not os.path.exists(self.sequence_path):
-            os.makedirs(self.sequence_path)
+    def get_frame_store_path(self):
+        return self.get_sequence_path() + ".frames"
+
+    def get_frame_store(self):
+        """
+        :return: The open FrameStore written by split_frames or save_frames, or None if frame_store is off or nothing
+        was written yet
+        """
+        if self.frame_store is None and self.use_frame_store and os.path.exists(self.get_frame_store_path()):
+            self.frame_store = FrameStore(self.get_frame_store_path())
+        return self.frame_store
 
-        while cap.isOpened():
-            success, frame = cap.read()
+    def write_frame_store(self, frames):
+        """
+        Replaces the frame store with these frames.
+        :param frames: an iterable of (frame_index, timestamp_ms, frame) tuples, ex; iter_frames()
+        :return: The number of frames stored
+        """
+        self.close_frame_store()
+        with FrameStoreWriter(self.get_frame_store_path(), self.frame_store_max_side) as writer:
+            for frame_index, timestamp_ms, frame in frames:
+                writer.append(frame_index, timestamp_ms, frame)
+        return len(writer.frame_indices)
+
+    def close_frame_store(self):
+        if self.frame_store is not None:
+            self.frame_store.close()
+            self.frame_store = None
+
+    def load_frame(self, image_path):
+        """
+        Reads a frame saved by split_frames or save_frames, from the frame store when it's in there.
+        :param image_path: the frame's path in the sequence folder, ex; os.path.join(sequence_path, "30.jpg")
+        :return: The frame, read-only if it comes from the frame store, or None if it can't be read
+        """
+        store = self.get_frame_store()
+        name = os.path.splitext(os.path.basename(image_path))[0]
+        if store is not None and name.isdigit() and int(name) in store:
+            return store.get(int(name))
+        return cv2.imread(image_path)
 
-            if not success:
+    def iter_frames(self, sampler=None):
+        """
+        Decodes the video and yields every sampled frame straight from memory, already rotated the same way
+        split_frames saves them. Nothing is written to disk. Once the video is exhausted, the sampler's decoded and
+        skipped frame counts are stored in sampling_stats.
+        :param sampler: where the frames come from, ex; a WindowSampler. Default to None (a FrameSampler at
+               frames_cut_ps over the whole video).
+        :return: A generator of (frame_index, timestamp_ms, frame) tuples, where frame_index is the frame's position in
+        the video and timestamp_ms its presentation time
+        """
+        if sampler is None:
+            sampler = FrameSampler(self.video_path, self.frames_cut_ps)
+        frames = iter(sampler)
+        while True:
+            # Only the sampler is timed, not whoever consumes the frames
+            start = time.perf_counter()
+            sample = next(frames, None)
+            if sample is not None:
+                frame_index, timestamp_ms, frame = sample
+                frame = self.orient_frame(frame)
+            self.stats.add_time("decode", time.perf_counter() - start)
+            if sample is None:
                 break
-            if frame_count % (math.ceil(frame_rate / self.frames_cut_ps)) == 0:
-                if self.width < self.height:
-                    cv2.imwrite(os.path.join(self.sequence_path, f"{frame_count}.jpg"), cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE))
-                else:
-                    cv2.imwrite(os.path.join(self.sequence_path, f"{frame_count}.jpg"), frame)
+            self.check_cancelled()
+            yield frame_index, timestamp_ms, frame
+
+        self.sampling_stats = sampler.stats()
+        self.stats.count("frames_decoded", self.sampling_stats["decoded"])
+        self.stats.count("frames_skipped", self.sampling_stats["skipped"])
 
-            frame_count += 1
+    def iter_saved_frames(self):
+        """
+        Reads back the frames saved by split_frames in video order.
+        :return: A generator of (frame_index, timestamp_ms, frame) tuples, same as iter_frames
+        """
+        store = self.get_frame_store()
+        if store is not None:
+            # Views into the mapped file, nothing to decode
+            for frame_index, timestamp_ms, frame in store:
+                self.check_cancelled()
+                self.stats.count("frames_decoded")
+                yield frame_index, timestamp_ms, frame
+            return
 
+        frames = [f for f in os.listdir(self.sequence_path) if os.path.isfile(os.path.join(self.sequence_path, f))]
+        frames_int = sorted([int(f.strip('.jpg')) for f in frames])
+        if metrics.debug:
+            print(frames_int)
+
+        cap = cv2.VideoCapture(self.video_path)
+        fps = cap.get(cv2.CAP_PROP_FPS)
         cap.release()
-        print(f"{os.path.basename(self.video_path)} successfully saved")
+        for f in frames_int:
+            self.check_cancelled()
+            # Without the video we can't know its frame rate, assume the frames were cut evenly
+            timestamp_ms = f * 1000 / fps if fps != 0 else f * 1000 / self.frames_cut_ps
+            with self.stats.timer("decode"):
+                frame = cv2.imread(os.path.join(self.sequence_path, str(f) + '.jpg'))
+            self.stats.count("frames_decoded")
+            yield f, timestamp_ms, frame
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise AnalysisCancelled(self.video_path)
+
+    def orient_frame(self, frame):
+        if self.width < self.height:
+            return cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+        return frame
+
+    def save_frames(self, frame_indices):
+        """
+        Writes only the requested frames of the video to the sequence folder, named the same way split_frames names
+        them so they can be passed to analyze_bottom_position.
+        With frame_store, a store that already has every requested frame, ex; from split_frames, is used as is.
+        Otherwise it's replaced by a store of only these frames, and the frames it had before are gone.
+        :param frame_indices: the frame indices (positions in the video) to save
+        :return: The saved file names, in the same order as frame_indices
+        """
+        self.sequence_path = self.get_sequence_path()
+        if self.use_frame_store:
+            store = self.get_frame_store()
+            if store is None or not all(frame_index in store for frame_index in frame_indices):
+                cap = cv2.VideoCapture(self.video_path)
+                fps = cap.get(cv2.CAP_PROP_FPS) or self.frames_cut_ps
+                cap.release()
+                self.write_frame_store((frame_index, frame_index * 1000 / fps, frame)
+                                       for frame_index, frame in self.read_frames(frame_indices))
+                store = self.get_frame_store()
+            return [f"{frame_index}.jpg" for frame_index in frame_indices if frame_index in store]
 
-    def find_key_time(self, movement_type):
+        if not os.path.exists(self.sequence_path):
+            os.makedirs(self.sequence_path)
+
+        names = []
+        for frame_index, frame in self.read_frames(frame_indices):
+            name = f"{frame_index}.jpg"
+            cv2.imwrite(os.path.join(self.sequence_path, name), frame)
+            names.append(name)
+
+        return names
+
+    def read_frames(self, frame_indices):
+        """
+        Decodes only the requested frames of the video, seeking to each one.
+        :return: A generator of (frame_index, frame) tuples, frames oriented like iter_frames. Frames that can't be
+        read are left out.
+        """
+        cap = cv2.VideoCapture(self.video_path)
+        try:
+            for frame_index in frame_indices:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, int(frame_index))
+                success, frame = cap.read()
+                if not success:
+                    continue
+                yield int(frame_index), self.orient_frame(frame)
+        finally:
+            cap.release()
+
+    def find_key_time(self, movement_type, streaming=False, running_mode="video", workers=1, save_key_frames=True,
+                      roi=False, keyframe_interval=1):
         """
         Find the point at which the lift is evaluated based on the position and angles of key joints. For example,
         the squat is best evaluated when the person is at the bottom of the lift.
-        :return: The frame at which the individual is evaluated at
+        :param streaming: analyze frames straight from the video instead of the images saved by split_frames. Only the
+               key frames are written to disk. Default to False.
+        :param running_mode: "video" tracks the person from one frame to the next with extract_landmarks, "image"
+               detects the person from scratch in every frame. Default to "video".
+        :param workers: number of processes to split the frames between, see extract_landmarks_parallel. Only used
+               with streaming, and always detects in "image" mode. Default to 1 (no worker processes).
+        :param save_key_frames: with streaming, write the key frames to the sequence folder. Turn off when only the
+               landmarks are needed afterwards, ex; for score_frames. Default to True.
+        :param roi: crop each frame to the lifter before detecting, see RoiTracker. Only used in "image" mode, "video"
+               mode already follows the lifter inside the landmarker. Default to False.
+        :param keyframe_interval: only run the model on one frame out of this many, and carry the landmarks over to
+               the frames in between with optical flow, see LandmarkFlow. Frames the flow loses the lifter in still
+               go through the model. Only used in "video" mode without worker processes. Default to 1 (the model
+               runs on every frame).
+        :return: The frame at which the individual is evaluated at, an empty list if nobody was seen doing the movement
         """
         image_per_frame = {}
         filename_per_frame = {}
@@ -93,33 +330,68 @@ class VideoAnalyzer(DataAnalyzer):
         angles_1 = {}
         angles_2 = {}
         all_points = []
-        criteria = open(os.path.join(self.base_dir, 'movement_criteria.json'))
-        criteria_data = json.load(criteria)
+        movement = load_criteria(os.path.join(self.base_dir, 'movement_criteria.json'))[movement_type]
+        action_joints = movement.action_triples
 
-        if self.sequence_path is None:
+        if streaming:
+            images = self.iter_frames()
+        elif self.sequence_path is None:
             return
-
-        frames = [f for f in os.listdir(self.sequence_path) if os.path.isfile(os.path.join(self.sequence_path, f))]
-        frames_int = sorted([int(f.strip('.jpg')) for f in frames])
-        frames_sorted = [str(f) + '.jpg' for f in frames_int]
-        print(frames_sorted)
-
-        for frame, photo in enumerate(frames_sorted):
-            analysis = self.analyze_photo(os.path.join(self.sequence_path, photo), action_joints=criteria_data[movement_type].get("action_joints"))
-            if analysis is None:
+        else:
+            images = self.iter_saved_frames()
+
+        # Frames where the scan model can't see the angle find_key_time follows go to the escalation model
+        escalate_joints = action_joints[0] if action_joints.shape[0] > 0 else None
+
+        if streaming and workers != 1:
+            series, self.sampling_stats = extract_landmarks_parallel(self, workers=workers, roi=roi,
+                                                                     escalate_joints=escalate_joints)
+            for tier, calls in self.sampling_stats.pop("tier_calls").items():
+                self.tier_calls[tier] += calls
+            self.stats.merge(self.sampling_stats.pop("analysis_stats"))
+        elif running_mode == "video":
+            flow = LandmarkFlow(keyframe_interval, required=action_joints[0]) if keyframe_interval > 1 and \
+                action_joints.shape[0] > 0 else None
+            series = self.extract_landmarks(frames=images, escalate_joints=escalate_joints, flow=flow,
+                                            cache_variant=f"{self.frames_cut_ps:g}fps")
+        else:
+            self.get_landmarker_pool(self.models["scan"]).warm_up()
+            roi_tracker = RoiTracker() if roi else None
+            series = LandmarkSeries.from_frames((frame_index, timestamp_ms,
+                                                 self.detect_landmarks(image_mat, frame_index, roi_tracker=roi_tracker,
+                                                                       tier=self.models["scan"],
+                                                                       escalate_joints=escalate_joints))
+                                                for frame_index, timestamp_ms, image_mat in images)
+        self.landmarks = series
+        # One column per action joint, left first
+        with self.stats.timer("angles"):
+            self.angle_series = self.get_angles(series.landmarks, action_joints, series.visible)
+
+        for frame, frame_index in enumerate(series.frame_indices.tolist()):
+            if not series.detected[frame]:
                 continue
             
-            angle, _, _ = analysis
-            angles[frame] = angle
+            angle = self.angle_series[frame, 0] if action_joints.shape[0] > 0 else np.nan
+            angles[frame] = float(angle) if not np.isnan(angle) else None
             # angles_1[frame] = angle_1
             # angles_2[frame] = angle_2
-            image_per_frame[frame] = photo
+            image_per_frame[frame] = frame_index
 
         angles_1 = angles
 
-        frame_ids = self.get_candidate_frames(angles_1)
-        print(frame_ids)
-        frame_names = [image_per_frame[i] for i in frame_ids]
+        with self.stats.timer("rep_segmentation"):
+            frame_ids = self.get_candidate_frames(angles_1)
+        if metrics.debug:
+            print(frame_ids)
+        if frame_ids is None:
+            # Nobody was seen doing the movement
+            if self.landmark_cache:
+                self.landmark_cache.flush()
+            return []
+        if streaming and save_key_frames:
+            frame_names = self.save_frames([image_per_frame[i] for i in frame_ids])
+        else:
+            frame_names = [str(image_per_frame[i]) + '.jpg' for i in frame_ids]
 
         #### DEBUG ####
         # for i in frame_names:
@@ -137,7 +409,89 @@ class VideoAnalyzer(DataAnalyzer):
 
         # plt.show()
 
-        criteria.close()
+        if self.landmark_cache:
+            self.landmark_cache.flush()
+        return frame_names
+
+    def find_key_time_adaptive(self, movement_type, window_ms=None, fine_samples_per_second=None,
+                               save_key_frames=True):
+        """
+        Coarse-to-fine version of find_key_time(streaming=True). The whole clip is only analyzed at frames_cut_ps,
+        which is enough to find each rep. Then short windows around each rep's bottom are analyzed at the full frame
+        rate to land on the real bottom, instead of sampling the whole clip that densely.
+        The coarse and fine landmarks end up together in self.landmarks, and self.reps points at the refined bottoms.
+        :param window_ms: how far before and after each coarse bottom to look. Default to None (one coarse sampling
+               interval, the furthest the real bottom can be).
+        :param fine_samples_per_second: sampling rate inside the windows. Default to None (every frame).
+        :param save_key_frames: same as find_key_time
+        :return: The key frame of each rep, same as find_key_time
+        """
+        movement = load_criteria(os.path.join(self.base_dir, 'movement_criteria.json'))[movement_type]
+        action_joints = movement.action_triples[:1]
+        escalate_joints = action_joints[0] if action_joints.shape[0] > 0 else None
+        if window_ms is None:
+            window_ms = 1000 / self.frames_cut_ps
+
+        coarse = self.extract_landmarks(escalate_joints=escalate_joints)
+        coarse_stats = self.sampling_stats
+        with self.stats.timer("angles"):
+            coarse_angles = self.get_angles(coarse.landmarks, action_joints, coarse.visible)
+        angles = {}
+        for frame in np.flatnonzero(coarse.detected).tolist():
+            angle = coarse_angles[frame, 0] if action_joints.shape[0] > 0 else np.nan
+            angles[frame] = float(angle) if not np.isnan(angle) else None
+
+        with self.stats.timer("rep_segmentation"):
+            candidate_frames = self.get_candidate_frames(angles)
+        if candidate_frames is None:
+            self.landmarks = coarse
+            return []
+        coarse_reps = self.reps
+
+        sampler = WindowSampler(self.video_path, [(coarse.timestamps_ms[rep.bottom] - window_ms,
+                                                   coarse.timestamps_ms[rep.bottom] + window_ms)
+                                                  for rep in coarse_reps], fine_samples_per_second)
+        # Frames the coarse pass already analyzed are only decoded
+        coarse_frames = set(coarse.frame_indices.tolist())
+        fine = self.extract_landmarks(frames=((frame_index, timestamp_ms, frame)
+                                              for frame_index, timestamp_ms, frame in self.iter_frames(sampler)
+                                              if frame_index not in coarse_frames),
+                                      escalate_joints=escalate_joints)
+
+        # Merge both passes in video order, frames sampled by both only once
+        frame_indices, positions = np.unique(np.concatenate([coarse.frame_indices, fine.frame_indices]),
+                                             return_index=True)
+        series = LandmarkSeries(np.concatenate([coarse.landmarks, fine.landmarks])[positions], frame_indices,
+                                np.concatenate([coarse.timestamps_ms, fine.timestamps_ms])[positions],
+                                coarse.sensitivity)
+        self.landmarks = series
+        with self.stats.timer("angles"):
+            self.angle_series = self.get_angles(series.landmarks, movement.action_triples, series.visible)
+        self.sampling_stats = {k: coarse_stats[k] + self.sampling_stats[k] for k in ("decoded", "skipped", "seeks")}
+        self.sampling_stats["coarse_frames"] = len(coarse)
+        self.sampling_stats["fine_frames"] = len(fine)
+
+        angle = self.angle_series[:, 0] if action_joints.shape[0] > 0 else np.full(len(series), np.nan)
+        reps = []
+        for rep in coarse_reps:
+            # The lowest angle seen around the coarse bottom, in either pass
+            bottom_ms = coarse.timestamps_ms[rep.bottom]
+            in_window = np.abs(series.timestamps_ms - bottom_ms) <= window_ms
+            bottom = int(np.nanargmin(np.where(in_window, angle, np.nan)))
+            reps.append(Rep(bottom, series.position(coarse.frame_indices[rep.start]),
+                            series.position(coarse.frame_indices[rep.end]), rep.depth, rep.confidence))
+        self.reps = reps
+
+        key_frames = [int(series.frame_indices[rep.bottom]) for rep in reps]
+        if metrics.debug:
+            print(key_frames)
+        if save_key_frames:
+            frame_names = self.save_frames(key_frames)
+        else:
+            frame_names = [f"{i}.jpg" for i in key_frames]
+
+        if self.landmark_cache:
+            self.landmark_cache.flush()
         return frame_names
 
     def analyze_photo(self, photo_path, action_joints=None, sensitivity=0.5):
@@ -162,369 +516,466 @@ class VideoAnalyzer(DataAnalyzer):
         OR
         connection_dictionary, same key value representations as the first return format.
         '''
-        mp_drawing = mp.solutions.drawing_utils
-        mp_drawing_styles = mp.solutions.drawing_styles
-        mp_pose = mp.solutions.pose
-        custom_connections = list(mp_pose.POSE_CONNECTIONS)
-        BaseOptions = mp.tasks.BaseOptions
-        PoseLandmarker = mp.tasks.vision.PoseLandmarker
-        PoseLandmarkerOptions = mp.tasks.vision.PoseLandmarkerOptions
-        VisionRunningMode = mp.tasks.vision.RunningMode
-
-        # Size of data (images in this case) for preprocessing
-        # FINAL SIZE: crop_width, crop_height
-        target_width = 224
-        target_height = 224
-        BG_COLOR = (0, 0, 0)  # Black
-        MASK_COLOR = (255, 255, 255)  # white
-
-        all_points = []
-        all_images = {}
-        image_per_frame = {}
-        connections = {}
-
         if not photo_path.endswith('.jpg'):
             return
 
-        # image = cv2.imread(photo_path)
-        base_options = python.BaseOptions(model_asset_path=os.path.join(self.base_dir, 'pose_landmarker_heavy.task'))
-        options = vision.PoseLandmarkerOptions(
-            base_options=base_options,
-            output_segmentation_masks=False
-        )
-        detector = vision.PoseLandmarker.create_from_options(options)
-
         # image = cv2.imread(photo_path)
         # image_cv2 = cv2.resize(image, (224, 224))
         # image = mp.Image(image_format=mp.ImageFormat.SRGB, data=cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        image_mat = cv2.imread(photo_path)
+        image_mat = self.load_frame(photo_path)
         # if self.width < self.height:
         #     image_mat = cv2.rotate(image_mat, cv2.ROTATE_90_CLOCKWISE)
 
+        # Saved frames are named after their index in the video, which lets them share the cached detection
+        frame_index = os.path.splitext(os.path.basename(photo_path))[0]
+        frame_index = int(frame_index) if frame_index.isdigit() else None
+
+        return self.analyze_image(image_mat, action_joints, sensitivity, frame_index=frame_index)
+
+    def analyze_image(self, image_mat, action_joints=None, sensitivity=0.5, frame_index=None):
+        """
+        Same as analyze_photo, but for a frame that is already decoded in memory (BGR, as returned by OpenCV).
+        :param frame_index: the frame's position in the video. When given, the landmark cache is checked before
+               running the model. Default to None.
+        """
+        return self.analyze_landmarks(self.detect_landmarks(image_mat, frame_index, sensitivity), action_joints,
+                                      sensitivity)
+
+    def detect_landmarks(self, image_mat, frame_index=None, sensitivity=0.5, roi_tracker=None, tier=None,
+                         escalate_joints=None):
+        """
+        Runs one frame through the IMAGE mode landmarker, unless its landmarks are already cached.
+        :param roi_tracker: a RoiTracker following the lifter through consecutive frames. When given, only the area
+               around where the lifter was in the previous frame is analyzed, and the whole frame again if they
+               aren't found there. Default to None (always the whole frame).
+        :param tier: which model to use, see model_tiers. Default to None (the score model).
+        :param escalate_joints: landmark indices that have to be visible. If the model doesn't see all of them, the
+               frame is run again through the escalation model. Default to None (never escalate).
+        :return: The packed landmarks, see pack_detection. Always normalized to the whole frame.
+        """
+        tier = tier or self.models["score"]
+        variant = "roi" if roi_tracker is not None else None
+        cache_group = self.get_cache_group(sensitivity, variant, tier, frame_shape=getattr(image_mat, "shape", None)) \
+            if frame_index is not None else None
+        landmarks = self.landmark_cache.get(cache_group, frame_index) if cache_group is not None else None
+        if cache_group is not None:
+            self.stats.count("cache_hits" if landmarks is not None else "cache_misses")
+
+        if landmarks is None:
+            if roi_tracker is None:
+                landmarks = self.detect_image(image_mat, tier)
+            else:
+                crop, box = roi_tracker.crop(image_mat)
+                landmarks = roi_tracker.map_back(self.detect_image(crop, tier), box, image_mat.shape)
+                if box is not None and roi_tracker.is_lost(landmarks):
+                    # Lost the lifter, look at the whole frame
+                    roi_tracker.reset()
+                    crop, _ = roi_tracker.crop(image_mat)
+                    landmarks = self.detect_image(crop, tier)
+            if cache_group is not None:
+                self.landmark_cache.put(cache_group, frame_index, landmarks)
+
+        if self.needs_escalation(landmarks, escalate_joints, sensitivity, tier):
+            return self.detect_landmarks(image_mat, frame_index, sensitivity, roi_tracker, self.models["escalate"])
+
+        if roi_tracker is not None:
+            roi_tracker.update(landmarks, image_mat.shape)
+        if len(landmarks) == 0:
+            self.stats.count("no_pose_frames")
+        return landmarks
+
+    def needs_escalation(self, landmarks, escalate_joints, sensitivity, tier):
+        if escalate_joints is None or tier == self.models["escalate"]:
+            return False
+        return len(landmarks) == 0 or not (landmarks[escalate_joints, 3] > sensitivity).all()
+
+    def detect_image(self, image_mat, tier=None):
+        import mediapipe as mp
+
+        tier = tier or self.models["score"]
         image = mp.Image(image_format=mp.ImageFormat.SRGB, data=image_mat)
-        detection_result = detector.detect(image)
+        with self.get_landmarker_pool(tier).landmarker() as detector:
+            with self.stats.timer("detection"):
+                detection_result = detector.detect(image)
+        self.tier_calls[tier] += 1
+        self.stats.count("detections")
+        return self.pack_detection(detection_result)
+
+    def get_landmarker_pool(self, tier, **options):
+        """
+        :param options: extra landmarker options, ex; running_mode
+        :return: The process-wide landmarker pool for a tier, see landmarker_pool.get_pool
+        """
+        return get_pool(model_path(tier), output_segmentation_masks=False, **options)
+
+    def get_cache_group(self, sensitivity, variant=None, tier=None, running_mode="image", frame_shape=None):
+        """
+        :param tier: the model the landmarks come from. Default to None (the score model).
+        :param running_mode: "image" or "video", the landmarker finds slightly different landmarks in each. Default to
+               "image".
+        :param frame_shape: shape of the frames the model sees, so downscaled frames (ex; from a frame store with
+               max_side) don't share landmarks with full size ones. Default to None.
+        :return: The landmark cache group for this video at this sensitivity, or None if caching is off or the video
+        can't be read
+        """
+        if not self.landmark_cache or not os.path.isfile(self.video_path):
+            return None
+        if self.video_hash is None:
+            self.video_hash = video_content_hash(self.video_path)
+
+        # Everything besides the video and model that changes what the landmarks are
+        parts = [running_mode]
+        if self.width < self.height:
+            # Rotated frames have rotated landmarks
+            parts.append("rotated")
+        if frame_shape is not None:
+            parts.append(f"{frame_shape[1]}x{frame_shape[0]}")
+        if variant is not None:
+            parts.append(variant)
+        return self.landmark_cache.group_key(self.video_hash, model_path(tier or self.models["score"]),
+                                             sensitivity, "-".join(parts))
+
+    def extract_landmarks(self, frames=None, sensitivity=0.5, escalate_joints=None, flow=None, cache_variant=None):
+        """
+        Runs a whole clip through a single VIDEO mode landmarker in timestamp order. Each frame starts from the pose
+        found in the previous one instead of detecting the person from scratch, which is much cheaper than
+        analyze_image on every frame. The landmarker is new for each clip, so nothing tracked in another video
+        carries over.
+        :param frames: an iterable of (frame_index, timestamp_ms, frame) tuples in timestamp order. Default to None
+               (every sampled frame from iter_frames).
+        :param sensitivity: same as analyze_photo
+        :param escalate_joints: landmark indices the scan model has to see in each frame. Frames where it doesn't are
+               detected again with the escalation model, see detect_landmarks. Default to None (never escalate).
+        :param flow: a LandmarkFlow carrying landmarks over between the frames the model runs on. Propagated
+               landmarks are never cached. Default to None (the model runs on every frame).
+        :param cache_variant: names the sequence of frames, ex; "5fps". A frame's landmarks depend on the frames the
+               landmarker saw before it, so they're only cached for a known sequence. Default to None (the sampling
+               rate when frames is None, otherwise nothing is cached).
+        :return: A LandmarkSeries with one entry per frame
+        """
+        import mediapipe as mp
+        from mediapipe.tasks.python import vision
+
+        if frames is None:
+            frames = self.iter_frames()
+            if cache_variant is None:
+                cache_variant = f"{self.frames_cut_ps:g}fps"
+        if cache_variant is not None and flow is not None:
+            # The landmarker doesn't see the propagated frames
+            cache_variant = f"{cache_variant}-k{flow.keyframe_interval}"
+
+        tier = self.models["scan"]
+        pool = self.get_landmarker_pool(tier, running_mode=vision.RunningMode.VIDEO)
+        cache_group = cache_shape = None
+        # Cached landmarks are only read until the first miss, and only stored while the landmarker has seen every
+        # frame since the start of the clip, so they're the same whichever frames were cached before
+        reading_cache = writing_cache = True
+        last_timestamp = -1
+        series = []
+
+        # Never checked back in, the next clip would start from this one's tracking state
+        with pool.landmarker(discard=True) as detector:
+            for frame_index, timestamp_ms, image_mat in frames:
+                if image_mat.shape != cache_shape:
+                    cache_group = self.get_cache_group(sensitivity, cache_variant, tier=tier, running_mode="video",
+                                                       frame_shape=image_mat.shape) \
+                        if cache_variant is not None else None
+                    cache_shape = image_mat.shape
+
+                if flow is not None:
+                    fallbacks = flow.fallbacks
+                    # Timed as detection, it's what the flow stands in for
+                    with self.stats.timer("detection"):
+                        landmarks = flow.propagate(image_mat)
+                    self.stats.count("flow_fallbacks", flow.fallbacks - fallbacks)
+                    if landmarks is not None:
+                        self.stats.count("frames_propagated")
+                        series.append((frame_index, timestamp_ms, landmarks))
+                        continue
+
+                landmarks = None
+                if cache_group is not None and reading_cache:
+                    landmarks = self.landmark_cache.get(cache_group, frame_index)
+                    self.stats.count("cache_hits" if landmarks is not None else "cache_misses")
+                    if landmarks is None:
+                        reading_cache = False
+                    else:
+                        # The landmarker starts tracking partway through the clip
+                        writing_cache = False
+
+                if landmarks is None:
+                    # Timestamps have to keep increasing, even if two frames share one
+                    timestamp = max(int(timestamp_ms), last_timestamp + 1)
+                    last_timestamp = timestamp
+
+                    image = mp.Image(image_format=mp.ImageFormat.SRGB, data=image_mat)
+                    start = time.perf_counter()
+                    detection_result = detector.detect_for_video(image, timestamp)
+                    self.stats.add_time("detection", time.perf_counter() - start)
+                    self.tier_calls[tier] += 1
+                    self.stats.count("detections")
+                    landmarks = self.pack_detection(detection_result)
+                    if cache_group is not None and writing_cache:
+                        self.landmark_cache.put(cache_group, frame_index, landmarks)
+
+                if self.needs_escalation(landmarks, escalate_joints, sensitivity, tier):
+                    landmarks = self.detect_landmarks(image_mat, frame_index, sensitivity,
+                                                      tier=self.models["escalate"])
+                elif len(landmarks) == 0:
+                    self.stats.count("no_pose_frames")
+
+                if flow is not None:
+                    flow.update(image_mat, landmarks)
+                series.append((frame_index, timestamp_ms, landmarks))
+
+        return LandmarkSeries.from_frames(series, sensitivity)
+
+    def pack_detection(self, detection_result):
+        """
+        :return: The landmarks of the first person in a PoseLandmarkerResult as a (33, 4) array of x, y, z, visibility,
+        or an empty (0, 4) array if nobody was detected
+        """
         if len(detection_result.pose_landmarks) == 0:
-            print("No pose detected! Try decreasing sensitivity.")
+            return np.empty((0, 4), dtype=np.float32)
+        if metrics.debug:
+            print(detection_result.pose_world_landmarks)
+
+        # Get the first one, since we are only going to be working with one person anyways
+        return pack_landmarks(detection_result.pose_landmarks[0])
+
+    def analyze_landmarks(self, landmarks, action_joints=None, sensitivity=0.5):
+        """
+        Turns packed landmarks (see pack_detection) into the connections (and angles) returned by analyze_photo.
+        The connections are a FrameLandmarks view over the array rather than a copy.
+        """
+        if len(landmarks) == 0 or np.isnan(landmarks[0, 0]):
+            if metrics.debug:
+                print("No pose detected! Try decreasing sensitivity.")
             return
-        print(detection_result.pose_world_landmarks)
-
-        with PoseLandmarker.create_from_options(options) as pose:
-            # Get the first one, since we are only going to be working with one person anyways
-            pose_landmarks_list = detection_result.pose_landmarks[0]
-            print(len(pose_landmarks_list))
-
-            for idx in range(len(pose_landmarks_list)):
-                pose_landmarks = pose_landmarks_list[idx]
-
-                # Draw the pose landmarks.
-                # pose_landmarks_proto = landmark_pb2.NormalizedLandmarkList()
-                # # print(pose_landmarks_proto)
-                # pose_landmarks_proto.landmark.extend([
-                #     landmark_pb2.NormalizedLandmark(x=landmark.x, y=landmark.y, z=landmark.z) for landmark in
-                #     pose_landmarks
-                # ])
-                # solutions.drawing_utils.draw_landmarks(
-                #     annotated_image,
-                #     pose_landmarks_proto,
-                #     solutions.pose.POSE_CONNECTIONS,
-                #     solutions.drawing_styles.get_default_pose_landmarks_style())
-                if pose_landmarks.visibility <= sensitivity:
-                    continue
-                connections[idx] = pose_landmarks
-            # self.draw_points(photo_path, (255, 0, 0), connections)
-            print("saved")
 
-            # Angle and movement analysis
-            if action_joints is None:
-                return connections
+        connections = FrameLandmarks(landmarks, landmarks[:, 3] > sensitivity)
+        if metrics.debug:
+            print(len(landmarks))
+        # self.draw_points(photo_path, (255, 0, 0), connections)
 
-            L_angle = None
-            R_angle = None
+        # Angle and movement analysis
+        if action_joints is None:
+            return connections
 
-            for i, (key, joints) in enumerate(action_joints.items()):
-                action_joint = key
-                adj_joint_1, adj_joint_2 = joints
+        # Accept the raw criteria dictionary as well as the index triples from CompiledMovement.action_triples
+        if isinstance(action_joints, dict):
+            action_joints = compile_action_joints(action_joints)
 
-                action_joint = connections.get(getattr(PoseLandmark, action_joint))
-                adj_joint_1 = connections.get(getattr(PoseLandmark, adj_joint_1))
-                adj_joint_2 = connections.get(getattr(PoseLandmark, adj_joint_2))
+        L_angle = None
+        R_angle = None
 
-                # If we do not see the action joints or adjacent joints, move on
-                if None in (action_joint, adj_joint_1, adj_joint_2):
-                    continue
+        for i, (action_joint, adj_joint_1, adj_joint_2) in enumerate(action_joints.tolist()):
+            action_joint = connections.get(action_joint)
+            adj_joint_1 = connections.get(adj_joint_1)
+            adj_joint_2 = connections.get(adj_joint_2)
 
-                angle_1 = self.get_angle(action_joint, adj_joint_1, adj_joint_2)
-                if i == 0:
-                    L_angle = angle_1
-                else:
-                    R_angle = angle_1
-
-            return L_angle, R_angle, connections
-            # cv2.imshow('A', cv2.cvtColor(annotated_image, cv2.COLOR_RGB2BGR))
-            # cv2.waitKey(0)
-            # cv2.imwrite('kms.jpg', annotated_image)
-
-            image_height, image_width, _ = image.shape
-            results = pose.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-            annotated_image = image
-
-            if results.segmentation_mask is None:
-                print(f"No segmentation mask for {os.path.basename(self.sequence_path)}")
-                return
-
-            condition = np.stack((results.segmentation_mask,) * 3, axis=-1) > 0.1
-            bg_image = np.zeros(image.shape, dtype=np.uint8)
-            bg_image[:] = BG_COLOR
-            annotated_image = np.where(condition, annotated_image, bg_image)
-            corners = self.get_mask_corners_cv(results.segmentation_mask, 0.1)
-
-            # mp_drawing.draw_landmarks(
-            #     annotated_image,
-            #     results.pose_landmarks,
-            #     connections=custom_connections,  # passing the modified connections list
-            #     landmark_drawing_spec=custom_style)  # and drawing style
-
-            # Make sure corners and landmarks exist
-            if results.pose_landmarks is None:
-                print(
-                    f"No landmarks for {os.path.basename(self.sequence_path)}")
-                return
-            all_points.append(corners)
-
-            connections_made = []
-            connections_1 = []
-            connections_2 = []
-            d_connections_1 = {}
-            d_connections_2 = {}
-            left_hip, right_hip = None, None
-            # Check if connections exist, delete if connections aren't visible enough
-            # CONNECTION FORMAT: Connection ID1, Connection ID2, Landmark 1, Landmark 2
-            print(results.pose_landmarks.landmark)
-            for index_1, i in enumerate(results.pose_landmarks.landmark):
-                for index_2, j in enumerate(results.pose_landmarks.landmark):
-                    connection = (index_1, index_2)
-                    if connection in custom_connections and i.visibility >= 0.2 and j.visibility >= 0.2:
-                        d_connections_1[index_1] = i
-                        d_connections_2[index_2] = j
-                        connection += (i, j)
-                        connections_1.append(index_1)
-                        connections_2.append(index_2)
-                        connections_made.append(connection)
-
-            print(connections_1)
-            print(connections_2)
-            connection_valid = True
-
-            # find action joints by finding each key associated with each joint, which will point to its coords
-            # if the action joint doesn't exist, stop looking for this frame
-            # if it does, find the other two adjacent joints and get their coordinates
-            # if the adjacent joints do not exist, we cannot find the angle, so terminate
-            # pass all coordinates into the angle function and add the output to a graph
-            # if the best fit is quadratic for one of the two dictionaries, we can say it an exercise and not
-            # noise
-            for key, joints in action_joints.items():
-                for pair in joints:
-                    action_joint = pair[0].value
-                    adj_joint_1, adj_joint_2 = pair[1]
-
-                    adj_joint_1 = adj_joint_1.value
-                    adj_joint_2 = adj_joint_2.value
-
-                    action_joint_1 = d_connections_1.get(action_joint)
-                    action_joint_2 = d_connections_2.get(action_joint)
-                    adj_joint_11 = d_connections_1.get(adj_joint_1)
-                    adj_joint_21 = d_connections_1.get(adj_joint_2)
-                    adj_joint_12 = d_connections_2.get(adj_joint_1)
-                    adj_joint_22 = d_connections_2.get(adj_joint_2)
-
-                    # If we do not see the action joints or adjacent joints, move on
-                    if None in (action_joint_1, action_joint_2, adj_joint_11, adj_joint_21, adj_joint_12, adj_joint_22):
-                        continue
-                    angle_1 = self.get_angle(action_joint_1, adj_joint_11, adj_joint_21)
-                    angle_2 = self.get_angle(action_joint_2, adj_joint_12, adj_joint_22)
-                    return angle_1, angle_2, d_connections_1, d_connections_2
-
-    def get_candidate_frames(self, angles_1):
-        candidate_frames = []
-        # print(angles_1)
-        if len(angles_1) > 0:
-            # min_index = 0
-            # min_angle = list(angles_1.values())[min_index]
-
-            # for f, angle in enumerate(angles_1.values()):
-            #     # Keep going until we find the first index that's numerical
-            #     if min_angle is None:
-            #         min_angle = list(angles_1.values())[f]
-            #     if angle is None:
-            #         continue
-                
-            #     if angle <= min_angle and f - min_index > 1:
-            #         x = list(angles_1.keys())[min_index:f]
-            #         y = list(angles_1.values())[min_index:f]
-
-            #         # Make sure each section has at least 5 angles to analyze, prevents noise
-            #         # Without this conditional, the program may bring in extra points past the miniumum, causing
-            #         # inaccurate fits
-            #         if len(x) < 3:
-            #             min_index = f
-            #             min_angle = angle
-            #             continue
-
-            #         # r-squared
-            #         r_s_poly = self.polyfit(x, y, 2)['determination']
-            #         r_s_one = self.polyfit(x, y, 1)['determination']
-
-            #         # if the fit is quadratic
-            #         if r_s_poly > r_s_one:
-            #             candidate_frames += list(angles_1.keys())[min_index:f]
-
-            #         min_angle = angle
-            #         min_index = f
-
-            #         # plt.scatter(x, y)
-            #         # plt.show()
-
-            # x = list(angles_1.keys())[min_index:]
-            # y = list(angles_1.values())[min_index:]
-
-            angles_1_no_none = {k:v for (k, v) in angles_1.items() if v is not None}
-            labels = list([i for i in range(len(angles_1_no_none.keys()))])
-            values = list(angles_1_no_none.values())
-
-            # print(angles_1_no_none)
-
-            sine_fit = self.fit_sin(labels, values)
-            angle_thresh = sine_fit["offset"] - abs(sine_fit["amp"])
-
-            # epsilon -> tolerance
-            # print(angle_thresh)
-            min_values = [i for i in values if i <= angle_thresh]
-            # If sine fit didn't work, pick the lowest position
-            if len(min_values) == 0:
-                min_values = [min(values)]
-
-            # print(min_values)
-            min_key = -1
-            prev_frame = 0
-            current_min = float('inf')
-
-            # Messy af refactor later
-            # Attempt to find key frame per every rep of the exercise
-            for k, v in angles_1.items():
-                if v not in min_values:
-                    continue
+            # If we do not see the action joints or adjacent joints, move on
+            if None in (action_joint, adj_joint_1, adj_joint_2):
+                continue
 
-                if k - 1 != prev_frame:
-                    if min_key != -1:
-                        candidate_frames.append(min_key)
-                    elif len(candidate_frames) >= 0:
-                        candidate_frames.append(k)  
+            angle_1 = self.get_angle(action_joint, adj_joint_1, adj_joint_2)
+            if i == 0:
+                L_angle = angle_1
+            else:
+                R_angle = angle_1
 
-                    min_key = -1
-                    current_min = float('inf')
-                else:
-                    if v < current_min:
-                        current_min = v
-                        min_key = k
-                prev_frame = k
+        return L_angle, R_angle, connections
 
-        return candidate_frames if len(candidate_frames) != 0 else None
+    def get_candidate_frames(self, angles_1, min_rep_seconds=0.5):
+        """
+        Finds the bottom of every rep in the action joint's angle series, see rep_segmentation.find_reps. The reps
+        found are kept on self.reps, with their positions converted to the keys of angles_1.
+        :param angles_1: {frame: angle}, angle being None where the joints weren't seen. Frames with no detection at
+               all can be left out.
+        :param min_rep_seconds: bottoms closer together than this are the same rep. Default to half a second.
+        :return: The frame of each rep's bottom, or None if there are no angles
+        """
+        angles_no_none = {k: v for (k, v) in angles_1.items() if v is not None}
+        if len(angles_no_none) == 0:
+            self.reps = []
+            return None
+
+        # Lay the angles out on consecutive frames, missing ones as NaN, so positions line up with time
+        first = min(angles_1)
+        values = np.full(max(angles_1) - first + 1, np.nan)
+        for k, v in angles_no_none.items():
+            values[k - first] = v
+
+        min_spacing = max(int(round(min_rep_seconds * self.frames_cut_ps)), 1)
+        reps = find_reps(values, min_spacing=min_spacing)
+        # If no reps stand out, pick the lowest position
+        if len(reps) == 0:
+            bottom = int(np.nanargmin(values))
+            reps = [Rep(bottom, 0, len(values) - 1, 0.0, 0.0)]
+
+        self.reps = [Rep(rep.bottom + first, rep.start + first, rep.end + first, rep.depth, rep.confidence)
+                     for rep in reps]
+        return [rep.bottom for rep in self.reps]
 
     def analyze_bottom_position(self, image_path, movement_type):
-        criteria = open(os.path.join(self.base_dir, 'movement_criteria.json'))
-        criteria_data = json.load(criteria)
-
-        base_options = python.BaseOptions(model_asset_path=os.path.join(self.base_dir, 'pose_landmarker_heavy.task'))
-        options = vision.PoseLandmarkerOptions(
-            base_options=base_options,
-            output_segmentation_masks=True)
-        detector = vision.PoseLandmarker.create_from_options(options)
-        img = mp.Image.create_from_file(image_path)
-        detection_result = detector.detect(img)
+        movement = load_criteria(os.path.join(self.base_dir, 'movement_criteria.json'))[movement_type]
 
         connections = self.analyze_photo(image_path, sensitivity=0.5)
 
         # print(connections)
-        image_mat = cv2.imread(image_path)
+        image_mat = self.load_frame(image_path)
+        if image_mat is not None and not image_mat.flags.writeable:
+            # Straight out of the frame store, draw on a copy
+            image_mat = image_mat.copy()
         # if self.width < self.height:
         #     image_mat = cv2.rotate(image_mat, cv2.ROTATE_90_CLOCKWISE)
 
-        analyzed_path = self.draw_points(image_mat, (os.path.basename(image_path)).strip('.jpg'), (255, 0, 0), connections)
+        if self.landmark_cache:
+            self.landmark_cache.flush()
+
+        with self.stats.timer("drawing"):
+            analyzed_path = self.draw_points(image_mat, (os.path.basename(image_path)).strip('.jpg'), (255, 0, 0),
+                                             connections)
         self.analyzed_images_path.append(analyzed_path)
         # self.draw_points(image, (0, 255, 0), connections_2)
-        left_required, right_required = [], []
 
-        for i in criteria_data[movement_type]["action_joints"]:
-            if "LEFT" in i:
-                left_required.append(i)
-                left_required += criteria_data[movement_type]["action_joints"][i]
-            else:
-                right_required.append(i)
-                right_required += criteria_data[movement_type]["action_joints"][i]
-
-        profile = self.determine_profile(connections, left_required, right_required)
-        c = criteria_data[movement_type]["assessment_side"]
-        assessment_range = []
-
-        # You can analyze the side profile with the front profile, but not the other way around, although it may
-        # be inaccurate. Try both profiles and let the user discern themselves if they want both pieces of advice
-        # if profile == "front":
-        #     c.update(criteria_data["squat"]["assessment_front"])
-        #     assessment_range += c
-
-        for i in c:
-            assessment_range.append(i)
-
-        print("ASS")
-        print(assessment_range)
-        score_per_condition = {}
-        for i in assessment_range:
-            required_joints = {}
-            print(c[i])
-
-            for condition in c[i]:
-                required_joints[condition] = c[i][condition]["joints"]
-
-            for k, v in required_joints.items():
-                target_slope = c[i][k]["m"]
-                assessment_type = c[i][k]["assessment_type"]
-                score = self.get_score(connections, v, target_slope, assessment_type, "side")
-                if score is not None:
-                    score_per_condition[k] = score
-
-        # You can analyze the side profile with the front profile, but not the other way around, although it may
-        # be inaccurate. Try both profiles and let the user discern themselves if they want both pieces of advice
-        assessment_range = []
-
-        if profile == "front":
-            c = criteria_data[movement_type]["assessment_front"]
-
-            for i in c:
-                assessment_range.append(i)
-
-            for i in assessment_range:
-                required_joints = {}
-                # print(c[i])
-
-                for condition in c[i]:
-                    required_joints[condition] = c[i][condition]["joints"]
-
-                for k, v in required_joints.items():
-                    target_slope = c[i][k]["m"]
-                    assessment_type = c[i][k]["assessment_type"]
-                    score = self.get_score(connections, v, target_slope, assessment_type, "side")
-                    if score is not None:
-                        score_per_condition[k] = score
-
-        criteria.close()
-        return score_per_condition
+        with self.stats.timer("scoring"):
+            profile = self.determine_profile(connections, movement.left_required, movement.right_required)
 
-    def draw_points(self, img, img_name, colour, connection_list):
-        img_height, img_width, _ = img.shape
+            # You can analyze the side profile with the front profile, but not the other way around, although it may
+            # be inaccurate. Try both profiles and let the user discern themselves if they want both pieces of advice
+            return get_scorer(movement, m_inf_threshold).score_frame(connections, profile)
+
+    def score_frames(self, movement_type, frame_indices=None, redetect=None):
+        """
+        Scores frames of the landmark series built by find_key_time in one go, ex; the bottom of every rep.
+        :param frame_indices: the frames' positions in the video. Default to None (every analyzed frame).
+        :param redetect: detect the frames again with the score model first, like analyze_bottom_position does.
+               Default to None (only when frame_indices are given and the series came from a different model).
+        :return: A dictionary of {frame index: score dictionary}, with the same score dictionaries as
+        analyze_bottom_position. Frames that weren't analyzed or where nobody was detected are left out.
+        """
+        if self.landmarks is None:
+            return {}
+
+        series = self.landmarks
+        if frame_indices is None:
+            positions = np.flatnonzero(series.detected)
+        else:
+            positions = [series.position(i) for i in frame_indices]
+            positions = np.array([p for p in positions if p is not None and series.detected[p]], dtype=np.intp)
+
+        if redetect is None:
+            redetect = frame_indices is not None and self.models["score"] != self.models["scan"]
+        if redetect:
+            series = LandmarkSeries.from_frames(
+                ((frame_index, timestamp_ms, self.detect_landmarks(frame, frame_index, series.sensitivity))
+                 for (frame_index, frame), timestamp_ms in zip(self.read_frames(series.frame_indices[positions]),
+                                                               series.timestamps_ms[positions])),
+                series.sensitivity)
+            positions = np.flatnonzero(series.detected)
+
+        movement = load_criteria(os.path.join(self.base_dir, 'movement_criteria.json'))[movement_type]
+        with self.stats.timer("scoring"):
+            scores = get_scorer(movement, m_inf_threshold).score_dicts(series.landmarks[positions],
+                                                                       series.visible[positions])
+        return dict(zip(series.frame_indices[positions].tolist(), scores))
+
+    def render_annotations(self, movement_type, frame_indices=None, scores=None, video=False, tile_width=320,
+                           columns=4, video_fps=None, video_max_side=480):
+        """
+        Draws the skeleton and the scores of every key frame onto one contact sheet image (images_<id>_contact.jpg),
+        so the frontend fetches one file instead of each _mediapipe.jpg. Optionally also writes a downscaled video of
+        the whole clip with the skeleton on it (images_<id>_annotated.mp4), in the same pass over the video.
+        The landmarks come from self.landmarks, nothing is detected again. Frames are drawn on after downscaling and
+        only the sheet's tiles are kept, so memory doesn't grow with the video's length or resolution.
+        :param frame_indices: frames to put on the contact sheet. Default to None (the bottom of every rep).
+        :param scores: {frame index: score dictionary}, ex; from score_frames. Default to None (score_frames).
+        :param video: also write the annotated video. Default to False.
+        :param video_fps: frame rate of the annotated video. Frames in between analyzed ones show the last analyzed
+               frame's skeleton. Default to None (frames_cut_ps, every analyzed frame once).
+        :param video_max_side: longer side of the annotated video, in pixels. Default to 480.
+        :return: {"contact_sheet": path, "video": path, "frames": frame indices on the sheet}, paths being None when
+        nothing was written, or None if find_key_time hasn't run
+        """
+        series = self.landmarks
+        if series is None:
+            return None
+        if frame_indices is None:
+            frame_indices = [int(series.frame_indices[rep.bottom]) for rep in self.reps or []]
+        if scores is None:
+            scores = self.score_frames(movement_type, frame_indices)
+        movement = load_criteria(os.path.join(self.base_dir, 'movement_criteria.json'))[movement_type]
+        titles = {condition.name: condition.title for conditions in movement.assessments.values()
+                  for condition in conditions}
+
+        tiles = {}
+        numbers = {frame_index: n for n, frame_index in enumerate(frame_indices, 1)}
+
+        def add_tile(frame_index, frame):
+            position = series.position(frame_index)
+            landmarks = series.landmarks[position] if position is not None and series.detected[position] else None
+            with self.stats.timer("drawing"):
+                tiles[frame_index] = draw_tile(frame, landmarks, series.visible[position] if landmarks is not None
+                                               else None, scores.get(frame_index), titles,
+                                               f"{numbers[frame_index]}: frame {frame_index}", tile_width)
+
+        wanted = set(frame_indices)
+        video_path = None
+        if video:
+            video_path = self.get_sequence_path() + "_annotated.mp4"
+            fps = video_fps or self.frames_cut_ps
+            # How long an analyzed frame's skeleton stays up, a frame more than one sampling interval away is blank
+            hold_ms = 1000 / min(self.frames_cut_ps, fps)
+            key_frames = np.array(sorted(i for i in wanted if i in scores), dtype=np.int64)
+            with AnnotatedVideoWriter(video_path, fps, video_max_side) as writer:
+                for frame_index, timestamp_ms, frame in self.iter_frames(FrameSampler(self.video_path, fps)):
+                    if frame_index in wanted and frame_index not in tiles:
+                        add_tile(frame_index, frame)
+
+                    with self.stats.timer("drawing"):
+                        position = np.searchsorted(series.frame_indices, frame_index, side="right") - 1
+                        landmarks = visible = None
+                        if position >= 0 and series.detected[position] and \
+                                timestamp_ms - series.timestamps_ms[position] <= hold_ms:
+                            landmarks, visible = series.landmarks[position], series.visible[position]
+                        # The scores of the last key frame stay up until the next one
+                        key = np.searchsorted(key_frames, frame_index, side="right") - 1
+                        lines = score_lines(scores[int(key_frames[key])], titles) if key >= 0 else None
+                        writer.write(frame, landmarks, visible, lines)
+            if writer.frames == 0:
+                # The writer only creates the file with the first frame, this is an older render's
+                if os.path.exists(video_path):
+                    os.remove(video_path)
+                video_path = None
+
+        # Key frames the pass didn't land on, or all of them without a video, come from the frame store or by seeking
+        missing = [i for i in frame_indices if i not in tiles]
+        store = self.get_frame_store()
+        if store is not None:
+            for frame_index in missing:
+                if frame_index in store:
+                    add_tile(frame_index, store.get(frame_index))
+            missing = [i for i in missing if i not in tiles]
+        for frame_index, frame in self.read_frames(missing):
+            add_tile(frame_index, frame)
+
+        on_sheet = [i for i in frame_indices if i in tiles]
+        sheet_path = None
+        with self.stats.timer("drawing"):
+            sheet = contact_sheet([tiles[i] for i in on_sheet], columns)
+            if sheet is not None:
+                sheet_path = self.get_sequence_path() + "_contact.jpg"
+                cv2.imwrite(sheet_path, sheet)
+        return {"contact_sheet": sheet_path, "video": video_path, "frames": on_sheet}
 
-        for k, joint in connection_list.items():
-            cv2.circle(img, (int(joint.x * img_width), int(joint.y * img_height)), 5, colour,
-                       -1)
+    def draw_points(self, img, img_name, colour, connection_list):
+        if isinstance(connection_list, FrameLandmarks):
+            draw_pose(img, connection_list.data, connection_list.visible, colour, radius=5, thickness=0)
+        else:
+            img_height, img_width, _ = img.shape
+            for k, joint in connection_list.items():
+                cv2.circle(img, (int(joint.x * img_width), int(joint.y * img_height)), 5, colour, -1)
             # cv2.putText(img, str(k), (int(joint.x * img_width), int(joint.y * img_height)), cv2.FONT_HERSHEY_SIMPLEX,
             #             0.5, (0, 0, 0))
 
@@ -565,14 +1016,21 @@ class VideoAnalyzer(DataAnalyzer):
         # print("angle:", math.degrees(angle))
         # print("|D_L|:", np.linalg.norm(vec_hip_L- vec_knee_L), "D_L:", vec_hip_L - vec_knee_L)
         # print("Left Hip:", joint_hip_R)
+        # With the frame store the folder only holds the analyzed images, it may not exist yet
+        os.makedirs(self.sequence_path, exist_ok=True)
         cv2.imwrite(os.path.join(self.sequence_path, img_name + "_mediapipe.jpg"), img)
         return os.path.join(self.sequence_path, img_name + "_mediapipe.jpg")
 
     def determine_profile(self, connections, required_landmarks_left, required_landmarks_right, delta_x_side_thresh=0.075):
+        """
+        :param required_landmarks_left: landmark indices that must be visible on the left side for a front profile,
+               see CompiledMovement.left_required
+        :param required_landmarks_right: the matching right side landmark indices, in the same order
+        """
         landmarks = connections.keys()
         # First check: Do our landmarks match for each side? If they don't, we can already say its a side profile
-        front_profile = required_landmarks_left + required_landmarks_right
-        if len([landmark for landmark in front_profile if getattr(PoseLandmark, landmark) in landmarks]) != len(front_profile):
+        front_profile = list(required_landmarks_left) + list(required_landmarks_right)
+        if len([landmark for landmark in front_profile if landmark in landmarks]) != len(front_profile):
             return "side"
 
         # print(connections.keys())
@@ -582,8 +1040,8 @@ class VideoAnalyzer(DataAnalyzer):
         delta_xs = []
         for i in range(len(required_landmarks_left)):
             # print(required_landmarks_left[i])
-            left_landmark = connections.get(getattr(PoseLandmark, required_landmarks_left[i]))
-            right_landmark = connections.get(getattr(PoseLandmark, required_landmarks_right[i]))
+            left_landmark = connections.get(required_landmarks_left[i])
+            right_landmark = connections.get(required_landmarks_right[i])
 
             if left_landmark is None or right_landmark is None:
                 continue
@@ -592,133 +1050,118 @@ class VideoAnalyzer(DataAnalyzer):
             delta_xs.append(delta_x)
 
         avg = np.average(np.array(delta_xs))
-        print("Dx:", delta_xs)
+        if metrics.debug:
+            print("Dx:", delta_xs)
         if avg <= delta_x_side_thresh:
             return "side"
         else:
             return "front"
 
     def add_side_prefix(self, joints):
-        left_side, right_side = [], []
-        for j in joints:
-            left_side.append("LEFT_" + j) if j != "MOUTH" else left_side.append(j + "_LEFT")
-            right_side.append("RIGHT_" + j) if j != "MOUTH" else right_side.append(j + "_RIGHT")
-
-        return left_side, right_side
+        return add_side_prefix(joints)
 
     def get_score(self, connections, analyzed_joints, target_slope, assessment_type, profile):
-        scores = []
-        print("A:", analyzed_joints)
-        print(assessment_type)
-        if assessment_type == "line":
-            for joints in analyzed_joints:
-                p1, p2 = None, None
-                joint_pair = self.add_side_prefix(joints) if profile == "side" else ([joints])
-
-                print(joint_pair)
-                for joint in joint_pair:
-                    p1 = connections.get(getattr(PoseLandmark, joint[0]))
-                    p2 = connections.get(getattr(PoseLandmark, joint[1]))
-
-                    if p1 is None or p2 is None:
-                        continue
+        condition = CompiledCondition(None, None, {"joints": analyzed_joints, "m": target_slope,
+                                                   "assessment_type": assessment_type}, profile, "get_score")
+        return self.score_condition(connections, condition)
 
-                    slope = self.get_slope(p1, p2, m_inf_threshold)
-                    if slope == 'inf':
-                        scores.append(self.get_percent_diff(slope, target_slope))
-                    else:
-                        scores.append(self.get_percent_diff(abs(slope), target_slope))
+    def score_condition(self, connections, condition):
+        """
+        Scores one compiled assessment condition. The lower the score, the closer the lifter is to the target.
+        :param condition: a CompiledCondition, see criteria.py
+        :return: The best (lowest) percent difference between the measured and target slopes, or None if none of the
+        condition's joints were visible
+        """
+        scores = []
+        target_slope = condition.target_slope
+        assessment_type = condition.assessment_type
 
         # The ugly one
-        elif assessment_type == "parallel_lines":
-            first_joints = analyzed_joints['first_line']
-            second_joints = analyzed_joints['second_line']
-
-            for joints_1 in first_joints:
-                left_side_first, right_side_first = self.add_side_prefix(joints_1) if profile == "side" else (joints_1)
-                for joints_2 in second_joints:
-                    left_side_second, right_side_second = self.add_side_prefix(joints_2) if profile == "side" else (joints_1, joints_2)
-                    if profile == "front":
-                        left_side_first, right_side_first = (joints_1, joints_2)
-                    slope_left_first, slope_left_second, slope_right_first, slope_right_second = None, None, None, None
-                    print(left_side_second, right_side_second, left_side_first, right_side_first)
-
-                    p1_left_first = connections.get(getattr(PoseLandmark, left_side_first[0]))
-                    p2_left_first = connections.get(getattr(PoseLandmark, left_side_first[1]))
-                    p1_left_second = connections.get(getattr(PoseLandmark, left_side_second[0]))
-                    p2_left_second = connections.get(getattr(PoseLandmark, left_side_second[1]))
-                    p1_right_first = connections.get(getattr(PoseLandmark, right_side_first[0]))
-                    p2_right_first = connections.get(getattr(PoseLandmark, right_side_first[1]))
-                    p1_right_second = connections.get(getattr(PoseLandmark, right_side_second[0]))
-                    p2_right_second = connections.get(getattr(PoseLandmark, right_side_second[1]))
-
-                    if None not in (p1_left_first, p2_left_first, p1_left_second, p2_left_second):
-                        slope_left_first = abs(self.get_slope(p1_left_first, p2_left_first, m_inf_threshold))
-                        slope_left_second = abs(self.get_slope(p1_left_second, p2_left_second, m_inf_threshold))
-                    if None not in (p1_right_first, p2_right_first, p1_right_second, p2_right_second):
-                        slope_right_first = abs(self.get_slope(p1_right_first, p2_right_first, m_inf_threshold))
-                        slope_right_second = abs(self.get_slope(p1_right_second, p2_right_second, m_inf_threshold))
-
-                    if target_slope != "None":
-                        if slope_left_first is not None and slope_left_second is not None:
-                            diff_1 = self.get_percent_diff(slope_left_first, target_slope)
-                            diff_2 = self.get_percent_diff(slope_left_second, target_slope)
-                            scores.append(np.average(np.array([diff_1, diff_2])))
-                        if slope_right_first is not None and slope_right_second is not None:
-                            diff_1 = self.get_percent_diff(slope_right_first, target_slope)
-                            diff_2 = self.get_percent_diff(slope_right_second, target_slope)
-                            scores.append(np.average(np.array([diff_1, diff_2])))
-                    else:
-                        if slope_left_first is not None and slope_left_second is not None:
-                            scores.append(self.get_percent_diff(slope_left_first, slope_left_second))
-                        if slope_right_first is not None and slope_right_second is not None:
-                            scores.append(self.get_percent_diff(slope_right_first, slope_right_second))
-        elif assessment_type == "min_line":
-            for joints in analyzed_joints:
-                left_side, right_side = self.add_side_prefix(joints) if profile == "side" else joints
-
-                for joint in (left_side, right_side):
-                    p1 = connections.get(getattr(PoseLandmark, joint[0]))
-                    p2 = connections.get(getattr(PoseLandmark, joint[1]))
-
-                    if p1 is None or p2 is None:
-                        continue
+        if assessment_type == "parallel_lines":
+            for (a_first, b_first), (a_second, b_second) in condition.pairs.tolist():
+                p1_first = connections.get(a_first)
+                p2_first = connections.get(b_first)
+                p1_second = connections.get(a_second)
+                p2_second = connections.get(b_second)
+
+                if None in (p1_first, p2_first, p1_second, p2_second):
+                    continue
 
-                    slope = self.get_slope(p1, p2, m_inf_threshold)
+                slope_first = self.get_slope(p1_first, p2_first, m_inf_threshold)
+                slope_second = self.get_slope(p1_second, p2_second, m_inf_threshold)
+                slope_first = abs(slope_first) if slope_first != 'inf' else slope_first
+                slope_second = abs(slope_second) if slope_second != 'inf' else slope_second
 
-                    if slope >= target_slope:
-                        scores.append(0)
-                    else:
-                        if slope == 'inf':
-                            scores.append(self.get_percent_diff(slope, target_slope))
-                        else:
-                            scores.append(self.get_percent_diff(abs(slope), target_slope))
-        elif assessment_type == "max_line":
-            for joints in analyzed_joints:
-                left_side, right_side = self.add_side_prefix(joints) if profile == "side" else joints
-
-                for joint in (left_side, right_side):
-                    p1 = connections.get(getattr(PoseLandmark, joint[0]))
-                    p2 = connections.get(getattr(PoseLandmark, joint[1]))
-
-                    if p1 is None or p2 is None:
-                        continue
+                if target_slope != "None":
+                    diff_1 = self.get_percent_diff(slope_first, target_slope)
+                    diff_2 = self.get_percent_diff(slope_second, target_slope)
+                    scores.append(np.average(np.array([diff_1, diff_2])))
+                else:
+                    scores.append(self.get_percent_diff(slope_first, slope_second))
+        else:
+            for a, b in condition.pairs.tolist():
+                p1 = connections.get(a)
+                p2 = connections.get(b)
 
-                    slope = self.get_slope(p1, p2, m_inf_threshold)
+                if p1 is None or p2 is None:
+                    continue
 
-                    if slope <= target_slope:
-                        scores.append(0)
-                    else:
-                        if slope == 'inf':
-                            scores.append(self.get_percent_diff(slope, target_slope))
-                        else:
-                            scores.append(self.get_percent_diff(abs(slope), target_slope))
+                slope = self.get_slope(p1, p2, m_inf_threshold)
+
+                if assessment_type == "min_line" and (slope == 'inf' or slope >= target_slope):
+                    scores.append(0)
+                elif assessment_type == "max_line" and slope != 'inf' and slope <= target_slope:
+                    scores.append(0)
+                elif slope == 'inf':
+                    scores.append(self.get_percent_diff(slope, target_slope))
+                else:
+                    scores.append(self.get_percent_diff(abs(slope), target_slope))
 
         return min([abs(i) for i in scores]) if len(scores) != 0 else None
     
-    def purge(self):
-        send2trash.send2trash(self.sequence_path)
-        send2trash.send2trash(self.video_path)
+    def close(self, keep=True):
+        """
+        Closes the frame store and releases the workspace, see Workspace.release.
+        :param keep: leave the workspace's files until they're evicted. Default to True, False deletes them now.
+        """
+        self.close_frame_store()
+        if self.workspace is not None:
+            self.workspace.release(keep)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # A failed analysis' frames are of no use to anyone
+        self.close(keep=exc_type is None)
+
+    def purge(self, trash=False):
+        """
+        Deletes the video and everything the analysis wrote.
+        :param trash: send the video and the frames to the trash instead of deleting them, ex; on a desktop. Default to
+               False, on a server the trash is just another folder that fills the disk.
+        """
+        self.close_frame_store()
+        for path in (self.get_frame_store_path(), self.get_sequence_path() + "_contact.jpg",
+                     self.get_sequence_path() + "_annotated.mp4"):
+            if os.path.exists(path):
+                os.remove(path)
+
+        paths = [self.video_path]
+        if self.sequence_path is not None and os.path.exists(self.sequence_path):
+            paths.append(self.sequence_path)
+        if trash:
+            import send2trash
+            for path in paths:
+                send2trash.send2trash(path)
+        else:
+            for path in paths:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+        if self.workspace is not None:
+            self.workspace.delete()
 
 
 # lift_folders = ["squat", "deadlifting", "bench pressing"]
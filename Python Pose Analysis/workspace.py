@@ -0,0 +1,235 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Files a workspace keeps its state in, next to the analysis' own files
+owner_file = ".owner"
+done_file = ".done"
+
+
+def directory_size(path):
+    """
+    :return: The size in bytes of every file under path, 0 if it doesn't exist
+    """
+    total = 0
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        return 0
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    total += directory_size(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                # Deleted while we were looking, ex; evicted by another process
+                continue
+    return total
+
+
+def pid_alive(pid):
+    if os.name == "nt":
+        # os.kill would terminate the process on Windows, assume it's still running
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+class Workspace:
+    def __init__(self, manager, path):
+        """
+        The folder one analysis keeps its working files in, see WorkspaceManager.acquire. While in use it's never
+        evicted. Once released it's kept until the manager needs the space, or deleted straight away. Call
+        WorkspaceManager.touch when its files are read afterwards, so it's evicted after workspaces nobody looked at.
+        Works as a context manager: released when the block finishes, deleted if it raised, so a crashed analysis
+        doesn't leave its frames behind.
+        """
+        self.manager = manager
+        self.path = path
+        self.closed = False
+
+    def join(self, *names):
+        return os.path.join(self.path, *names)
+
+    @property
+    def nbytes(self):
+        return directory_size(self.path)
+
+    def release(self, keep=True):
+        """
+        Marks the analysis as finished.
+        :param keep: leave the files until the manager evicts them, ex; so the frontend can still fetch the analyzed
+               images. Default to True, False deletes them now.
+        """
+        if self.closed:
+            return
+        if not keep:
+            self.delete()
+            return
+        self.closed = True
+        try:
+            # Its modification time is when the workspace was last used, for the LRU
+            with open(self.join(done_file), 'w'):
+                pass
+            os.remove(self.join(owner_file))
+        except OSError:
+            pass
+        self.manager.evict()
+
+    def delete(self):
+        """
+        Deletes the workspace and everything in it outright, nothing goes through the trash.
+        """
+        self.closed = True
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.release(keep=exc_type is None)
+
+    def __repr__(self):
+        return f"Workspace({self.path!r}, closed={self.closed})"
+
+
+class WorkspaceManager:
+    def __init__(self, root=None, max_bytes=4 << 30):
+        """
+        Hands out one folder per analysis under root, and keeps everything under root within max_bytes by deleting
+        the least recently used workspaces, used, meaning released or touched. Workspaces still in use are never
+        deleted, they only count towards the total. The state is kept in the folders themselves, so several processes
+        can share a root, and workspaces of processes that died without releasing them are deleted the next time the
+        manager looks.
+        :param root: where workspaces go, a tmpfs mount keeps frames in memory instead of on disk, ex; /dev/shm/pose.
+               Default to None (pose_analysis/ in the system's temporary directory).
+        :param max_bytes: budget for everything under root. Default to 4 GiB.
+        """
+        self.root = root or os.path.join(tempfile.gettempdir(), "pose_analysis")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def acquire(self, name="analysis"):
+        """
+        Creates a new, empty workspace. Makes room for it first if root is over budget.
+        :param name: start of the folder's name, ex; the video's name. A random suffix keeps it unique.
+        :return: The Workspace, release it (or use it as a context manager) once the analysis is done
+        """
+        self.evict()
+        name = "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+        path = tempfile.mkdtemp(prefix=f"{name}-", dir=self.root)
+        with open(os.path.join(path, owner_file), 'w') as f:
+            f.write(str(os.getpid()))
+        return Workspace(self, path)
+
+    def touch(self, path):
+        """
+        Marks a released workspace as just used, so it's evicted last. Call it whenever its files are read, ex; when
+        the frontend fetches an analyzed image.
+        :param path: the workspace's folder or any file in it
+        :return: False if path isn't in a released workspace under root
+        """
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        if relative == os.curdir or relative.startswith(os.pardir):
+            return False
+        workspace = os.path.join(self.root, relative.split(os.sep)[0])
+        try:
+            os.utime(os.path.join(workspace, done_file))
+        except OSError:
+            # Still in use, or already evicted
+            return False
+        return True
+
+    def scan(self):
+        """
+        :return: A list of (state, last used, bytes, path) tuples for every workspace under root, state being
+        "active", "done" or "stale" (its process is gone)
+        """
+        workspaces = []
+        try:
+            entries = [entry for entry in os.scandir(self.root) if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return workspaces
+
+        for entry in entries:
+            try:
+                done = os.stat(os.path.join(entry.path, done_file))
+                workspaces.append(("done", done.st_mtime, directory_size(entry.path), entry.path))
+                continue
+            except OSError:
+                pass
+            try:
+                with open(os.path.join(entry.path, owner_file)) as f:
+                    pid = int(f.read() or 0)
+            except (OSError, ValueError):
+                pid = 0
+            try:
+                last_used = entry.stat().st_mtime
+            except OSError:
+                continue
+            if pid:
+                state = "active" if pid_alive(pid) else "stale"
+            else:
+                # Just created by acquire, which hasn't written the owner yet
+                state = "active" if time.time() - last_used < 60 else "stale"
+            workspaces.append((state, last_used, directory_size(entry.path), entry.path))
+        return workspaces
+
+    def usage(self):
+        """
+        :return: {"active": bytes, "done": bytes, "stale": bytes, "workspaces": count} across every process using root
+        """
+        usage = {"active": 0, "done": 0, "stale": 0, "workspaces": 0}
+        for state, _, size, _ in self.scan():
+            usage[state] += size
+            usage["workspaces"] += 1
+        return usage
+
+    def evict(self):
+        """
+        Deletes workspaces left behind by dead processes, then the least recently used released ones until root is
+        back under budget.
+        :return: The number of bytes freed
+        """
+        with self._lock:
+            workspaces = self.scan()
+            total = sum(size for _, _, size, _ in workspaces)
+            freed = 0
+            # Stale ones go first whatever their age, then released ones least recently used first
+            for state, _, size, path in sorted(workspaces, key=lambda w: (w[0] != "stale", w[1])):
+                if state == "active" or (state == "done" and total <= self.max_bytes):
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                freed += size
+            return freed
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_workspace_manager():
+    """
+    Returns the process-wide WorkspaceManager. Its root can be moved with the POSE_ANALYSIS_WORKSPACE environment
+    variable, ex; to a tmpfs mount, and its budget set in bytes with POSE_ANALYSIS_WORKSPACE_BYTES.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            max_bytes = os.environ.get("POSE_ANALYSIS_WORKSPACE_BYTES")
+            _manager = WorkspaceManager(os.environ.get("POSE_ANALYSIS_WORKSPACE") or None,
+                                        int(max_bytes) if max_bytes else 4 << 30)
+        return _manager